@@ -1,9 +1,6 @@
+import importlib
+
 from skipping_schoo import version
-from skipping_schoo import download_schoo
-from skipping_schoo import rip_audio
-from skipping_schoo import transscribe
-from skipping_schoo import summarize
-from skipping_schoo import utils
 from skipping_schoo.errors import SkippingSchooError
 
 
@@ -17,3 +14,19 @@ __all__ = [
     "utils",
     "SkippingSchooError"
 ]
+
+# Stage modules pull in heavy dependencies (whisper, tokenizers, bs4), so they
+# are only imported when first accessed as attributes of the package
+_LAZY_MODULES = {"download_schoo", "rip_audio", "transscribe", "summarize", "utils"}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_MODULES:
+        module = importlib.import_module(f"skipping_schoo.{name}")
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module 'skipping_schoo' has no attribute '{name}'")
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | _LAZY_MODULES)
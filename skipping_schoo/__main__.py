@@ -1,12 +1,20 @@
 import argparse
+import json
 import os
+import shutil
 import sys
-
-import openai
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from skipping_schoo import version
+from skipping_schoo import artifact_cache
+from skipping_schoo import draft
+from skipping_schoo import llm_cache
+from skipping_schoo import metrics
 from skipping_schoo import download_schoo
+from skipping_schoo import parallel_transcribe
 from skipping_schoo import rip_audio
+from skipping_schoo import storage
 from skipping_schoo import transscribe
 from skipping_schoo import summarize
 from skipping_schoo import utils
@@ -14,58 +22,333 @@ from skipping_schoo.errors import SkippingSchooError
 
 PROG = "SkippingSchoo"
 
-def _pipeline(url: str, overwrite: bool = False, cleanup: bool = False) -> str:
-    """Runs the entire pipeline for downloading a schoo video. Prints the transcription to the terminal"""
-    openai_key = os.getenv("OPENAI_API_KEY")
-    if openai_key is None or len(openai_key) == 0:
-        raise SkippingSchooError(
-            "No OpenAI API key set at the OPENAI_API_KEY environment variable"
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def _pipeline(
+    url: str,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    audio_only: bool = False,
+    stream: bool = False,
+    downloader: str = download_schoo.DOWNLOADER,
+    use_cache: bool = True,
+    processes: int = 1,
+    draft_model: Optional[str] = None,
+) -> str:
+    """Runs the entire pipeline for downloading a schoo video. Prints the transcription to the terminal
+
+    [audio_only] downloads the audio straight into the wav file, skipping the video and the rip step.
+    [stream] goes further, and hands the decoded audio straight to Whisper without writing a wav file
+    [downloader] picks how the playlist is fetched, see download_schoo.DOWNLOADERS
+    [use_cache] reuses the course title, m3u8 url and pages looked up by previous runs, and the output of
+    every stage that previous runs already produced from the same inputs and parameters, and OpenAI responses to the same requests
+    [processes] above 1 transcribes pieces of the audio, split at silences, on that many processes
+    [draft_model] first transcribes with that small Whisper model, and prints and publishes a draft summary of it
+    while the full model transcribes in the background. The full summary then replaces the draft
+    """
+    summarize.configure_backend()
+    cache = artifact_cache.get_cache() if use_cache else None
+    summarize.USE_RESPONSE_CACHE = use_cache
+    course_title = download_schoo.get_video_title(url, use_cache=use_cache)
+    wav_path = None
+    if stream:
+        transcription_path = _streamTranscribe(
+            url, overwrite=overwrite, use_cache=use_cache, cache=cache
         )
     else:
-        openai.api_key = openai_key
-    course_title = download_schoo.get_video_title(url)
-    video_path = _downloadSchoo(url, overwrite=overwrite, cleanup=cleanup)
-    wav_path = _ripAudio(video_path, overwrite=overwrite, cleanup=cleanup)
-    transcription_path = _transcribeAudio(
-        wav_path, overwrite=overwrite, cleanup=cleanup
-    )
+        if audio_only:
+            wav_path = _downloadAudio(
+                url,
+                overwrite=overwrite,
+                downloader=downloader,
+                use_cache=use_cache,
+                cache=cache,
+            )
+        else:
+            video_path = _downloadSchoo(
+                url,
+                overwrite=overwrite,
+                cleanup=cleanup,
+                downloader=downloader,
+                use_cache=use_cache,
+                cache=cache,
+            )
+            wav_path = _ripAudio(
+                video_path, overwrite=overwrite, cleanup=cleanup, cache=cache
+            )
+        if draft_model is not None and draft.is_needed(wav_path, overwrite):
+            transcription_path = _draftThenTranscribe(
+                wav_path,
+                course_title,
+                draft_model,
+                overwrite=overwrite,
+                cleanup=cleanup,
+                processes=processes,
+                cache=cache,
+            )
+        else:
+            transcription_path = _transcribeAudio(
+                wav_path,
+                overwrite=overwrite,
+                cleanup=cleanup,
+                processes=processes,
+                cache=cache,
+            )
     summarize_path = _summarize(
-        transcription_path, course_title, overwrite=overwrite, cleanup=cleanup
+        transcription_path,
+        course_title,
+        overwrite=overwrite,
+        cleanup=cleanup,
+        cache=cache,
     )
+    model_size = transscribe.get_model(transcription_path) or transscribe.get_settings()["model_size"]
+    draft.write_tag(transcription_path, model_size, draft=False)
+    draft.write_tag(summarize_path, model_size, draft=False)
+    if not cleanup:
+        storage.archive(transcription_path, wav_path)
+    if cache is not None:
+        log(f"Artifact cache: {json.dumps(cache.stats())}")
+        log(f"Response cache: {json.dumps(llm_cache.get_cache().stats())}")
     with open(summarize_path, "r", encoding=utils.ENCODING) as f:
         summary = f.read()
         print(summary)
         return summary
 
 
-def _downloadSchoo(url: str, overwrite: bool = False, cleanup: bool = False) -> str:
+def _downloadSchoo(
+    url: str,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    downloader: str = download_schoo.DOWNLOADER,
+    use_cache: bool = True,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
+) -> str:
     """Downloads an entire schoo video from a schoo [url] or class id and returns the path of the file on disk"""
     video_id = download_schoo.parse_url(url)
-    m3u8 = download_schoo.get_m3u8_link(video_id)
-    video_path = download_schoo.get_video(m3u8, f"{video_id}.mp4", overwrite=overwrite)
-    return video_path
+    filename = f"{video_id}.mp4"
+
+    def produce(overwrite_output: bool) -> str:
+        m3u8 = download_schoo.get_m3u8_link(video_id, use_cache=use_cache)
+        return download_schoo.get_video(
+            m3u8, filename, overwrite=overwrite_output, downloader=downloader
+        )
+
+    return artifact_cache.run(
+        cache,
+        "video",
+        download_schoo.get_output_path(filename),
+        produce,
+        params={"class_id": video_id},
+        overwrite=overwrite,
+        trust_existing=True,
+    )
+
+
+def _downloadAudio(
+    url: str,
+    overwrite: bool = False,
+    downloader: str = download_schoo.DOWNLOADER,
+    use_cache: bool = True,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
+) -> str:
+    """Downloads only the audio of a schoo [url] or class id into a 16khz mono wav file and returns its path"""
+    video_id = download_schoo.parse_url(url)
+    filename = f"{video_id}.{storage.audio_extension()}"
+
+    def produce(overwrite_output: bool) -> str:
+        m3u8 = download_schoo.get_m3u8_link(video_id, use_cache=use_cache)
+        return download_schoo.get_audio(
+            m3u8, filename, overwrite=overwrite_output, downloader=downloader
+        )
+
+    return artifact_cache.run(
+        cache,
+        "audio",
+        download_schoo.get_output_path(filename),
+        produce,
+        params={"class_id": video_id, **rip_audio.artifact_params()},
+        overwrite=overwrite,
+        trust_existing=True,
+    )
+
+
+def _streamTranscribe(
+    url: str,
+    overwrite: bool = False,
+    use_cache: bool = True,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
+) -> str:
+    """Streams the audio of a schoo [url] or class id straight into Whisper, without writing audio to disk
+    Returns the path of the transcribed text file
+    """
+    video_id = download_schoo.parse_url(url)
+    audio_name = f"{video_id}.wav"
+    transcription_path = transscribe.get_transcript_path(audio_name)
 
+    def produce(overwrite_output: bool) -> str:
+        if not overwrite_output and transscribe.is_complete_with(
+            transcription_path, transscribe.artifact_params()
+        ):
+            log(
+                f"Transcription file already existed at {transcription_path}, and overwrite is set to false. Skipping download and transcribe steps"
+            )
+            return transcription_path
+        m3u8 = download_schoo.get_m3u8_link(video_id, use_cache=use_cache)
+        samples = download_schoo.stream_audio(m3u8)
+        return transscribe.transcribe(
+            audio_name, overwrite=overwrite_output, audio=samples
+        )
 
-def _ripAudio(video_path: str, overwrite: bool = False, cleanup: bool = False) -> str:
+    transcription_path = artifact_cache.run(
+        cache,
+        "transcript",
+        transcription_path,
+        produce,
+        params={
+            "class_id": video_id,
+            "audio": rip_audio.artifact_params(),
+            **transscribe.artifact_params(),
+        },
+        overwrite=overwrite,
+        trust_existing=True,
+        valid=lambda path: transscribe.is_complete_with(path, transscribe.artifact_params()),
+    )
+    transscribe.mark_complete(transcription_path)
+    return transcription_path
+
+
+def _ripAudio(
+    video_path: str,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
+) -> str:
     """Rips the audio of a file at the [video_path] into a 16khz mono wav file
     returns the path of the downloaded wav file
     """
-    output_name = utils.make_output_filename(video_path, "wav")
-    wav_path = rip_audio.rip(
-        video_path, output_name, overwrite=overwrite, cleanup=cleanup
+    output_name = utils.make_output_filename(video_path, storage.audio_extension())
+    wav_path = artifact_cache.run(
+        cache,
+        "wav",
+        rip_audio.get_output_path(video_path, output_name),
+        lambda overwrite_output: rip_audio.rip(
+            video_path, output_name, overwrite=overwrite_output
+        ),
+        params=rip_audio.artifact_params(),
+        files=[video_path],
+        overwrite=overwrite,
     )
+    _cleanupInput(video_path, cleanup)
     return wav_path
 
 
 def _transcribeAudio(
-    audio_path: str, overwrite: bool = False, cleanup: bool = False
+    audio_path: str,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    processes: int = 1,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
 ) -> str:
     """Transcribes the audio file at the [audio_path] into a text file
     Returns the path of the transcribed text file
     """
-    transcription_path = transscribe.transcribe(
-        audio_path, overwrite=overwrite, cleanup=cleanup
+
+    def produce(overwrite_output: bool) -> str:
+        if processes > 1:
+            return parallel_transcribe.transcribe_parallel(
+                audio_path, processes=processes, overwrite=overwrite_output
+            )
+        return transscribe.transcribe(audio_path, overwrite=overwrite_output)
+
+    params = transscribe.artifact_params(split=processes > 1)
+    transcription_path = artifact_cache.run(
+        cache,
+        "transcript",
+        transscribe.get_transcript_path(audio_path),
+        produce,
+        params=params,
+        files=[audio_path],
+        overwrite=overwrite,
+        # a transcript checks its own checkpoint, so a partial one made with the same settings is resumed
+        trust_existing=True,
+        valid=lambda path: transscribe.is_complete_with(path, params),
     )
+    transscribe.mark_complete(transcription_path, params=params)
+    _cleanupInput(audio_path, cleanup)
+    if cleanup:
+        rip_audio.remove_samples(audio_path)
+    return transcription_path
+
+
+def _draftThenTranscribe(
+    audio_path: str,
+    course_title: str,
+    draft_model: str,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    processes: int = 1,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
+) -> str:
+    """Transcribes the audio at [audio_path] with the small [draft_model], then summarizes that draft while the full model
+    transcribes the same audio in the background. The draft summary is printed, and published in place of the full summary
+    until that is written
+    Returns the path of the full transcript
+    """
+    draft_path = draft.get_draft_transcript_path(audio_path, draft_model)
+    draft_params = transscribe.artifact_params(model_size=draft_model, beam_size=draft.DRAFT_BEAM_SIZE)
+    with metrics.span("draft", model=draft_model):
+        draft_path = artifact_cache.run(
+            cache,
+            "transcript",
+            draft_path,
+            lambda overwrite_output: transscribe.transcribe(
+                audio_path,
+                model_size=draft_model,
+                beam_size=draft.DRAFT_BEAM_SIZE,
+                overwrite=overwrite_output,
+                transcript_path=draft_path,
+            ),
+            params=draft_params,
+            files=[audio_path],
+            overwrite=overwrite,
+            trust_existing=True,
+            valid=lambda path: transscribe.is_complete_with(path, draft_params),
+        )
+        transscribe.mark_complete(draft_path, params=draft_params)
+        draft.write_tag(draft_path, draft_model, draft=True)
+
+    # the draft is summarized over the network while the full model has the CPU
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="full-transcribe") as pool:
+        full = pool.submit(
+            _transcribeAudio,
+            audio_path,
+            overwrite=overwrite,
+            cleanup=cleanup,
+            processes=processes,
+            cache=cache,
+        )
+        with metrics.span("draft", model=draft_model):
+            draft_summary_path = _summarize(
+                draft_path, course_title, overwrite=overwrite, cleanup=cleanup, cache=cache
+            )
+        draft.write_tag(draft_summary_path, draft_model, draft=True)
+        draft.publish(
+            draft_summary_path,
+            summarize.get_summary_path(transscribe.get_transcript_path(audio_path)),
+            draft_model,
+        )
+        log(f"Draft summary from the {draft_model} model, to be replaced once the full transcript is summarized:")
+        with open(draft_summary_path, "r", encoding=utils.ENCODING) as f:
+            print(f.read())
+        transcription_path = full.result()
+
+    if cleanup:
+        shutil.rmtree(utils.get_output_directory_path(draft_path), ignore_errors=True)
+    else:
+        storage.archive(draft_path)
     return transcription_path
 
 
@@ -74,16 +357,38 @@ def _summarize(
     course_title: str,
     overwrite: bool = False,
     cleanup: bool = False,
+    cache: Optional[artifact_cache.ArtifactCache] = None,
 ) -> str:
     """Takes the transcription at [transcription_path] and summarizes it
     Returns the path of summary text file
     """
-    summary_path = summarize.summarizer_file(
-        transcription_path, course_title, overwrite=overwrite, cleanup=cleanup
+    summary_path = summarize.get_summary_path(transcription_path)
+    summary_path = artifact_cache.run(
+        cache,
+        "summary",
+        summary_path,
+        lambda overwrite_output: summarize.summarizer_file(
+            transcription_path,
+            course_title,
+            # a published draft is always replaced
+            overwrite=overwrite_output or draft.is_draft(summary_path),
+            cleanup=cleanup,
+        ),
+        params=summarize.artifact_params(course_title),
+        files=[transcription_path],
+        overwrite=overwrite,
     )
     return summary_path
 
 
+def _cleanupInput(path: str, cleanup: bool) -> None:
+    """Deletes the input of a finished stage if [cleanup] is set. Done here rather than by the stage,
+    since a stage restored from the artifact cache never runs"""
+    if cleanup and os.path.exists(path):
+        log(f"Cleanup set to true, deleting {path}")
+        os.unlink(path)
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
         prog=PROG,
@@ -104,9 +409,90 @@ def main() -> int:
         help="if set, will delete all intermediary data generated, keeping only the final summary.txt",
     )
 
+    parser.add_argument(
+        "-a",
+        "--audio-only",
+        action="store_true",
+        help="if set, downloads only the audio straight into a 16khz mono wav file. No video is written to disk",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help="if set, streams the audio straight into Whisper. Neither video nor audio is written to disk",
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="if set, first prints a draft summary from a small Whisper model, while the full model transcribes in the background. The full summary replaces the draft once done",
+    )
+    parser.add_argument(
+        "--draft-model",
+        default=draft.DRAFT_MODEL_SIZE,
+        help=f"Whisper model of the draft, e.g. {', '.join(draft.DRAFT_MODELS)}",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--downloader",
+        choices=download_schoo.DOWNLOADERS,
+        default=download_schoo.DOWNLOADER,
+        help="'ffmpeg' lets ffmpeg fetch the playlist. 'segments' fetches the segments in parallel, and resumes interrupted downloads",
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="if set, fetches the course pages again instead of using the title, m3u8 url and pages cached by previous runs, and ignores the artifact cache of stage outputs and the cache of OpenAI responses",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        help="if above 1, splits the audio at silences and transcribes the pieces on this many processes",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=storage.MODES,
+        default=storage.MODE,
+        help=f"compressed keeps audio as {storage.AUDIO_FORMAT}, and compresses the transcript, chunks and intermediate summaries once the summary is written",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="json lines file every timed span, request latency and the run's totals are appended to",
+    )
+    parser.add_argument(
+        "--prometheus",
+        help="Prometheus textfile the run's counters and stage times are written to, e.g. for node_exporter's textfile collector",
+    )
+    parser.add_argument(
+        "--profile",
+        help="directory a CPU profile and peak memory report of every stage are written to",
+    )
+
     args = parser.parse_args()
 
-    _pipeline(args.url, overwrite=args.overwrite, cleanup=args.cleanup)
+    if args.draft and args.stream:
+        parser.error("--draft transcribes the audio twice, so it needs the audio on disk and cannot be combined with --stream")
+    metrics.configure(jsonl_path=args.metrics, profile_dir=args.profile)
+    storage.MODE = args.storage
+    try:
+        with metrics.span("pipeline"):
+            _pipeline(
+                args.url,
+                overwrite=args.overwrite,
+                cleanup=args.cleanup,
+                audio_only=args.audio_only,
+                stream=args.stream,
+                downloader=args.downloader,
+                use_cache=not args.no_cache,
+                processes=args.processes,
+                draft_model=args.draft_model if args.draft else None,
+            )
+    finally:
+        metrics.finish(args.prometheus)
     return 0
 
 
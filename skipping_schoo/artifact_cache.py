@@ -0,0 +1,380 @@
+# /usr/bin/python3
+""" This file is responsible for caching the output of every pipeline stage under a hash of the stage's inputs and parameters"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional
+
+from skipping_schoo import metrics
+from skipping_schoo import storage
+from skipping_schoo import utils
+
+PROG = "ArtifactCache"
+
+# Lets several workers, or several machines with a shared mount, use one artifact store,
+# while pages and metadata stay in the local cache directory
+ARTIFACT_DIR_ENV = "SKIPPING_SCHOO_ARTIFACT_DIR"
+INDEX_NAME = "index.sqlite3"
+OBJECTS_DIR = "objects"
+MAX_BYTES = 20 * 1024**3
+HASH_CHUNK_BYTES = 1 << 20
+# Videos and audio are large, and would soon push the small but slow to make transcripts and summaries out of the store.
+# Their outputs are only recorded in a sidecar, so an existing file made from the same inputs is kept
+UNSTORED_STAGES = ("video", "audio", "wav")
+# Next to every output the cache restored or recorded, holding the key it was made under
+SIDECAR_SUFFIX = ".artifact.json"
+
+# Bump when the format of any stage output changes, so that older artifacts are never reused
+CACHE_VERSION = 1
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS artifacts (
+        key TEXT PRIMARY KEY,
+        stage TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS artifacts_accessed ON artifacts (accessed)",
+    """CREATE TABLE IF NOT EXISTS stats (
+        stage TEXT PRIMARY KEY,
+        hits INTEGER NOT NULL DEFAULT 0,
+        misses INTEGER NOT NULL DEFAULT 0,
+        evictions INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS file_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT NOT NULL
+    )""",
+]
+
+_cache: Optional["ArtifactCache"] = None
+_cache_lock = threading.Lock()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def get_artifact_dir() -> str:
+    """returns (and creates) the artifact store, read from SKIPPING_SCHOO_ARTIFACT_DIR, defaulting to 'artifacts' in the cache directory"""
+    path = os.getenv(ARTIFACT_DIR_ENV)
+    if not path:
+        return utils.get_cache_dir("artifacts")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class ArtifactCache:
+    """A content addressed store of stage outputs. An artifact is keyed by the stage name, its parameters,
+    and the content of its input files, so changing a model or a prompt always misses while the same work
+    done from another directory, or by another worker sharing [directory], hits.
+
+    Artifacts are copied in and out rather than linked, so that a stage rewriting its output cannot corrupt the store.
+    Once the store holds more than [max_bytes], the least recently used artifacts are evicted. The outputs of UNSTORED_STAGES
+    are never stored. Every output is marked with a sidecar naming its key, so that an output still on disk is kept rather
+    than made again after its artifact was evicted
+    """
+
+    def __init__(
+        self, directory: Optional[str] = None, max_bytes: int = MAX_BYTES
+    ) -> None:
+        self.directory = directory or get_artifact_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.directory, OBJECTS_DIR), exist_ok=True)
+        with self._connect() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(os.path.join(self.directory, INDEX_NAME), timeout=30)
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.directory, OBJECTS_DIR, key[:2], key)
+
+    def hash_file(self, path: str) -> str:
+        """returns the sha256 of the content of [path]. Digests are remembered by size and mtime, so an unchanged file is only read once
+        A text file kept compressed is hashed by its text, so its key is the same either way, see storage.find
+        """
+        path = os.path.abspath(path)
+        st = os.stat(storage.find(path) or path)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT digest FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        h = hashlib.sha256()
+        with storage.open_bytes(path) as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, digest),
+            )
+        return digest
+
+    def key(
+        self, stage: str, params: Optional[dict[str, Any]] = None, files: Iterable[str] = ()
+    ) -> str:
+        """returns the key of the output of [stage] run with [params] over the input [files]"""
+        description = {
+            "version": CACHE_VERSION,
+            "stage": stage,
+            "params": params or {},
+            "files": [self.hash_file(f) for f in files],
+        }
+        encoded = json.dumps(description, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(encoded.encode(utils.ENCODING)).hexdigest()
+
+    def _count(self, conn: sqlite3.Connection, stage: str, column: str, n: int = 1) -> None:
+        conn.execute("INSERT OR IGNORE INTO stats (stage) VALUES (?)", (stage,))
+        conn.execute(
+            f"UPDATE stats SET {column} = {column} + ? WHERE stage = ?", (n, stage)
+        )
+
+    def get(self, stage: str, key: str, output_path: str) -> bool:
+        """Copies the artifact stored under [key] to [output_path]
+        returns whether there was one
+        """
+        object_path = self._object_path(key)
+        with self._connect() as conn:
+            found = conn.execute(
+                "SELECT 1 FROM artifacts WHERE key = ?", (key,)
+            ).fetchone() is not None and os.path.exists(object_path)
+            if found:
+                conn.execute(
+                    "UPDATE artifacts SET accessed = ? WHERE key = ?", (time.time(), key)
+                )
+            self._count(conn, stage, "hits" if found else "misses")
+        metrics.count("artifact_cache_hits" if found else "artifact_cache_misses", stage=stage)
+        if not found:
+            return False
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        _copy_atomic(object_path, output_path)
+        _write_sidecar(output_path, stage, key)
+        return True
+
+    def put(self, stage: str, key: str, path: str) -> None:
+        """Stores a copy of the file at [path] under [key], then evicts down to the size cap.
+        The outputs of UNSTORED_STAGES, and text kept compressed by storage.archive, are only marked with their key
+        """
+        _write_sidecar(path, stage, key)
+        if stage in UNSTORED_STAGES or not os.path.exists(path):
+            return
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            log(f"{path} is larger than the whole cache, not storing it")
+            return
+        object_path = self._object_path(key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        _copy_atomic(path, object_path)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO artifacts (key, stage, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, stage, size, now, now),
+            )
+        self.evict(keep=key)
+
+    def evict(self, max_bytes: Optional[int] = None, keep: Optional[str] = None) -> int:
+        """Deletes the least recently used artifacts until the store holds at most [max_bytes]
+        returns the number of bytes freed
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        freed = 0
+        with self._connect() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+            if total <= limit:
+                return 0
+            rows = conn.execute(
+                "SELECT key, stage, size FROM artifacts ORDER BY accessed ASC"
+            ).fetchall()
+            for key, stage, size in rows:
+                if total - freed <= limit:
+                    break
+                if key == keep:
+                    continue
+                try:
+                    os.unlink(self._object_path(key))
+                except FileNotFoundError:
+                    pass
+                conn.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                self._count(conn, stage, "evictions")
+                freed += size
+        if freed > 0:
+            log(f"Evicted {freed} bytes of least recently used artifacts")
+        return freed
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """returns the hits, misses and evictions of every stage, along with the number and bytes of its stored artifacts"""
+        results: dict[str, dict[str, int]] = {}
+        with self._connect() as conn:
+            for stage, hits, misses, evictions in conn.execute(
+                "SELECT stage, hits, misses, evictions FROM stats"
+            ):
+                results[stage] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "evictions": evictions,
+                    "artifacts": 0,
+                    "bytes": 0,
+                }
+            for stage, count, size in conn.execute(
+                "SELECT stage, COUNT(*), SUM(size) FROM artifacts GROUP BY stage"
+            ):
+                entry = results.setdefault(
+                    stage, {"hits": 0, "misses": 0, "evictions": 0}
+                )
+                entry["artifacts"] = count
+                entry["bytes"] = size
+        return results
+
+    def clear(self) -> None:
+        """Deletes every artifact and resets the statistics"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifacts")
+            conn.execute("DELETE FROM stats")
+        shutil.rmtree(os.path.join(self.directory, OBJECTS_DIR), ignore_errors=True)
+        os.makedirs(os.path.join(self.directory, OBJECTS_DIR), exist_ok=True)
+
+    def run(
+        self,
+        stage: str,
+        output_path: str,
+        produce: Callable[[bool], str],
+        params: Optional[dict[str, Any]] = None,
+        files: Iterable[str] = (),
+        overwrite: bool = False,
+        trust_existing: bool = False,
+        valid: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        """Returns [output_path] filled from the cache, or calls [produce] with an overwrite flag and stores what it wrote
+
+        On a miss, an output already at [output_path] is kept and stored if its sidecar names the same key,
+        or if [valid] says it was made with the same parameters, e.g. from a checkpoint. Otherwise [produce] is asked
+        to overwrite, since an existing output may have been made with other parameters.
+        [trust_existing] is for stages whose output is fully determined by its file name, such as downloads,
+        or that check an existing output themselves, which then only overwrite if [overwrite] was asked for
+        """
+        key = self.key(stage, params, files)
+        if not overwrite and self.get(stage, key, output_path):
+            log(f"Cache hit for {stage}, restored {output_path}")
+            return output_path
+        if not overwrite and storage.exists(output_path):
+            if _read_sidecar(output_path) == key or (valid is not None and valid(output_path)):
+                log(f"Cache miss for {stage}, keeping {output_path}, which was made from the same inputs")
+                self.put(stage, key, output_path)
+                return output_path
+        log(f"Cache miss for {stage}")
+        forget(output_path)
+        path = produce(overwrite or not trust_existing)
+        if storage.exists(path):
+            self.put(stage, key, path)
+        return path
+
+
+def _sidecar_path(path: str) -> str:
+    return f"{path}{SIDECAR_SUFFIX}"
+
+
+def _write_sidecar(path: str, stage: str, key: str) -> None:
+    utils.write_text_atomic(_sidecar_path(path), json.dumps({"stage": stage, "key": key}))
+
+
+def _read_sidecar(path: str) -> Optional[str]:
+    try:
+        with open(_sidecar_path(path), "r", encoding=utils.ENCODING) as f:
+            return json.load(f)["key"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def forget(path: str) -> None:
+    """Drops the record of which key the output at [path] was made under, before it is rewritten by anything but the cache"""
+    if os.path.exists(_sidecar_path(path)):
+        os.unlink(_sidecar_path(path))
+
+
+def _copy_atomic(src: str, dst: str) -> None:
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def get_cache() -> ArtifactCache:
+    """returns the artifact cache shared by the whole process"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ArtifactCache()
+        return _cache
+
+
+def run(
+    cache: Optional[ArtifactCache],
+    stage: str,
+    output_path: str,
+    produce: Callable[[bool], str],
+    params: Optional[dict[str, Any]] = None,
+    files: Iterable[str] = (),
+    overwrite: bool = False,
+    trust_existing: bool = False,
+    valid: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """ArtifactCache.run, or just [produce] with [overwrite] when there is no [cache]"""
+    if cache is None:
+        return produce(overwrite)
+    return cache.run(
+        stage,
+        output_path,
+        produce,
+        params=params,
+        files=files,
+        overwrite=overwrite,
+        trust_existing=trust_existing,
+        valid=valid,
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Inspects and trims the cache of stage outputs shared between runs",
+    )
+    parser.add_argument(
+        "--dir",
+        help=f"artifact directory. Defaults to ${ARTIFACT_DIR_ENV}, or 'artifacts' in the cache directory",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="print the hits, misses and size of every stage")
+    evict = subparsers.add_parser("evict", help="evict down to a size")
+    evict.add_argument("max_mb", type=float)
+    subparsers.add_parser("clear", help="delete every artifact")
+
+    args = parser.parse_args()
+
+    cache = ArtifactCache(args.dir)
+    if args.command == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+    elif args.command == "evict":
+        freed = cache.evict(max_bytes=int(args.max_mb * 1024 * 1024))
+        print(f"freed {freed} bytes")
+    else:
+        cache.clear()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
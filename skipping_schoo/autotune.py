@@ -0,0 +1,265 @@
+# /usr/bin/python3
+""" This file is responsible for finding the fastest Whisper settings on this host that still transcribe as well as the slow defaults"""
+import argparse
+import datetime
+import difflib
+import itertools
+import json
+import os
+import platform
+import re
+import sys
+import threading
+import time
+from typing import Any, Optional
+
+from skipping_schoo import utils
+from skipping_schoo.errors import SkippingSchooError
+
+PROG = "Autotune"
+
+# Read by transscribe, unless it points somewhere else through SKIPPING_SCHOO_WHISPER_CALIBRATION
+CALIBRATION_ENV = "SKIPPING_SCHOO_WHISPER_CALIBRATION"
+CALIBRATION_NAME = "whisper_calibration.json"
+
+CLIP_SECS = 120
+# the share of the reference transcript's characters a faster setting must reproduce to be chosen
+AGREEMENT = 0.95
+COMPUTE_TYPES = ["int8", "int8_float32", "float32"]
+BEAM_SIZES = [1, 5]
+VAD_FILTERS = [False, True]
+NUM_WORKERS = [1]
+# the reference transcript is made with the most careful settings
+REFERENCE = {"compute_type": "float32", "beam_size": 5, "vad_filter": False}
+
+_IGNORED_REGEX = re.compile(r"[\s、。,.!?！？「」]")
+
+_cached: Optional[tuple[str, float, Optional[dict]]] = None
+_cached_lock = threading.Lock()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def get_calibration_path() -> str:
+    path = os.getenv(CALIBRATION_ENV)
+    if path:
+        return path
+    return os.path.join(utils.get_cache_dir(), CALIBRATION_NAME)
+
+
+def default_threads(cores: Optional[int] = None) -> list[int]:
+    """The thread counts worth trying: all the cores, then halving down to 4"""
+    cores = cores or os.cpu_count() or 1
+    threads = [cores]
+    while threads[-1] // 2 >= 4:
+        threads.append(threads[-1] // 2)
+    return threads
+
+
+def agreement(reference: str, text: str) -> float:
+    """returns how closely [text] matches [reference], from 0 to 1, by character. Whitespace and punctuation are ignored,
+    since Japanese transcripts differ mostly in where they put them"""
+    a = _IGNORED_REGEX.sub("", reference)
+    b = _IGNORED_REGEX.sub("", text)
+    if len(a) == 0 and len(b) == 0:
+        return 1.0
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def _run(whisper, audio, language: str, beam_size: int, vad_filter: bool) -> tuple[str, float]:
+    start = time.perf_counter()
+    segments, _ = whisper.transcribe(
+        audio, language=language, beam_size=beam_size, vad_filter=vad_filter
+    )
+    # segments are produced lazily, so the time is only spent while reading them
+    text = "".join(s.text for s in segments)
+    return text, time.perf_counter() - start
+
+
+def calibrate(
+    clip_path: str,
+    clip_secs: float = CLIP_SECS,
+    start_secs: float = 0.0,
+    model_sizes: Optional[list[str]] = None,
+    compute_types: list[str] = COMPUTE_TYPES,
+    threads: Optional[list[int]] = None,
+    num_workers: list[int] = NUM_WORKERS,
+    beam_sizes: list[int] = BEAM_SIZES,
+    vad_filters: list[bool] = VAD_FILTERS,
+    min_agreement: float = AGREEMENT,
+    reference_text: Optional[str] = None,
+) -> dict[str, Any]:
+    """Transcribes [clip_secs] of [clip_path] under every combination of the given settings, and measures each one's
+    real-time factor and agreement with a reference transcript. Unless [reference_text] is given, the reference is
+    transcribed from the same clip with the default model and the REFERENCE settings
+
+    A model is loaded once for every model size, compute type, thread and worker count; beam size and the VAD filter are tried on each
+    returns the fastest settings agreeing at least [min_agreement] with the reference, along with every measurement
+    """
+    from skipping_schoo import rip_audio
+    from skipping_schoo import transscribe
+
+    model_sizes = model_sizes or [transscribe.MODEL_SIZE]
+    threads = threads or default_threads()
+    audio = rip_audio.decode_samples(clip_path, start=start_secs, duration=clip_secs)
+    audio_secs = len(audio) / rip_audio.SAMPLE_RATE
+    if audio_secs <= 0:
+        raise SkippingSchooError(f"No audio to calibrate with in {clip_path}")
+    language = transscribe.LANGUAGE
+
+    if reference_text is None:
+        log(f"Transcribing the reference with {REFERENCE}")
+        whisper = transscribe.load_model(
+            transscribe.MODEL_SIZE,
+            device=transscribe.DEVICE,
+            compute_type=REFERENCE["compute_type"],
+            cpu_threads=max(threads),
+            num_workers=1,
+        )
+        reference_text, _ = _run(
+            whisper, audio, language, REFERENCE["beam_size"], REFERENCE["vad_filter"]
+        )
+        del whisper
+
+    runs: list[dict[str, Any]] = []
+    for model_size, compute_type, cpu_threads, workers in itertools.product(
+        model_sizes, compute_types, threads, num_workers
+    ):
+        try:
+            whisper = transscribe.load_model(
+                model_size,
+                device=transscribe.DEVICE,
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,
+                num_workers=workers,
+            )
+        except ValueError as e:
+            # e.g. a compute type this CPU does not support
+            log(f"Skipping {model_size} {compute_type}: {e}")
+            continue
+        for beam_size, vad_filter in itertools.product(beam_sizes, vad_filters):
+            settings = {
+                "model_size": model_size,
+                "device": transscribe.DEVICE,
+                "compute_type": compute_type,
+                "cpu_threads": cpu_threads,
+                "num_workers": workers,
+                "beam_size": beam_size,
+                "vad_filter": vad_filter,
+            }
+            text, secs = _run(whisper, audio, language, beam_size, vad_filter)
+            run = {
+                "settings": settings,
+                "real_time_factor": round(secs / audio_secs, 4),
+                "agreement": round(agreement(reference_text, text), 4),
+            }
+            runs.append(run)
+            log(f"{settings}: real-time factor {run['real_time_factor']}, agreement {run['agreement']}")
+        del whisper
+
+    passing = [r for r in runs if r["agreement"] >= min_agreement]
+    if len(passing) == 0:
+        raise SkippingSchooError(
+            f"No settings agreed with the reference by {min_agreement}, the best was {max((r['agreement'] for r in runs), default=0)}"
+        )
+    best = min(passing, key=lambda r: r["real_time_factor"])
+    return {
+        "settings": best["settings"],
+        "real_time_factor": best["real_time_factor"],
+        "agreement": best["agreement"],
+        "min_agreement": min_agreement,
+        "clip": os.path.abspath(clip_path),
+        "clip_secs": round(audio_secs, 2),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "calibrated": datetime.datetime.now().isoformat(timespec="seconds"),
+        "runs": runs,
+    }
+
+
+def save_calibration(calibration: dict[str, Any], path: Optional[str] = None) -> str:
+    path = path or get_calibration_path()
+    utils.write_text_atomic(path, json.dumps(calibration, indent=2, ensure_ascii=False))
+    return path
+
+
+def load_calibration(path: Optional[str] = None) -> Optional[dict[str, Any]]:
+    """returns the settings calibrated on this host, or None if there are none.
+    A calibration made on a machine with another number of cores is ignored, since its thread counts would be wrong.
+    The file is only read again once it changes
+    """
+    global _cached
+    path = path or get_calibration_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _cached_lock:
+        if _cached is not None and _cached[0] == path and _cached[1] == mtime:
+            return _cached[2]
+        with open(path, "r", encoding=utils.ENCODING) as f:
+            calibration = json.load(f)
+        settings = calibration.get("settings")
+        if calibration.get("cpus") != os.cpu_count():
+            log(
+                f"Ignoring the Whisper calibration at {path}, made on a host with {calibration.get('cpus')} cores rather than {os.cpu_count()}"
+            )
+            settings = None
+        _cached = (path, mtime, settings)
+        return settings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Finds the fastest Whisper settings for this host that still agree with a careful reference transcript, and saves them for transscribe to use",
+    )
+    parser.add_argument("clip", help="audio or video file of typical speech to calibrate with")
+    parser.add_argument("--secs", type=float, default=CLIP_SECS, help="seconds of the clip to transcribe")
+    parser.add_argument("--start", type=float, default=0.0, help="where in the clip to start, in seconds")
+    parser.add_argument("--reference", help="text file of a trusted transcript of the same seconds of the clip")
+    parser.add_argument("--models", nargs="+", help="model sizes to try. Defaults to the one transscribe uses")
+    parser.add_argument("--compute-types", nargs="+", default=COMPUTE_TYPES)
+    parser.add_argument("--threads", nargs="+", type=int, help="cpu thread counts to try. Defaults to every core, halved down to 4")
+    parser.add_argument("--workers", nargs="+", type=int, default=NUM_WORKERS)
+    parser.add_argument("--beam-sizes", nargs="+", type=int, default=BEAM_SIZES)
+    parser.add_argument(
+        "--vad",
+        nargs="+",
+        choices=["on", "off"],
+        default=["off", "on"],
+        help="whether to try with and without the silence filter",
+    )
+    parser.add_argument("--agreement", type=float, default=AGREEMENT, help="lowest agreement with the reference to accept, from 0 to 1")
+    parser.add_argument("--output", help=f"where to save the calibration. Defaults to ${CALIBRATION_ENV}, or the cache directory")
+
+    args = parser.parse_args()
+
+    reference_text = None
+    if args.reference:
+        with open(args.reference, "r", encoding=utils.ENCODING) as f:
+            reference_text = f.read()
+    calibration = calibrate(
+        args.clip,
+        clip_secs=args.secs,
+        start_secs=args.start,
+        model_sizes=args.models,
+        compute_types=args.compute_types,
+        threads=args.threads,
+        num_workers=args.workers,
+        beam_sizes=args.beam_sizes,
+        vad_filters=[v == "on" for v in args.vad],
+        min_agreement=args.agreement,
+        reference_text=reference_text,
+    )
+    path = save_calibration(calibration, args.output)
+    log(
+        f"Fastest settings agreeing with the reference: {calibration['settings']}, real-time factor {calibration['real_time_factor']}. Saved to {path}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,338 @@
+# /usr/bin/python3
+""" This file is responsible for sending chat completion requests to a model, hosted or local, and streaming back the response"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from skipping_schoo import http_client
+from skipping_schoo import utils
+from skipping_schoo.errors import RateLimitError, RetryableError, SkippingSchooError
+
+PROG = "Backends"
+
+HOSTED_URL = "https://api.openai.com/v1"
+# llama.cpp, vLLM, Ollama and others serve this API. Read from SKIPPING_SCHOO_LLM_URL
+LOCAL_URL_ENV = "SKIPPING_SCHOO_LLM_URL"
+LOCAL_URL = "http://127.0.0.1:8080/v1"
+LOCAL_KEY_ENV = "SKIPPING_SCHOO_LLM_KEY"
+# a completion can take a while to finish, but the first token should not
+TIMEOUT = (10, 300)
+
+STUB_HOST = "127.0.0.1"
+STUB_PORT = 8766
+STUB_WORDS = 80
+# what the stub server answers the requests it refuses with, like the hosted API when the request budget is spent
+STUB_RATE_LIMIT_HEADERS = {
+    "x-ratelimit-limit-requests": "60",
+    "x-ratelimit-remaining-requests": "0",
+    "x-ratelimit-reset-requests": "10ms",
+}
+
+BACKENDS = ["openai", "local", "stub"]
+BACKEND = "openai"
+
+_stub_server: Optional["StubServer"] = None
+_stub_lock = threading.Lock()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class Completion:
+    def __init__(self, text: str, headers, first_token_secs: Optional[float], total_secs: float) -> None:
+        self.text = text
+        self.headers = headers
+        self.first_token_secs = first_token_secs
+        self.total_secs = total_secs
+
+
+class OpenAICompatibleBackend:
+    """Sends chat completions to any server speaking the OpenAI API at [base_url].
+    Requests share one pooled session, so connections are kept alive between chunks, and responses are streamed:
+    [complete] hands every piece of text to [on_text] as soon as it arrives.
+    [rate_limited] backends have account budgets that requests must be paced to, see ratelimit.RateLimiter
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: Optional[str] = None,
+        name: Optional[str] = None,
+        rate_limited: bool = False,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.name = name or f"local:{self.base_url}"
+        self.rate_limited = rate_limited
+        self._session = http_client.make_session()
+
+    def complete(
+        self,
+        request: dict[str, Any],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Completion:
+        """Sends [request], the keyword arguments of a chat completion, and returns the whole response once it is done
+        Raises RateLimitError or RetryableError for failures worth retrying, and SkippingSchooError for the rest
+        """
+        import requests
+
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        started = time.monotonic()
+        try:
+            r = self._session.post(
+                f"{self.base_url}/chat/completions",
+                json={**request, "stream": True},
+                headers=headers,
+                stream=True,
+                timeout=TIMEOUT,
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(f"Could not reach {self.base_url}: {e}") from e
+        with r:
+            _raise_for_status(r)
+            if not r.headers.get("Content-Type", "").startswith("text/event-stream"):
+                # the server ignored "stream", and sent the whole response at once
+                text = r.json()["choices"][0]["message"]["content"]
+                if on_text is not None:
+                    on_text(text)
+                elapsed = time.monotonic() - started
+                return Completion(text, r.headers, elapsed, elapsed)
+            pieces: list[str] = []
+            first_token_secs = None
+            try:
+                for delta in _iter_deltas(r):
+                    if first_token_secs is None:
+                        first_token_secs = time.monotonic() - started
+                    pieces.append(delta)
+                    if on_text is not None:
+                        on_text(delta)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise RetryableError(f"Stream from {self.base_url} broke off: {e}") from e
+            return Completion(
+                "".join(pieces), r.headers, first_token_secs, time.monotonic() - started
+            )
+
+
+def _raise_for_status(r) -> None:
+    if r.status_code == 200:
+        return
+    body = r.text[:500]
+    if r.status_code == 429:
+        raise RateLimitError(f"Rate limited: {body}", headers=r.headers)
+    if r.status_code >= 500 or r.status_code == 408:
+        raise RetryableError(f"Server error {r.status_code}: {body}", headers=r.headers)
+    raise SkippingSchooError(f"Completion request failed with {r.status_code}: {body}")
+
+
+def _iter_deltas(r):
+    """yields the text of every server-sent event of a streamed chat completion"""
+    for raw in r.iter_lines():
+        if not raw.startswith(b"data:"):
+            continue
+        data = raw[len(b"data:") :].strip()
+        if data == b"[DONE]":
+            return
+        event = json.loads(data.decode(utils.ENCODING))
+        if "error" in event:
+            raise RetryableError(f"Error in stream: {event['error']}")
+        for choice in event.get("choices", []):
+            content = choice.get("delta", {}).get("content")
+            if content:
+                yield content
+
+
+def _stub_text(request: dict[str, Any]) -> str:
+    """The response of the stub server: a short digest of the request, followed by the first words of the last message,
+    so it is the same every time for the same request and differs between requests"""
+    digest = hashlib.sha256(
+        json.dumps(request["messages"], sort_keys=True, ensure_ascii=False).encode(utils.ENCODING)
+    ).hexdigest()[:12]
+    prompt = request["messages"][-1]["content"]
+    words = prompt.split()[: min(STUB_WORDS, int(request.get("max_tokens") or STUB_WORDS))]
+    return f"[stub {digest}] " + " ".join(words)
+
+
+def _make_stub_http_server(address: tuple[str, int], token_delay: float, rate_limited: int):
+    """Builds the http server behind StubServer. http.server is only imported here, since summaries never need it"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode(utils.ENCODING))
+            with self.server.lock:
+                self.server.requests += 1
+                refused = self.server.requests <= self.server.rate_limited
+            if refused:
+                body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests"}}).encode(utils.ENCODING)
+                self.send_response(429)
+                for name, value in STUB_RATE_LIMIT_HEADERS.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            text = _stub_text(request)
+            if not request.get("stream"):
+                body = json.dumps(
+                    {"choices": [{"index": 0, "message": {"role": "assistant", "content": text}}]},
+                    ensure_ascii=False,
+                ).encode(utils.ENCODING)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            delay = self.server.token_delay
+            for i, word in enumerate(text.split(" ")):
+                if delay > 0:
+                    time.sleep(delay)
+                event = {"choices": [{"index": 0, "delta": {"content": word if i == 0 else f" {word}"}}]}
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _write_chunk(self, text: str) -> None:
+            data = text.encode(utils.ENCODING)
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    class _StubHTTPServer(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address) -> None:
+            # clients drop their pooled keep-alive connections when they exit, which is not worth a traceback
+            if not isinstance(sys.exc_info()[1], ConnectionError):
+                super().handle_error(request, client_address)
+
+    server = _StubHTTPServer(address, _StubHandler)
+    server.token_delay = token_delay
+    server.rate_limited = rate_limited
+    server.lock = threading.Lock()
+    server.requests = 0
+    return server
+
+
+class StubServer:
+    """A local server answering chat completions deterministically, streamed one word every [token_delay] seconds.
+    The first [rate_limited] requests are refused with a 429 and STUB_RATE_LIMIT_HEADERS, to exercise retries.
+    Summaries can be load tested through it without an API key or a network
+    """
+
+    def __init__(
+        self,
+        host: str = STUB_HOST,
+        port: int = STUB_PORT,
+        token_delay: float = 0.0,
+        rate_limited: int = 0,
+    ) -> None:
+        self._server = _make_stub_http_server((host, port), token_delay, rate_limited)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def requests(self) -> int:
+        """the number of completion requests received, refused ones included"""
+        return self._server.requests
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _get_stub_server() -> StubServer:
+    """returns a stub server running in this process on a free port, starting it on first use"""
+    global _stub_server
+    with _stub_lock:
+        if _stub_server is None:
+            _stub_server = StubServer(port=0).start()
+        return _stub_server
+
+
+def make_backend(name: str = BACKEND, base_url: Optional[str] = None) -> OpenAICompatibleBackend:
+    """Returns the backend [name], one of BACKENDS
+    openai: the hosted API, with the key at OPENAI_API_KEY
+    local: an OpenAI compatible server at [base_url], defaulting to $SKIPPING_SCHOO_LLM_URL
+    stub: the stub server at [base_url], or one started in this process
+    """
+    if name == "openai":
+        key = os.getenv("OPENAI_API_KEY")
+        if key is None or len(key) == 0:
+            raise SkippingSchooError(
+                "No OpenAI API key set at the OPENAI_API_KEY environment variable"
+            )
+        return OpenAICompatibleBackend(
+            base_url or HOSTED_URL, key, name="openai", rate_limited=True
+        )
+    if name == "local":
+        url = base_url or os.getenv(LOCAL_URL_ENV) or LOCAL_URL
+        return OpenAICompatibleBackend(url, os.getenv(LOCAL_KEY_ENV))
+    if name == "stub":
+        return OpenAICompatibleBackend(base_url or _get_stub_server().url, name="stub")
+    raise SkippingSchooError(f"Unknown backend {name}, expected one of {BACKENDS}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Runs the stub completion server, for testing the summarize stage offline",
+    )
+    parser.add_argument("--host", default=STUB_HOST)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument(
+        "--token-delay",
+        type=float,
+        default=0.0,
+        help="seconds between streamed words, to simulate a slow model",
+    )
+    parser.add_argument(
+        "--rate-limited",
+        type=int,
+        default=0,
+        help="number of requests to refuse with a 429 first, to exercise retries",
+    )
+
+    args = parser.parse_args()
+
+    server = StubServer(args.host, args.port, args.token_delay, args.rate_limited)
+    log(f"Serving stub completions at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,427 @@
+# /usr/bin/python3
+""" This file is responsible for running the whole pipeline over many courses at once, overlapping the stages of different courses"""
+import argparse
+import datetime
+import json
+import os
+import queue
+import sys
+import threading
+from typing import Any, Callable, Optional
+
+from skipping_schoo import artifact_cache
+from skipping_schoo import llm_cache
+from skipping_schoo import metrics
+from skipping_schoo import download_schoo
+from skipping_schoo import rip_audio
+from skipping_schoo import storage
+from skipping_schoo import transscribe
+from skipping_schoo import summarize
+from skipping_schoo import utils
+
+PROG = "Batch"
+
+DOWNLOAD_WORKERS = 2
+RIP_WORKERS = 2
+TRANSCRIBE_WORKERS = 1
+SUMMARIZE_WORKERS = 2
+QUEUE_SIZE = 2
+
+_STOP = object()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class Course:
+    """Tracks one course as it moves through the pipeline"""
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.video_id: Optional[str] = None
+        self.title: Optional[str] = None
+        self.video_path: Optional[str] = None
+        self.wav_path: Optional[str] = None
+        self.transcript_path: Optional[str] = None
+        self.summary_path: Optional[str] = None
+        self.stage: str = "queued"
+        self.error: Optional[str] = None
+        self.durations: dict[str, float] = {}
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.stage == "done"
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "source": self.source,
+            "video_id": self.video_id,
+            "title": self.title,
+            "stage": self.stage,
+            "error": self.error,
+            "summary": self.summary_path,
+            "durations": self.durations,
+        }
+
+
+class Stage:
+    """One step of the pipeline, run by its own pool of [workers] threads
+
+    [run] is called with the course and the worker state returned by [init]. [init] is called once per worker thread,
+    so that expensive resources such as Whisper models are loaded once per worker rather than once per course
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[Course, Any], None],
+        workers: int = 1,
+        init: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        self.name = name
+        self.run = run
+        self.workers = max(1, workers)
+        self.init = init
+
+
+def run_pipeline(
+    courses: list[Course], stages: list[Stage], queue_size: int = QUEUE_SIZE
+) -> list[Course]:
+    """Pushes every course through each stage in order. Stages are connected by bounded queues,
+    so that course N+1 is downloading while course N is being transcribed.
+
+    A course that fails at one stage is marked with the error and dropped from the later stages. The rest of the batch continues.
+    """
+    queues: list[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining = [stage.workers for stage in stages]
+    lock = threading.Lock()
+
+    def finish_worker(idx: int) -> None:
+        with lock:
+            remaining[idx] -= 1
+            last = remaining[idx] == 0
+        if last and idx + 1 < len(stages):
+            for _ in range(stages[idx + 1].workers):
+                queues[idx + 1].put(_STOP)
+
+    def work(idx: int) -> None:
+        stage = stages[idx]
+        state = None
+        init_error = None
+        if stage.init is not None:
+            try:
+                state = stage.init()
+            except Exception as e:
+                log(f"Failed to start a {stage.name} worker: {e}")
+                init_error = e
+        while True:
+            course = queues[idx].get()
+            if course is _STOP:
+                break
+            course.stage = stage.name
+            try:
+                if init_error is not None:
+                    raise init_error
+                start = datetime.datetime.now()
+                stage.run(course, state)
+                course.durations[stage.name] = round(
+                    (datetime.datetime.now() - start).total_seconds(), 2
+                )
+            except Exception as e:
+                course.error = f"{type(e).__name__}: {e}"
+                log(f"[{course.source}] failed at {stage.name}: {course.error}")
+                continue
+            if idx + 1 < len(stages):
+                queues[idx + 1].put(course)
+            else:
+                course.stage = "done"
+                log(f"[{course.source}] finished")
+        finish_worker(idx)
+
+    threads = []
+    for idx, stage in enumerate(stages):
+        for i in range(stage.workers):
+            t = threading.Thread(target=work, args=(idx,), name=f"{stage.name}-{i}")
+            t.start()
+            threads.append(t)
+    for course in courses:
+        queues[0].put(course)
+    for _ in range(stages[0].workers):
+        queues[0].put(_STOP)
+    for t in threads:
+        t.join()
+    return courses
+
+
+def make_stages(
+    overwrite: bool = False,
+    cleanup: bool = False,
+    download_workers: int = DOWNLOAD_WORKERS,
+    rip_workers: int = RIP_WORKERS,
+    transcribe_workers: int = TRANSCRIBE_WORKERS,
+    summarize_workers: int = SUMMARIZE_WORKERS,
+    audio_only: bool = False,
+    downloader: str = download_schoo.DOWNLOADER,
+    use_cache: bool = True,
+) -> list[Stage]:
+    """Builds the download -> rip -> transcribe -> summarize stages of the pipeline
+    With [audio_only], the download stage writes the 16khz wav file directly, and there is no rip stage
+    With [use_cache], every stage first looks for its output in the artifact cache shared by all workers
+    """
+    cache = artifact_cache.get_cache() if use_cache else None
+    summarize.USE_RESPONSE_CACHE = use_cache
+
+    def cleanup_input(path: str) -> None:
+        if cleanup and os.path.exists(path):
+            os.unlink(path)
+
+    def download(course: Course, _) -> None:
+        course.video_id = download_schoo.parse_url(course.source)
+        course.title = download_schoo.get_video_title(
+            course.video_id, use_cache=use_cache
+        )
+        filename = f"{course.video_id}.{storage.audio_extension()}" if audio_only else f"{course.video_id}.mp4"
+
+        def produce(overwrite_output: bool) -> str:
+            m3u8 = download_schoo.get_m3u8_link(course.video_id, use_cache=use_cache)
+            fetch = download_schoo.get_audio if audio_only else download_schoo.get_video
+            return fetch(
+                m3u8, filename, overwrite=overwrite_output, downloader=downloader
+            )
+
+        params = {"class_id": course.video_id}
+        if audio_only:
+            params.update(rip_audio.artifact_params())
+        path = artifact_cache.run(
+            cache,
+            "audio" if audio_only else "video",
+            download_schoo.get_output_path(filename),
+            produce,
+            params=params,
+            overwrite=overwrite,
+            trust_existing=True,
+        )
+        if audio_only:
+            course.wav_path = path
+        else:
+            course.video_path = path
+
+    def rip(course: Course, _) -> None:
+        output_name = utils.make_output_filename(course.video_path, storage.audio_extension())
+        course.wav_path = artifact_cache.run(
+            cache,
+            "wav",
+            rip_audio.get_output_path(course.video_path, output_name),
+            lambda overwrite_output: rip_audio.rip(
+                course.video_path, output_name, overwrite=overwrite_output
+            ),
+            params=rip_audio.artifact_params(),
+            files=[course.video_path],
+            overwrite=overwrite,
+        )
+        cleanup_input(course.video_path)
+
+    def transcribe(course: Course, whisper) -> None:
+        course.transcript_path = artifact_cache.run(
+            cache,
+            "transcript",
+            transscribe.get_transcript_path(course.wav_path),
+            lambda overwrite_output: transscribe.transcribe(
+                course.wav_path, overwrite=overwrite_output, whisper=whisper
+            ),
+            params=transscribe.artifact_params(),
+            files=[course.wav_path],
+            overwrite=overwrite,
+            # a transcript checks its own checkpoint, so a partial one made with the same settings is resumed
+            trust_existing=True,
+            valid=lambda path: transscribe.is_complete_with(path, transscribe.artifact_params()),
+        )
+        transscribe.mark_complete(course.transcript_path)
+        cleanup_input(course.wav_path)
+        if cleanup:
+            rip_audio.remove_samples(course.wav_path)
+
+    def load_whisper():
+        return transscribe.load_model(
+            cpu_threads=utils.cpu_threads_per_worker(transcribe_workers)
+        )
+
+    def summarize_course(course: Course, _) -> None:
+        course.summary_path = artifact_cache.run(
+            cache,
+            "summary",
+            summarize.get_summary_path(course.transcript_path),
+            lambda overwrite_output: summarize.summarizer_file(
+                course.transcript_path,
+                course.title,
+                overwrite=overwrite_output,
+                cleanup=cleanup,
+            ),
+            params=summarize.artifact_params(course.title),
+            files=[course.transcript_path],
+            overwrite=overwrite,
+        )
+        if not cleanup:
+            storage.archive(course.transcript_path, course.wav_path)
+
+    stages = [Stage("download", download, workers=download_workers)]
+    if not audio_only:
+        stages.append(Stage("rip", rip, workers=rip_workers))
+    stages.append(
+        Stage("transcribe", transcribe, workers=transcribe_workers, init=load_whisper)
+    )
+    stages.append(Stage("summarize", summarize_course, workers=summarize_workers))
+    return stages
+
+
+def read_sources(sources: list[str], filename: Optional[str] = None) -> list[str]:
+    """Collects class ids or urls from the command line and from a file with one per line.
+    Blank lines and lines starting with '#' are skipped
+    """
+    collected = list(sources)
+    if filename is not None:
+        with open(filename, "r", encoding=utils.ENCODING) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0 or line.startswith("#"):
+                    continue
+                collected.append(line)
+    return collected
+
+
+def format_report(courses: list[Course]) -> str:
+    """Returns a tab separated status line per course"""
+    lines = []
+    for course in courses:
+        if course.ok:
+            status = f"done\t{course.summary_path}"
+        else:
+            status = f"failed at {course.stage}\t{course.error}"
+        lines.append(f"{course.video_id or course.source}\t{status}")
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Downloads, transcribes and summarizes many schoo courses, overlapping the stages of different courses",
+    )
+    parser.add_argument(
+        "urls", nargs="*", help="Schoo URLs or course numbers to summarize"
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        help="file containing one Schoo URL or course number per line",
+    )
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="If set, overwrites every step of the process if any files from a prevous run of the same file existed",
+    )
+    parser.add_argument(
+        "-c",
+        "--cleanup",
+        action="store_true",
+        help="if set, will delete all intermediary data generated, keeping only the final summary.txt",
+    )
+    parser.add_argument(
+        "-a",
+        "--audio-only",
+        action="store_true",
+        help="if set, downloads only the audio straight into a 16khz mono wav file, skipping the video and the rip stage",
+    )
+    parser.add_argument(
+        "-d",
+        "--downloader",
+        choices=download_schoo.DOWNLOADERS,
+        default=download_schoo.DOWNLOADER,
+        help="'ffmpeg' lets ffmpeg fetch the playlist. 'segments' fetches the segments in parallel, and resumes interrupted downloads",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="if set, fetches the course pages again instead of using the title, m3u8 url and pages cached by previous runs, and ignores the artifact cache of stage outputs and the cache of OpenAI responses",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="if set, looks up the titles and m3u8 urls of every course concurrently before the pipeline starts, see crawl.py",
+    )
+    parser.add_argument("--download-workers", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--rip-workers", type=int, default=RIP_WORKERS)
+    parser.add_argument(
+        "--transcribe-workers",
+        type=int,
+        default=TRANSCRIBE_WORKERS,
+        help="each transcribe worker keeps its own Whisper model loaded",
+    )
+    parser.add_argument("--summarize-workers", type=int, default=SUMMARIZE_WORKERS)
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=QUEUE_SIZE,
+        help="maximum number of courses waiting between two stages",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=storage.MODES,
+        default=storage.MODE,
+        help=f"compressed keeps audio as {storage.AUDIO_FORMAT}, and compresses the transcript, chunks and intermediate summaries once the summary is written",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="json lines file every timed span, request latency and the run's totals are appended to",
+    )
+    parser.add_argument(
+        "--prometheus",
+        help="Prometheus textfile the run's counters and stage times are written to, e.g. for node_exporter's textfile collector",
+    )
+    parser.add_argument(
+        "--profile",
+        help="directory a CPU profile and peak memory report of every stage are written to",
+    )
+
+    args = parser.parse_args()
+
+    sources = read_sources(args.urls, args.file)
+    if len(sources) == 0:
+        parser.error("no urls or course numbers given")
+    summarize.configure_backend()
+    storage.MODE = args.storage
+    if args.prefetch and not args.no_cache:
+        from skipping_schoo import crawl
+
+        log(f"Prefetched class metadata: {json.dumps(crawl.prefetch(sources))}")
+
+    courses = [Course(s) for s in sources]
+    stages = make_stages(
+        overwrite=args.overwrite,
+        cleanup=args.cleanup,
+        download_workers=args.download_workers,
+        rip_workers=args.rip_workers,
+        transcribe_workers=args.transcribe_workers,
+        summarize_workers=args.summarize_workers,
+        audio_only=args.audio_only,
+        downloader=args.downloader,
+        use_cache=not args.no_cache,
+    )
+    metrics.configure(jsonl_path=args.metrics, profile_dir=args.profile)
+    try:
+        with metrics.span("batch", courses=len(courses)):
+            run_pipeline(courses, stages, queue_size=args.queue_size)
+    finally:
+        metrics.count("courses_failed", sum(not c.ok for c in courses))
+        metrics.count("courses_done", sum(c.ok for c in courses))
+        metrics.finish(args.prometheus)
+    print(format_report(courses))
+    if not args.no_cache:
+        log(f"Artifact cache: {json.dumps(artifact_cache.get_cache().stats())}")
+        log(f"Response cache: {json.dumps(llm_cache.get_cache().stats())}")
+    return 0 if all(c.ok for c in courses) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,893 @@
+# /usr/bin/python3
+""" This file is responsible for measuring the performance of the pipeline, so that regressions can be caught between commits"""
+import argparse
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from skipping_schoo import utils
+
+PROG = "Benchmark"
+
+ENTRY_POINTS = [
+    "skipping_schoo",
+    "skipping_schoo.__main__",
+    "skipping_schoo.download_schoo",
+    "skipping_schoo.rip_audio",
+    "skipping_schoo.transscribe",
+    "skipping_schoo.summarize",
+]
+
+IMPORT_RUNS = 5
+# A run is only a regression if it is slower than the baseline by both of these margins,
+# so that scheduler noise on millisecond imports does not fail the check
+IMPORT_TOLERANCE = 0.25
+IMPORT_SLACK_MS = 10.0
+
+EXTRACT_RUNS = 5
+EXTRACT_PAGE_BYTES = 2 * 1024 * 1024
+
+TOKENIZE_HOURS = 3.0
+TOKENIZE_METHODS = ("legacy", "streaming")
+# roughly one Whisper segment every 4 seconds of speech
+SEGMENTS_PER_HOUR = 900
+
+PIPELINE_AUDIO_SECS = 300
+PIPELINE_STAGES = ("download", "rip", "transcribe", "summarize")
+# a stage only counts as a regression once it is this much slower than the baseline
+PIPELINE_TOLERANCE = 0.15
+HLS_SEGMENT_SECS = 6
+
+_IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import {0}; "
+    "print((time.perf_counter() - t) * 1000)"
+)
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def measure_import_ms(module: str, runs: int = IMPORT_RUNS) -> dict[str, float]:
+    """Imports [module] in a fresh interpreter [runs] times
+    returns the best and median import time, and the median total process time, in milliseconds
+    """
+    import_times: list[float] = []
+    process_times: list[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        x = subprocess.run(
+            [sys.executable, "-c", _IMPORT_SNIPPET.format(module)],
+            stdout=subprocess.PIPE,
+            encoding="utf8",
+        )
+        process_times.append((time.perf_counter() - start) * 1000)
+        x.check_returncode()
+        import_times.append(float(x.stdout.strip().splitlines()[-1]))
+    return {
+        "import_best_ms": round(min(import_times), 3),
+        "import_median_ms": round(statistics.median(import_times), 3),
+        "process_median_ms": round(statistics.median(process_times), 3),
+    }
+
+
+def measure_imports(
+    modules: list[str] = ENTRY_POINTS, runs: int = IMPORT_RUNS
+) -> dict[str, dict[str, float]]:
+    """Measures the import time of every entry point"""
+    results = {}
+    for module in modules:
+        results[module] = measure_import_ms(module, runs=runs)
+        log(f"{module}: {results[module]['import_best_ms']} ms")
+    return results
+
+
+def compare_imports(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float = IMPORT_TOLERANCE,
+    slack_ms: float = IMPORT_SLACK_MS,
+) -> list[str]:
+    """Compares import timings against a baseline
+    returns a list of human readable regressions, which is empty if nothing got worse
+    """
+    regressions = []
+    for module, timings in results.items():
+        if module not in baseline:
+            continue
+        before = baseline[module]["import_best_ms"]
+        after = timings["import_best_ms"]
+        if after > before * (1 + tolerance) and after - before > slack_ms:
+            regressions.append(f"{module}: {before} ms -> {after} ms")
+    return regressions
+
+
+def synthesize_room_page(size_bytes: int = EXTRACT_PAGE_BYTES) -> str:
+    """Builds a room-like html page of roughly [size_bytes], with its <title> near the top
+    and the akamai_url in a script at the middle, as on real room pages"""
+    filler_line = '<div class="comment"><p>コメントです comment &amp; reply</p></div>\n'
+    half = max(1, size_bytes // 2 // len(filler_line.encode(utils.ENCODING)))
+    return "".join(
+        [
+            "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">\n",
+            "<title>スマホサイトコーディング入門 -構造設計とHTMLコーディング｜Schoo</title>\n</head><body>\n",
+            filler_line * half,
+            '<script>var room = {"akamai_url": "https://video.schoo.jp/video/2001/2799/master.m3u8", "id": 2799};</script>\n',
+            filler_line * half,
+            "</body></html>\n",
+        ]
+    )
+
+
+def _best_ms(fn, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return round(min(times), 3)
+
+
+def measure_extraction(pages: dict[str, str], runs: int = EXTRACT_RUNS) -> dict[str, dict]:
+    """Times the BeautifulSoup extraction against the incremental scan, for the m3u8 url and the title of every page"""
+    from skipping_schoo import download_schoo
+
+    def chunks(text: str):
+        step = download_schoo.SCAN_CHUNK_CHARS
+        return (text[i : i + step] for i in range(0, len(text), step))
+
+    results = {}
+    for name, text in pages.items():
+        soup_m3u8_ms = _best_ms(
+            lambda: download_schoo.extract_m3u8_from_html(
+                download_schoo._parse_html(text)
+            ),
+            runs,
+        )
+        scan_m3u8_ms = _best_ms(
+            lambda: download_schoo.scan_first(
+                chunks(text), download_schoo.M3U8_REGEX, line_bounded=True
+            ),
+            runs,
+        )
+        soup_title_ms = _best_ms(
+            lambda: download_schoo._parse_html(text).find("title"), runs
+        )
+        scan_title_ms = _best_ms(
+            lambda: download_schoo.scan_first(chunks(text), download_schoo.TITLE_REGEX),
+            runs,
+        )
+        results[name] = {
+            "bytes": len(text.encode(utils.ENCODING)),
+            "soup_m3u8_ms": soup_m3u8_ms,
+            "scan_m3u8_ms": scan_m3u8_ms,
+            "m3u8_speedup": round(soup_m3u8_ms / max(scan_m3u8_ms, 0.001), 1),
+            "soup_title_ms": soup_title_ms,
+            "scan_title_ms": scan_title_ms,
+            "title_speedup": round(soup_title_ms / max(scan_title_ms, 0.001), 1),
+        }
+        log(
+            f"{name}: m3u8 {soup_m3u8_ms} ms -> {scan_m3u8_ms} ms, title {soup_title_ms} ms -> {scan_title_ms} ms"
+        )
+    return results
+
+
+def _run_extract(args: argparse.Namespace) -> int:
+    pages = {}
+    for path in args.pages:
+        with open(path, "r", encoding=utils.ENCODING) as f:
+            pages[os.path.basename(path)] = f.read()
+    if len(pages) == 0:
+        pages["synthetic"] = synthesize_room_page(args.synthetic_bytes)
+    results = measure_extraction(pages, runs=args.runs)
+    if args.output:
+        _write_json(args.output, results)
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0
+
+
+def synthesize_transcript(path: str, hours: float = TOKENIZE_HOURS) -> str:
+    """Writes a transcript of [hours] of speech in the format transscribe writes, returns [path]"""
+    from skipping_schoo import transscribe
+
+    sentences = [
+        "今日はスマホサイトのコーディングについて、構造設計の基本から説明していきます。",
+        "まずはHTMLの骨組みを作って、それぞれの要素にクラス名を付けていきましょう。",
+        "ここで大事なのは、デザインを見ながら情報の優先順位を決めることです。",
+        "質問がきていますね。CSSはこのあとの回で詳しく扱いますので、少々お待ちください。",
+    ]
+    segments = int(hours * SEGMENTS_PER_HOUR)
+    step = 60 * 60 / SEGMENTS_PER_HOUR
+    with open(path, "w", encoding=utils.ENCODING) as f:
+        for i in range(segments):
+            text = sentences[i % len(sentences)]
+            f.write(transscribe.format_segment(i * step, (i + 1) * step, text))
+            f.write("\n")
+    return path
+
+
+def _peak_rss_mb() -> "float | None":
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _tokenize_worker(method: str, path: str, results) -> None:
+    """Chunks the transcript at [path] in a fresh process, so that peak memory only reflects [method]"""
+    from skipping_schoo import summarize
+
+    try:
+        if method == "legacy":
+            # the previous implementation: the slow GPT-2 tokenizer over the whole transcript, then a decode per chunk
+            from transformers import AutoTokenizer
+
+            tok = AutoTokenizer.from_pretrained("gpt2")
+            baseline_mb = _peak_rss_mb()
+            start = time.perf_counter()
+            with open(path, "r", encoding=utils.ENCODING) as f:
+                tokens = tok.encode(f.read())
+            step = summarize.CHUNK_SIZE - summarize.CHUNK_OVERLAP
+            chunks = [
+                tok.decode(tokens[i : i + summarize.CHUNK_SIZE])
+                for i in range(0, len(tokens), step)
+            ]
+            token_count = len(tokens)
+        else:
+            summarize.get_tokenizer().count("warm up")
+            baseline_mb = _peak_rss_mb()
+            start = time.perf_counter()
+            chunks = summarize.break_up_to_chunks_file(path)
+            token_count = summarize.count_tokens_file(path)
+        secs = time.perf_counter() - start
+        peak_mb = _peak_rss_mb()
+        results.put(
+            {
+                "tokens": token_count,
+                "chunks": len(chunks),
+                "secs": round(secs, 3),
+                "tokens_per_sec": round(token_count / max(secs, 1e-9)),
+                "peak_rss_mb": peak_mb,
+                "peak_rss_over_baseline_mb": None
+                if peak_mb is None
+                else round(peak_mb - baseline_mb, 1),
+            }
+        )
+    except ImportError as e:
+        results.put({"skipped": f"missing dependency: {e.name}"})
+
+
+def measure_tokenize(path: str, methods: tuple[str, ...] = TOKENIZE_METHODS) -> dict[str, dict]:
+    """Times chunking the transcript at [path] with each of [methods], each in its own process"""
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for method in methods:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_tokenize_worker, args=(method, path, queue))
+        p.start()
+        results[method] = queue.get()
+        p.join()
+        log(f"{method}: {results[method]}")
+    return results
+
+
+def _run_tokenize(args: argparse.Namespace) -> int:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        transcripts = args.transcripts
+        if len(transcripts) == 0:
+            transcripts = [
+                synthesize_transcript(
+                    os.path.join(tmp, f"synthetic_{args.hours}h.txt"), args.hours
+                )
+            ]
+        for path in transcripts:
+            results[os.path.basename(path)] = measure_tokenize(path, tuple(args.methods))
+    if args.output:
+        _write_json(args.output, results)
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0
+
+
+def synthesize_speech(path: str, secs: float = PIPELINE_AUDIO_SECS) -> str:
+    """Writes [secs] of speech-like 16khz mono audio to the wav file at [path]: voiced syllables with a wandering pitch
+    and a few harmonics, a few per second, with short pauses between phrases. It has none of the words of real speech,
+    but Whisper and ffmpeg do the same amount of work per second of it
+    returns [path]"""
+    import wave
+
+    import numpy as np
+
+    from skipping_schoo import rip_audio
+
+    rate = rip_audio.SAMPLE_RATE
+    rng = np.random.default_rng(2799)
+    samples = np.zeros(int(secs * rate), dtype=np.float32)
+    t = 0.0
+    while t < secs:
+        # a phrase of syllables, then a pause
+        for _ in range(int(rng.integers(3, 12))):
+            length = float(rng.uniform(0.12, 0.3))
+            start = int(t * rate)
+            n = min(int(length * rate), len(samples) - start)
+            if n <= 0:
+                break
+            x = np.arange(n) / rate
+            pitch = float(rng.uniform(100, 220)) * (1 + 0.1 * np.sin(2 * np.pi * 3 * x))
+            phase = 2 * np.pi * np.cumsum(pitch) / rate
+            voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+            envelope = np.sin(np.pi * np.arange(n) / n) ** 2
+            samples[start : start + n] += (0.2 * voiced * envelope).astype(np.float32)
+            t += length
+        t += float(rng.uniform(0.2, 0.8))
+    samples += rng.normal(0, 0.003, len(samples)).astype(np.float32)
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(rip_audio.CHANNELS)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm.tobytes())
+    return path
+
+
+def synthesize_hls(wav_path: str, directory: str, segment_secs: int = HLS_SEGMENT_SECS) -> str:
+    """Encodes the audio at [wav_path], with a small blank video track, into an HLS playlist of [segment_secs] long
+    MPEG-TS segments in [directory], like the streams schoo serves
+    returns the path of the playlist"""
+    os.makedirs(directory, exist_ok=True)
+    playlist = os.path.join(directory, "master.m3u8")
+    args = [
+        "ffmpeg",
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-y",
+        "-f",
+        "lavfi",
+        "-i",
+        "color=c=black:size=320x180:rate=10",
+        "-i",
+        wav_path,
+        "-shortest",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-c:a",
+        "aac",
+        "-f",
+        "hls",
+        "-hls_time",
+        str(segment_secs),
+        "-hls_playlist_type",
+        "vod",
+        playlist,
+    ]
+    x = subprocess.run(args, stdout=subprocess.PIPE)
+    x.check_returncode()
+    return playlist
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FixtureServer:
+    """Serves the files of [directory] over local http, so downloads go through the same code as real ones"""
+
+    def __init__(self, directory: str) -> None:
+        handler = functools.partial(_QuietHandler, directory=directory)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, name: str) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/{name}"
+
+    def __enter__(self) -> "FixtureServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _dir_bytes(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(directory)
+        for f in files
+    )
+
+
+def _skip_reason(e: Exception) -> str:
+    if isinstance(e, ImportError):
+        return f"missing dependency: {e.name}"
+    if isinstance(e, FileNotFoundError) and e.filename in ("ffmpeg", "ffprobe"):
+        return f"missing dependency: {e.filename}"
+    return f"{type(e).__name__}: {e}"
+
+
+def _time_stage(name: str, results: dict, fn) -> object:
+    """Runs [fn], storing its duration and the stats it returns under results[name]
+    returns the output of the stage, or None if it could not run"""
+    start = time.perf_counter()
+    try:
+        output, stats = fn()
+    except (ImportError, OSError, subprocess.CalledProcessError) as e:
+        results[name] = {"skipped": _skip_reason(e)}
+        log(f"{name}: skipped, {results[name]['skipped']}")
+        return None
+    secs = time.perf_counter() - start
+    results[name] = {"secs": round(secs, 3), **stats(secs)}
+    log(f"{name}: {results[name]}")
+    return output
+
+
+def measure_pipeline(
+    work_dir: str,
+    audio_secs: float = PIPELINE_AUDIO_SECS,
+    downloader: str = "ffmpeg",
+    model_size: "str | None" = None,
+    parallelism: "int | None" = None,
+    token_delay: float = 0.0,
+) -> dict[str, dict]:
+    """Runs every stage of the pipeline on synthetic fixtures in [work_dir], without touching the network:
+    the HLS stream of [audio_secs] of speech-like audio is served from a local http server, and summaries come from the stub completion server
+
+    Whisper hears no words in synthetic audio, so the summarize stage is given a synthetic transcript of the same length instead of the Whisper one
+    returns the duration and throughput of each stage, and of all of them together
+    """
+    from skipping_schoo import backends, download_schoo, rip_audio, summarize, transscribe
+
+    model_size = model_size or transscribe.MODEL_SIZE
+    parallelism = parallelism or summarize.PARALLELISM
+    fixtures_dir = os.path.join(work_dir, "fixtures")
+    os.makedirs(fixtures_dir, exist_ok=True)
+    wav_fixture = synthesize_speech(os.path.join(fixtures_dir, "speech.wav"), audio_secs)
+    transcript_fixture = synthesize_transcript(
+        os.path.join(fixtures_dir, "lecture.txt"), audio_secs / 3600
+    )
+    results: dict[str, dict] = {}
+    cwd = os.getcwd()
+    # every stage writes next to its input, under the working directory
+    os.chdir(work_dir)
+    stub = backends.StubServer(port=0, token_delay=token_delay).start()
+    previous = (summarize.BACKEND, summarize.BASE_URL, summarize.USE_RESPONSE_CACHE)
+    summarize.BACKEND, summarize.BASE_URL, summarize.USE_RESPONSE_CACHE = "stub", stub.url, False
+    try:
+        playlist = None
+        try:
+            playlist = synthesize_hls(wav_fixture, os.path.join(fixtures_dir, "hls"))
+        except (OSError, subprocess.CalledProcessError) as e:
+            results["download"] = {"skipped": _skip_reason(e)}
+        started = time.perf_counter()
+        with FixtureServer(fixtures_dir) as server:
+
+            def download():
+                path = download_schoo.get_video(
+                    server.url("hls/master.m3u8"), "bench.mp4", overwrite=True, downloader=downloader
+                )
+                served = _dir_bytes(os.path.join(fixtures_dir, "hls"))
+                return path, lambda secs: {
+                    "bytes": served,
+                    "bytes_per_sec": round(served / secs),
+                    "downloader": downloader,
+                }
+
+            video = _time_stage("download", results, download) if playlist else None
+
+        def rip():
+            size = os.path.getsize(video)
+            path = rip_audio.rip(video, "bench.wav", overwrite=True)
+            return path, lambda secs: {"bytes": size, "bytes_per_sec": round(size / secs)}
+
+        wav = None
+        if video is None:
+            results["rip"] = {"skipped": "no video was downloaded"}
+        else:
+            wav = _time_stage("rip", results, rip)
+        if wav is None:
+            # the rest of the pipeline can still be measured on the audio fixture
+            wav = wav_fixture
+
+        def transcribe():
+            load_start = time.perf_counter()
+            whisper = transscribe.load_model(model_size)
+            load_secs = time.perf_counter() - load_start
+            transcribe_start = time.perf_counter()
+            path = transscribe.transcribe(
+                wav, model_size=model_size, overwrite=True, whisper=whisper
+            )
+            transcribe_secs = time.perf_counter() - transcribe_start
+            return path, lambda secs: {
+                "audio_secs": audio_secs,
+                "model": model_size,
+                "model_load_secs": round(load_secs, 3),
+                "real_time_factor": round(transcribe_secs / audio_secs, 4),
+            }
+
+        _time_stage("transcribe", results, transcribe)
+
+        def summarize_stage():
+            tokens = summarize.count_tokens_file(transcript_fixture)
+            path = summarize.summarizer_file(
+                transcript_fixture, "benchmark", overwrite=True, parallelism=parallelism
+            )
+            return path, lambda secs: {
+                "tokens": tokens,
+                "tokens_per_sec": round(tokens / secs),
+                "parallelism": parallelism,
+                "token_delay": token_delay,
+            }
+
+        _time_stage("summarize", results, summarize_stage)
+        total = time.perf_counter() - started
+        ran = [name for name in PIPELINE_STAGES if "secs" in results.get(name, {})]
+        results["end_to_end"] = {
+            "secs": round(total, 3),
+            "stages": ran,
+            "real_time_factor": round(total / audio_secs, 4),
+        }
+    finally:
+        summarize.BACKEND, summarize.BASE_URL, summarize.USE_RESPONSE_CACHE = previous
+        stub.stop()
+        os.chdir(cwd)
+    return results
+
+
+def _git_commit() -> "str | None":
+    try:
+        x = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="utf8",
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return None
+    return x.stdout.strip() if x.returncode == 0 else None
+
+
+def compare_pipeline(
+    results: dict, baseline: dict, tolerance: float = PIPELINE_TOLERANCE
+) -> list[str]:
+    """Compares the duration of every stage against a baseline run with the same parameters
+    returns a list of human readable regressions, which is empty if nothing got worse
+    """
+    if results["params"] != baseline.get("params"):
+        log("Baseline was run with other parameters, comparing anyway")
+    regressions = []
+    for name, stage in results["stages"].items():
+        before = baseline.get("stages", {}).get(name, {}).get("secs")
+        after = stage.get("secs")
+        if before is None or after is None:
+            continue
+        if after > before * (1 + tolerance):
+            regressions.append(f"{name}: {before} s -> {after} s")
+    return regressions
+
+
+def _run_pipeline(args: argparse.Namespace) -> int:
+    from skipping_schoo import summarize, transscribe
+
+    args.model = args.model or transscribe.MODEL_SIZE
+    args.parallelism = args.parallelism or summarize.PARALLELISM
+    params = {
+        "audio_secs": args.secs,
+        "downloader": args.downloader,
+        "model": args.model,
+        "parallelism": args.parallelism,
+        "token_delay": args.token_delay,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        stages = measure_pipeline(
+            tmp,
+            audio_secs=args.secs,
+            downloader=args.downloader,
+            model_size=args.model,
+            parallelism=args.parallelism,
+            token_delay=args.token_delay,
+        )
+    results = {
+        "commit": _git_commit(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "stages": stages,
+    }
+    if args.output:
+        _write_json(args.output, results)
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.baseline is None:
+        return 0
+    if not os.path.exists(args.baseline) or args.save_baseline:
+        log(f"Writing pipeline baseline to {args.baseline}")
+        _write_json(args.baseline, results)
+        return 0
+    regressions = compare_pipeline(results, _load_json(args.baseline), args.tolerance)
+    if len(regressions) > 0:
+        for r in regressions:
+            log(f"Pipeline regression: {r}")
+        return 1
+    log("No pipeline regressions against baseline")
+    return 0
+
+
+def _time_text_codec(path: str, codec: str) -> dict:
+    """Compresses a copy of the transcript at [path] with [codec], or leaves it plain, then reads it back line by line
+    as the chunker does. returns the bytes kept on disk and the seconds to write and to read"""
+    import shutil
+
+    from skipping_schoo import storage
+
+    copy = f"{path}.{codec}.txt"
+    shutil.copyfile(path, copy)
+    start = time.perf_counter()
+    stored = copy if codec == "plain" else storage.compress_file(copy, codec)
+    write_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    with storage.open_text(copy) as f:
+        for _ in f:
+            pass
+    read_secs = time.perf_counter() - start
+    stats = {
+        "bytes": os.path.getsize(stored),
+        "write_secs": round(write_secs, 4),
+        "read_secs": round(read_secs, 4),
+    }
+    storage.remove(copy)
+    return stats
+
+
+def _time_audio_format(wav_path: str, extension: str) -> dict:
+    """Encodes the audio at [wav_path] in the format of [extension] as the rip stage would, then decodes it back into samples
+    as transcribe would. returns the bytes kept on disk and the seconds to write and to read"""
+    from skipping_schoo import rip_audio
+
+    path = f"{wav_path}.{extension}"
+    start = time.perf_counter()
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", wav_path]
+        + rip_audio.ffmpeg_output_args(path)
+        + [path],
+        check=True,
+    )
+    write_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    rip_audio.decode_samples(path)
+    read_secs = time.perf_counter() - start
+    stats = {
+        "bytes": os.path.getsize(path),
+        "write_secs": round(write_secs, 3),
+        "read_secs": round(read_secs, 3),
+    }
+    os.unlink(path)
+    return stats
+
+
+def measure_storage(
+    directory: str,
+    transcripts: "list[str] | None" = None,
+    hours: float = TOKENIZE_HOURS,
+    audio_secs: float = PIPELINE_AUDIO_SECS,
+) -> dict[str, dict]:
+    """Compares the disk used by every way storage.py can keep text and audio, and the time to write and read each back
+    Text is measured on [transcripts], or a synthetic transcript of [hours], audio on [audio_secs] of synthetic speech
+    """
+    from skipping_schoo import storage
+
+    if not transcripts:
+        transcripts = [synthesize_transcript(os.path.join(directory, "transcript.txt"), hours)]
+    text_codecs = ["plain", "gzip"] + (["zstd"] if storage._zstd() is not None else [])
+    results: dict[str, dict] = {"text": {}, "audio": {}}
+    for codec in text_codecs:
+        runs = [_time_text_codec(t, codec) for t in transcripts]
+        results["text"][codec] = {
+            key: round(sum(r[key] for r in runs), 4) for key in runs[0]
+        }
+        log(f"text {codec}: {results['text'][codec]}")
+    if "zstd" not in text_codecs:
+        results["text"]["zstd"] = {"skipped": "missing dependency: zstandard"}
+
+    try:
+        wav_path = synthesize_speech(os.path.join(directory, "speech.wav"), audio_secs)
+    except ImportError as e:
+        results["audio"] = {"skipped": _skip_reason(e)}
+        return results
+    for extension in storage.AUDIO_CODECS:
+        try:
+            results["audio"][extension] = _time_audio_format(wav_path, extension)
+        except (OSError, subprocess.CalledProcessError) as e:
+            results["audio"][extension] = {"skipped": _skip_reason(e)}
+        log(f"audio {extension}: {results['audio'][extension]}")
+    return results
+
+
+def _run_storage(args: argparse.Namespace) -> int:
+    import shutil
+
+    with tempfile.TemporaryDirectory() as tmp:
+        transcripts = []
+        for i, t in enumerate(args.transcripts):
+            # measured on copies, so the originals are never compressed away
+            transcripts.append(shutil.copyfile(t, os.path.join(tmp, f"{i}.txt")))
+        results = {
+            "params": {"hours": args.hours, "audio_secs": args.secs, "transcripts": args.transcripts},
+            **measure_storage(tmp, transcripts, args.hours, args.secs),
+        }
+    if args.output:
+        _write_json(args.output, results)
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0
+
+
+def _load_json(path: str) -> dict:
+    with open(path, "r", encoding=utils.ENCODING) as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data: dict) -> None:
+    with open(path, "w", encoding=utils.ENCODING) as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+def _run_imports(args: argparse.Namespace) -> int:
+    results = measure_imports(runs=args.runs)
+    if args.output:
+        _write_json(args.output, results)
+    if args.baseline is None:
+        print(json.dumps(results, indent=2))
+        return 0
+    if not os.path.exists(args.baseline) or args.save_baseline:
+        log(f"Writing import time baseline to {args.baseline}")
+        _write_json(args.baseline, results)
+        return 0
+    regressions = compare_imports(
+        results, _load_json(args.baseline), tolerance=args.tolerance
+    )
+    if len(regressions) > 0:
+        for r in regressions:
+            log(f"Import time regression: {r}")
+        return 1
+    log("No import time regressions against baseline")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Runs performance benchmarks for the pipeline",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    imports = subparsers.add_parser(
+        "imports", help="Measures the startup import time of every entry point"
+    )
+    imports.add_argument(
+        "-b",
+        "--baseline",
+        help="json file of previous timings. Exits non-zero if any entry point got slower. Written if it does not exist yet",
+    )
+    imports.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="if set, overwrites the baseline with the new timings instead of comparing",
+    )
+    imports.add_argument("--output", help="json file to write the timings to")
+    imports.add_argument("--runs", type=int, default=IMPORT_RUNS)
+    imports.add_argument("--tolerance", type=float, default=IMPORT_TOLERANCE)
+    imports.set_defaults(func=_run_imports)
+
+    extract = subparsers.add_parser(
+        "extract",
+        help="Compares BeautifulSoup against the incremental scan for finding the m3u8 url and title of room pages",
+    )
+    extract.add_argument(
+        "pages",
+        nargs="*",
+        help="saved room pages. A synthetic page is used if none are given",
+    )
+    extract.add_argument("--synthetic-bytes", type=int, default=EXTRACT_PAGE_BYTES)
+    extract.add_argument("--runs", type=int, default=EXTRACT_RUNS)
+    extract.add_argument("--output", help="json file to write the timings to")
+    extract.set_defaults(func=_run_extract)
+
+    tokenize = subparsers.add_parser(
+        "tokenize",
+        help="Compares the tokens per second and peak memory of chunking long transcripts, old tokenizer against the streaming chunker",
+    )
+    tokenize.add_argument(
+        "transcripts",
+        nargs="*",
+        help="transcript files. A synthetic transcript is used if none are given",
+    )
+    tokenize.add_argument(
+        "--hours",
+        type=float,
+        default=TOKENIZE_HOURS,
+        help="length of speech in the synthetic transcript",
+    )
+    tokenize.add_argument(
+        "--methods", nargs="+", choices=TOKENIZE_METHODS, default=list(TOKENIZE_METHODS)
+    )
+    tokenize.add_argument("--output", help="json file to write the timings to")
+    tokenize.set_defaults(func=_run_tokenize)
+
+    pipeline = subparsers.add_parser(
+        "pipeline",
+        help="Times download, rip, transcribe and summarize separately and end to end, on synthetic fixtures served locally",
+    )
+    pipeline.add_argument(
+        "--secs",
+        type=float,
+        default=PIPELINE_AUDIO_SECS,
+        help="length of the synthetic lecture",
+    )
+    pipeline.add_argument("--downloader", default="ffmpeg", choices=["ffmpeg", "segments"])
+    pipeline.add_argument("--model", help="Whisper model. Defaults to the one transscribe uses")
+    pipeline.add_argument("-p", "--parallelism", type=int, help="chunks summarized at once")
+    pipeline.add_argument(
+        "--token-delay",
+        type=float,
+        default=0.0,
+        help="seconds between the words streamed by the stub completion server",
+    )
+    pipeline.add_argument("--output", help="json file to write the results to")
+    pipeline.add_argument(
+        "-b",
+        "--baseline",
+        help="json file of a previous run. Exits non-zero if any stage got slower. Written if it does not exist yet",
+    )
+    pipeline.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="if set, overwrites the baseline with the new results instead of comparing",
+    )
+    pipeline.add_argument("--tolerance", type=float, default=PIPELINE_TOLERANCE)
+    pipeline.set_defaults(func=_run_pipeline)
+
+    storage = subparsers.add_parser(
+        "storage",
+        help="Compares the size, write and read time of plain and compressed transcripts, and of wav, FLAC and Opus audio",
+    )
+    storage.add_argument(
+        "transcripts",
+        nargs="*",
+        help="transcript files. A synthetic transcript is used if none are given",
+    )
+    storage.add_argument("--hours", type=float, default=TOKENIZE_HOURS, help="length of speech in the synthetic transcript")
+    storage.add_argument("--secs", type=float, default=PIPELINE_AUDIO_SECS, help="length of the synthetic audio")
+    storage.add_argument("--output", help="json file to write the results to")
+    storage.set_defaults(func=_run_storage)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
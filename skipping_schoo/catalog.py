@@ -0,0 +1,99 @@
+""" This file is responsible for remembering the title and m3u8 url of every class id that has been looked up"""
+import os
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from skipping_schoo import utils
+
+CATALOG_NAME = "catalog.sqlite3"
+# e.g. a catalog on a filesystem shared by the machines of a job queue
+CATALOG_ENV = "SKIPPING_SCHOO_CATALOG"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS classes (
+    class_id TEXT PRIMARY KEY,
+    title TEXT,
+    m3u8 TEXT,
+    updated REAL NOT NULL
+)
+"""
+
+# class ids a lookup found no page for, so that crawls over ranges of ids do not ask for them again
+_MISSING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS missing (
+    class_id TEXT PRIMARY KEY,
+    checked REAL NOT NULL
+)
+"""
+
+
+class Catalog:
+    """A small SQLite index of class metadata. Every call opens its own connection, so one catalog can be used from many threads"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.getenv(CATALOG_ENV) or os.path.join(utils.get_cache_dir(), CATALOG_NAME)
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+            conn.execute(_MISSING_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, class_id: str) -> tuple[Optional[str], Optional[str]]:
+        """returns the (title, m3u8 url) known for [class_id], with None for anything not looked up yet"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT title, m3u8 FROM classes WHERE class_id = ?", (class_id,)
+            ).fetchone()
+        if row is None:
+            return None, None
+        return row[0], row[1]
+
+    def get_title(self, class_id: str) -> Optional[str]:
+        return self.get(class_id)[0]
+
+    def get_m3u8(self, class_id: str) -> Optional[str]:
+        return self.get(class_id)[1]
+
+    def put(
+        self, class_id: str, title: Optional[str] = None, m3u8: Optional[str] = None
+    ) -> None:
+        """Records the [title] and/or [m3u8] url of [class_id], keeping whichever one is not given"""
+        with self._connect() as conn:
+            conn.execute(
+                """INSERT INTO classes (class_id, title, m3u8, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(class_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, classes.title),
+                    m3u8 = COALESCE(excluded.m3u8, classes.m3u8),
+                    updated = excluded.updated""",
+                (class_id, title, m3u8, time.time()),
+            )
+            conn.execute("DELETE FROM missing WHERE class_id = ?", (class_id,))
+
+    def put_missing(self, class_id: str) -> None:
+        """Records that [class_id] has no course page"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO missing (class_id, checked) VALUES (?, ?)",
+                (class_id, time.time()),
+            )
+
+    def resolved(self, class_ids: Iterable[str]) -> set[str]:
+        """returns those of [class_ids] whose title and m3u8 url are both known, or that are known to have no page"""
+        class_ids = list(class_ids)
+        found: set[str] = set()
+        with self._connect() as conn:
+            # sqlite allows a limited number of parameters per statement
+            for i in range(0, len(class_ids), 400):
+                batch = class_ids[i : i + 400]
+                marks = ",".join("?" * len(batch))
+                found.update(
+                    row[0]
+                    for row in conn.execute(
+                        f"""SELECT class_id FROM classes WHERE class_id IN ({marks}) AND title IS NOT NULL AND m3u8 IS NOT NULL
+                        UNION SELECT class_id FROM missing WHERE class_id IN ({marks})""",
+                        batch + batch,
+                    )
+                )
+        return found
@@ -0,0 +1,206 @@
+# /usr/bin/python3
+""" This file is responsible for shrinking a transcript before it is summarized, dropping what costs tokens but carries no content"""
+import argparse
+import os
+import re
+import sys
+from typing import Iterable, Iterator, Optional
+
+from skipping_schoo import metrics
+from skipping_schoo import segments as structured
+from skipping_schoo import storage
+from skipping_schoo import tokenizer
+from skipping_schoo import utils
+
+PROG = "Compact"
+
+# one coarse timestamp is kept per this many seconds, instead of a start and end on every segment
+MARKER_SECS = 300
+# a segment repeating one of the last few segments is one of Whisper's hallucination loops
+REPEAT_WINDOW = 4
+# a phrase said this many times in a row within one segment is kept once
+PHRASE_REPEATS = 3
+
+_SEGMENT_REGEX = re.compile(r"^\[(\d+(?:\.\d+)?) -> (\d+(?:\.\d+)?)\] ?(.*)$")
+_REPEATED_PHRASE_REGEX = re.compile(
+    r"(.{2,40}?)(?:\s*\1){%d,}" % (PHRASE_REPEATS - 1)
+)
+FILLERS = [
+    "えーっと",
+    "えーと",
+    "えっと",
+    "えー",
+    "あのー",
+    "あの",
+    "まあ",
+    "うーん",
+    "んー",
+    "uh",
+    "um",
+]
+# these also begin real words, e.g. the あの in あの人 or the まあ in まあまあ,
+# so they only count as fillers when punctuation or a space follows them. The others may run straight into the next word
+WORD_PREFIX_FILLERS = ["あの", "まあ", "uh", "um"]
+
+
+def _alternatives(fillers: list[str]) -> str:
+    return "|".join(re.escape(f) for f in sorted(fillers, key=len, reverse=True))
+
+
+# a filler must start a segment or follow a separator, and takes the separators after it along
+_FILLER_REGEX = re.compile(
+    r"(?:^|(?<=[\s、。,.!?！？]))(?:(?:%s)ー*[\s、,]*|(?:%s)ー*(?:[\s、,]+|(?=[。.!?！？]|$)))"
+    % (
+        _alternatives([f for f in FILLERS if f not in WORD_PREFIX_FILLERS]),
+        _alternatives(WORD_PREFIX_FILLERS),
+    ),
+    re.IGNORECASE,
+)
+_PUNCTUATION_REGEX = re.compile(r"[\s、。,.!?！？]")
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def get_compact_path(transcript_path: str) -> str:
+    """Returns the path of the compacted transcript. It keeps the base name of the transcript,
+    so that the chunks and summaries made from it are named as before"""
+    base = utils.get_basename_no_ext(transcript_path)
+    return os.path.join(os.path.dirname(transcript_path), f"{base}.compact.txt")
+
+
+def artifact_params() -> dict:
+    """Everything that changes the compacted transcript, for keying the artifact cache"""
+    return {
+        "marker_secs": MARKER_SECS,
+        "repeat_window": REPEAT_WINDOW,
+        "phrase_repeats": PHRASE_REPEATS,
+        "fillers": FILLERS,
+        "word_prefix_fillers": WORD_PREFIX_FILLERS,
+    }
+
+
+def _format_marker(secs: float) -> str:
+    minutes, seconds = divmod(int(secs), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f"[{hours}:{minutes:02d}:{seconds:02d}]"
+    return f"[{minutes:02d}:{seconds:02d}]"
+
+
+def clean_segment(text: str) -> str:
+    """Removes filler words and collapses a phrase repeated over and over within the segment"""
+    text = _REPEATED_PHRASE_REGEX.sub(r"\1", text.strip())
+    text = _FILLER_REGEX.sub("", text)
+    return text.strip()
+
+
+def _parse_lines(lines: Iterable[str]) -> Iterator[tuple[Optional[float], str]]:
+    for line in lines:
+        m = _SEGMENT_REGEX.match(line.rstrip("\r\n"))
+        if m is None:
+            yield None, line.strip()
+        else:
+            yield float(m.group(1)), m.group(3)
+
+
+def compact_segments(
+    segments: Iterable[tuple[Optional[float], str]], marker_secs: int = MARKER_SECS
+) -> Iterator[str]:
+    """Turns the (start, text) of every segment into lines without timestamps, writing one time marker line per [marker_secs] of speech instead.
+    Segments stay on their own lines, so the chunker can still cut between them. Segments without a start are passed through cleaned
+    """
+    recent: list[str] = []
+    next_marker = 0.0
+    for start, text in segments:
+        text = clean_segment(text)
+        if len(text) == 0:
+            continue
+        normalized = _PUNCTUATION_REGEX.sub("", text)
+        if normalized in recent:
+            continue
+        recent = (recent + [normalized])[-REPEAT_WINDOW:]
+        if start is not None and start >= next_marker:
+            yield f"{_format_marker(start)}\n"
+            next_marker = (int(start // marker_secs) + 1) * marker_secs
+        yield f"{text}\n"
+
+
+def compact_lines(lines: Iterable[str], marker_secs: int = MARKER_SECS) -> Iterator[str]:
+    """Compacts the lines of a plain transcript, see [compact_segments]"""
+    return compact_segments(_parse_lines(lines), marker_secs)
+
+
+@metrics.stage("compact")
+def compact_file(
+    transcript_path: str,
+    overwrite: bool = False,
+    model: Optional[str] = None,
+) -> str:
+    """Writes the compacted transcript next to [transcript_path] and returns its path.
+    With [model], the tokens saved are counted with that model's tokenizer and logged
+    """
+    output_path = get_compact_path(transcript_path)
+    if not overwrite and storage.exists(output_path):
+        log(
+            f"Compacted transcript already existed at {output_path}, and overwrite is set to false. Skipping compaction"
+        )
+        return output_path
+    if structured.has_index(transcript_path):
+        # only the start and text of each segment are needed, which the structured segments hold without any parsing
+        with structured.SegmentIndex(transcript_path) as index:
+            compacted = "".join(compact_segments(index.texts()))
+    else:
+        with storage.open_text(transcript_path) as f:
+            compacted = "".join(compact_lines(f))
+    utils.write_text_atomic(output_path, compacted)
+    if model is not None:
+        before, after = count_saved(transcript_path, output_path, model)
+        saved = before - after
+        metrics.count("tokens_compacted_away", saved)
+        log(
+            f"Compacted {transcript_path} from {before} to {after} tokens, saving {saved} ({round(100 * saved / max(1, before), 1)}%)"
+        )
+    return output_path
+
+
+def count_saved(transcript_path: str, compact_path: str, model: str) -> tuple[int, int]:
+    """returns the tokens of the transcript before and after compaction"""
+    tok = tokenizer.get_tokenizer(model)
+    counts = []
+    for path in (transcript_path, compact_path):
+        with storage.open_text(path) as f:
+            counts.append(sum(tok.count(line) for line in f))
+    return counts[0], counts[1]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Strips the per-segment timestamps, repeated segments and filler words from a transcript, and reports the tokens saved",
+    )
+    parser.add_argument("transcript")
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="if set, will overwrite an existing compacted transcript",
+    )
+    parser.add_argument(
+        "--model", help="model whose tokenizer counts the tokens saved. Defaults to the summarizing model"
+    )
+
+    args = parser.parse_args()
+
+    if args.model is None:
+        from skipping_schoo import summarize
+
+        args.model = summarize.MODEL
+
+    print(compact_file(args.transcript, overwrite=args.overwrite, model=args.model))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
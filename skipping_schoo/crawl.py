@@ -0,0 +1,356 @@
+# /usr/bin/python3
+""" This file is responsible for looking up the titles and m3u8 urls of many classes at once, ahead of downloading them"""
+import argparse
+import asyncio
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+from urllib.parse import urlparse
+
+from skipping_schoo import catalog
+from skipping_schoo import download_schoo
+from skipping_schoo import http_client
+from skipping_schoo import utils
+from skipping_schoo.errors import RetryableError, SkippingSchooError
+
+PROG = "Crawl"
+
+BASE_URL = "https://schoo.jp"
+# requests in flight to one host at once
+CONCURRENCY = 8
+# least seconds between the starts of two requests to one host
+DELAY_SECS = 0.1
+MAX_ATTEMPTS = 3
+BACKOFF_SECS = 2.0
+
+RANGE_REGEX = re.compile(r"(\d+)-(\d+)")
+
+STUB_HOST = "127.0.0.1"
+STUB_PORT = 8767
+_STUB_CLASS_REGEX = re.compile(r"/class/(\d+)(/room)?/?$")
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def parse_class_ids(specs: Iterable[str]) -> list[str]:
+    """Turns class ids, ranges of them such as 2799-2850, and schoo urls into a list of class ids, without duplicates"""
+    class_ids: dict[str, None] = {}
+    for spec in specs:
+        spec = spec.strip()
+        match = RANGE_REGEX.fullmatch(spec)
+        if match is not None:
+            first, last = int(match.group(1)), int(match.group(2))
+            class_ids.update((str(i), None) for i in range(first, last + 1))
+            continue
+        match = download_schoo.CLASS_ID_REGEX.match(spec)
+        if spec.isdigit():
+            class_ids[spec] = None
+        elif match is not None:
+            class_ids[match.group(1)] = None
+        else:
+            raise SkippingSchooError(f"Not a class id, range of class ids or Schoo URL: {spec}")
+    return list(class_ids)
+
+
+class _Host:
+    """The requests one host allows: at most [concurrency] at once, started at least [delay_secs] apart"""
+
+    def __init__(self, concurrency: int, delay_secs: float) -> None:
+        self.slots = asyncio.Semaphore(concurrency)
+        self.delay_secs = delay_secs
+        self.next_start = 0.0
+
+    async def wait_turn(self) -> None:
+        # nothing is awaited between reading and moving next_start, so requests take their turns in order
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.delay_secs
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class Crawler:
+    """Resolves the title and m3u8 url of many classes concurrently, and records them in the catalog the download stage reads.
+    Requests are paced per host, see [_Host]. The pages are fetched over a pooled session on a thread per request in flight,
+    while the event loop decides which requests go out when
+    """
+
+    def __init__(
+        self,
+        class_catalog: Optional[catalog.Catalog] = None,
+        base_url: str = BASE_URL,
+        concurrency: int = CONCURRENCY,
+        delay_secs: float = DELAY_SECS,
+        refresh: bool = False,
+    ) -> None:
+        self.catalog = class_catalog or catalog.Catalog()
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.delay_secs = delay_secs
+        self.refresh = refresh
+        self._session = http_client.make_session(pool_size=concurrency)
+        self._hosts: dict[str, _Host] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _host(self, url: str) -> _Host:
+        netloc = urlparse(url).netloc
+        if netloc not in self._hosts:
+            self._hosts[netloc] = _Host(self.concurrency, self.delay_secs)
+        return self._hosts[netloc]
+
+    def _get(self, url: str) -> Optional[str]:
+        """Fetches [url] on the calling thread. returns its text, or None if there is no such page"""
+        import requests
+
+        try:
+            r = self._session.get(url, timeout=http_client.TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(f"Could not reach {url}: {e}") from e
+        if r.status_code == 404:
+            return None
+        if r.status_code == 429 or r.status_code >= 500:
+            raise RetryableError(f"{url} answered {r.status_code}", headers=r.headers)
+        if r.status_code != 200:
+            raise SkippingSchooError(f"{url} answered {r.status_code}")
+        return r.text
+
+    async def _fetch(self, url: str, parse) -> Optional[str]:
+        """Fetches [url] once its host allows, retrying transient failures, and returns what [parse] finds in it,
+        or None if there is no such page. Both run on a worker thread"""
+        loop = asyncio.get_running_loop()
+        host = self._host(url)
+
+        def fetch_and_parse() -> Optional[str]:
+            text = self._get(url)
+            return None if text is None else parse(text)
+
+        for attempt in range(MAX_ATTEMPTS):
+            async with host.slots:
+                await host.wait_turn()
+                try:
+                    return await loop.run_in_executor(self._executor, fetch_and_parse)
+                except RetryableError as e:
+                    if attempt + 1 == MAX_ATTEMPTS:
+                        raise
+                    log(f"{e}, retrying")
+            await asyncio.sleep(BACKOFF_SECS * 2**attempt)
+        return None
+
+    async def resolve(self, class_id: str) -> str:
+        """Looks up the title and m3u8 url of [class_id] from its course and room pages, fetched at the same time,
+        and records them. returns "resolved", "missing" if the class has no page, or "failed"
+        """
+        class_url = f"{self.base_url}/class/{class_id}"
+        try:
+            title, m3u8 = await asyncio.gather(
+                self._fetch(class_url, lambda text: download_schoo.title_from_page(text, class_id)),
+                self._fetch(f"{class_url}/room", download_schoo.m3u8_from_page),
+            )
+        except (SkippingSchooError, OSError) as e:
+            log(f"Could not resolve class {class_id}: {e}")
+            return "failed"
+        loop = asyncio.get_running_loop()
+        if title is None or m3u8 is None:
+            await loop.run_in_executor(self._executor, self.catalog.put_missing, class_id)
+            return "missing"
+        await loop.run_in_executor(self._executor, self.catalog.put, class_id, title, m3u8)
+        return "resolved"
+
+    async def crawl_async(self, class_ids: Iterable[str]) -> dict:
+        """Resolves every class of [class_ids] not in the catalog yet, or all of them with [refresh]
+        returns how many were resolved, missing, failed and skipped, and how long it took
+        """
+        class_ids = list(class_ids)
+        # the limits of every host belong to the event loop they were made in
+        self._hosts = {}
+        known = set() if self.refresh else self.catalog.resolved(class_ids)
+        todo = [c for c in class_ids if c not in known]
+        counts = {"resolved": 0, "missing": 0, "failed": 0, "skipped": len(class_ids) - len(todo)}
+        log(f"Resolving {len(todo)} class(es), {counts['skipped']} already in the catalog")
+        start = time.perf_counter()
+        # a thread for every request one host allows in flight, and one more for catalog writes
+        with ThreadPoolExecutor(max_workers=self.concurrency + 1, thread_name_prefix=PROG) as self._executor:
+            for outcome in await asyncio.gather(*(self.resolve(c) for c in todo)):
+                counts[outcome] += 1
+        self._executor = None
+        secs = time.perf_counter() - start
+        counts["secs"] = round(secs, 3)
+        counts["classes_per_sec"] = round(len(todo) / secs, 2) if secs > 0 else None
+        return counts
+
+    def crawl(self, class_ids: Iterable[str]) -> dict:
+        return asyncio.run(self.crawl_async(class_ids))
+
+
+def prefetch(sources: Iterable[str]) -> dict:
+    """Resolves the classes of [sources], urls or class ids, into the default catalog, so that their downloads need no page fetches"""
+    return Crawler().crawl(parse_class_ids(sources))
+
+
+def stub_course_page(class_id: str) -> str:
+    return (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8">\n'
+        f"<title>テスト授業 {class_id} -構造設計とHTMLコーディング｜Schoo</title>\n</head><body>\n"
+        f"<h1>テスト授業 {class_id}</h1>\n</body></html>\n"
+    )
+
+
+def stub_room_page(class_id: str) -> str:
+    return (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8">\n'
+        f"<title>テスト授業 {class_id}｜Schoo</title>\n</head><body>\n"
+        f'<script>var room = {{"akamai_url": "https://video.schoo.jp/video/2001/{class_id}/master.m3u8", "id": {class_id}}};</script>\n'
+        "</body></html>\n"
+    )
+
+
+def _make_stub_http_server(address: tuple[str, int]):
+    """Builds the http server behind StubSchooServer. http.server is only imported here, since a crawl never needs it"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            server = self.server
+            with server.lock:
+                server.requests += 1
+                server.in_flight += 1
+                server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+            try:
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                match = _STUB_CLASS_REGEX.match(self.path)
+                if match is None or match.group(1) in server.missing:
+                    self._send(404, "Not found")
+                elif match.group(2):
+                    self._send(200, stub_room_page(match.group(1)))
+                else:
+                    self._send(200, stub_course_page(match.group(1)))
+            finally:
+                with server.lock:
+                    server.in_flight -= 1
+
+        def _send(self, status: int, text: str) -> None:
+            body = text.encode(utils.ENCODING)
+            self.send_response(status)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(address, _StubHandler)
+    server.daemon_threads = True
+    return server
+
+
+class StubSchooServer:
+    """A local server imitating the course and room pages of schoo, answering every request after [latency] seconds.
+    Classes in [missing] have no pages. It counts the requests it answered, and the most it was answering at once,
+    so a crawl can be checked against its concurrency limit without touching schoo
+    """
+
+    def __init__(
+        self,
+        host: str = STUB_HOST,
+        port: int = STUB_PORT,
+        latency: float = 0.0,
+        missing: Iterable[str] = (),
+    ) -> None:
+        self._server = _make_stub_http_server((host, port))
+        self._server.latency = latency
+        self._server.missing = set(missing)
+        self._server.lock = threading.Lock()
+        self._server.requests = 0
+        self._server.in_flight = 0
+        self._server.peak_in_flight = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self) -> int:
+        return self._server.requests
+
+    @property
+    def peak_in_flight(self) -> int:
+        return self._server.peak_in_flight
+
+    def start(self) -> "StubSchooServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Looks up the titles and m3u8 urls of many classes concurrently, so their downloads need no page fetches",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fetch = subparsers.add_parser("fetch", help="resolve classes into the catalog")
+    fetch.add_argument("classes", nargs="*", help="class ids, ranges of class ids such as 2799-2850, or Schoo URLs")
+    fetch.add_argument("-f", "--file", help="file containing one class id, range or Schoo URL per line")
+    fetch.add_argument("--base-url", default=BASE_URL, help="site to crawl, e.g. the url of a stub server")
+    fetch.add_argument("--catalog", help=f"catalog database. Defaults to ${catalog.CATALOG_ENV}, or the one in the cache directory, which the download stage reads")
+    fetch.add_argument("-n", "--concurrency", type=int, default=CONCURRENCY, help="requests in flight to one host at once")
+    fetch.add_argument("--delay", type=float, default=DELAY_SECS, help="least seconds between the starts of two requests to one host")
+    fetch.add_argument("--refresh", action="store_true", help="if set, looks up classes already in the catalog again")
+
+    stub = subparsers.add_parser("stub", help="serve imitation course and room pages, to crawl offline")
+    stub.add_argument("--host", default=STUB_HOST)
+    stub.add_argument("--port", type=int, default=STUB_PORT)
+    stub.add_argument("--latency", type=float, default=0.0, help="seconds before every answer, to simulate a slow site")
+    stub.add_argument("--missing", nargs="*", default=[], help="class ids to answer 404 for")
+
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        server = StubSchooServer(args.host, args.port, args.latency, args.missing)
+        log(f"Serving imitation schoo pages at {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
+        return 0
+
+    specs = list(args.classes)
+    if args.file:
+        with open(args.file, "r", encoding=utils.ENCODING) as f:
+            specs.extend(line.strip() for line in f if line.strip())
+    if len(specs) == 0:
+        parser.error("no class ids, ranges or urls given")
+    crawler = Crawler(
+        catalog.Catalog(args.catalog),
+        base_url=args.base_url,
+        concurrency=args.concurrency,
+        delay_secs=args.delay,
+        refresh=args.refresh,
+    )
+    counts = crawler.crawl(parse_class_ids(specs))
+    print(json.dumps(counts))
+    return 0 if counts["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,44 @@
 # /usr/bin/python3
 """ This file is responsible for downloading Schoo video files into a .mp4 onto your local machine"""
 import os
+import shutil
 import sys, subprocess
 import argparse
-import requests
-from bs4 import BeautifulSoup
-from typing import Union
+import html
+import threading
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Union
 import re
 
+from skipping_schoo import catalog
+from skipping_schoo import hls
+from skipping_schoo import http_client
+from skipping_schoo import metrics
+from skipping_schoo import pagecache
+from skipping_schoo import rip_audio
+from skipping_schoo import storage
 from skipping_schoo import utils
 from skipping_schoo.errors import SkippingSchooError
 
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
 PROG = "DownloadSchoo"
 SCHOO_REGEX = re.compile(r"(?:https://)?schoo.jp/class/(\d+)/room")
+CLASS_ID_REGEX = re.compile(r"(?:https://)?schoo.jp/class/(\d+)")
+M3U8_REGEX = re.compile(r"['\"]?akamai_url['\"]?:\W*(.*\.m3u8)['\"]?")
+TITLE_REGEX = re.compile(r"<title(?:\s[^>]*)?>(.*?)</title\s*>", re.IGNORECASE | re.DOTALL)
+
+SCAN_CHUNK_CHARS = 1 << 14
+SCAN_TAIL_CHARS = 1 << 12
+
+DOWNLOADERS = ("ffmpeg", "segments")
+DOWNLOADER = "ffmpeg"
+SEGMENTS_DIR = "segments"
+
+# The page cache and class catalog are shared by every thread of the process, and created on first use
+_page_cache: Optional[pagecache.PageCache] = None
+_catalog: Optional[catalog.Catalog] = None
+_cache_lock = threading.Lock()
 
 
 def log(msg: str, end="\n") -> None:
@@ -57,20 +83,112 @@ def reconstruct_video_url(url: Union[str, int]) -> str:
     raise SkippingSchooError("Not a valid Schoo URL or class number")
 
 
-def get_room_html_data(video_id: str) -> BeautifulSoup:
+def _parse_html(text: str) -> "BeautifulSoup":
+    """Parses html with BeautifulSoup, which is only imported when a page actually needs parsing"""
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(text, "html.parser")
+
+
+def _get_page_cache() -> pagecache.PageCache:
+    global _page_cache
+    with _cache_lock:
+        if _page_cache is None:
+            _page_cache = pagecache.PageCache()
+        return _page_cache
+
+
+def _get_catalog() -> catalog.Catalog:
+    global _catalog
+    with _cache_lock:
+        if _catalog is None:
+            _catalog = catalog.Catalog()
+        return _catalog
+
+
+def _class_id(url: Union[str, int]) -> Optional[str]:
+    """Returns the class id of a schoo url or class number, or None if it has none"""
+    if isinstance(url, int):
+        return str(url)
+    if url.isdigit():
+        return url
+    match = CLASS_ID_REGEX.match(url)
+    return None if match is None else match.group(1)
+
+
+def _fetch_page(url: str, video_id: Union[str, int], use_cache: bool = True) -> str:
+    """Fetches a schoo page over the shared session. With [use_cache], an unchanged page is served from the page cache"""
+    if use_cache:
+        page = _get_page_cache().get(url)
+        status_code, text = page.status_code, page.text
+    else:
+        r = http_client.get_session().get(url, timeout=http_client.TIMEOUT)
+        status_code, text = r.status_code, r.text
+    if status_code != 200:
+        raise SkippingSchooError(f"No such course: {video_id}")
+    return text
+
+
+def _stream_page(
+    url: str, video_id: Union[str, int], use_cache: bool = True
+) -> Iterator[str]:
+    """Yields a schoo page in pieces. Without [use_cache] the response is streamed, so a caller that stops early
+    never downloads the rest of the page"""
+    if use_cache:
+        text = _fetch_page(url, video_id, use_cache=True)
+        for i in range(0, len(text), SCAN_CHUNK_CHARS):
+            yield text[i : i + SCAN_CHUNK_CHARS]
+        return
+    with http_client.get_session().get(
+        url, timeout=http_client.TIMEOUT, stream=True
+    ) as r:
+        if r.status_code != 200:
+            raise SkippingSchooError(f"No such course: {video_id}")
+        yield from r.iter_content(SCAN_CHUNK_CHARS, decode_unicode=True)
+
+
+def scan_first(
+    chunks: Iterable[str],
+    pattern: re.Pattern,
+    line_bounded: bool = False,
+    seen: Optional[list[str]] = None,
+) -> Optional[str]:
+    """Runs [pattern] over text arriving in [chunks], and returns its first group as soon as it matches,
+    without reading the remaining chunks. Every chunk read is appended to [seen], if given
+
+    With [line_bounded], only complete lines are searched, so that a greedy pattern that cannot cross a line
+    matches exactly what it would in the full text. Otherwise only the last SCAN_TAIL_CHARS are carried over between chunks
+    """
+    buffer = ""
+    for chunk in chunks:
+        if seen is not None:
+            seen.append(chunk)
+        buffer += chunk
+        if line_bounded:
+            complete = buffer.rfind("\n") + 1
+            match = pattern.search(buffer, 0, complete)
+            if match is not None:
+                return match.group(1)
+            buffer = buffer[complete:]
+        else:
+            match = pattern.search(buffer)
+            if match is not None:
+                return match.group(1)
+            buffer = buffer[-SCAN_TAIL_CHARS:]
+    match = pattern.search(buffer)
+    return None if match is None else match.group(1)
+
+
+def get_room_html_data(video_id: str, use_cache: bool = True) -> "BeautifulSoup":
     """Fetches the html for the room, which we use at later steps to parse out the title and m3u8 url"""
     video_url = f"{reconstruct_video_url(video_id)}/room"
-    r = requests.get(video_url)
-    if r.status_code != 200:
-        raise SkippingSchooError(f"No such course: {video_id}")
-    return BeautifulSoup(r.text, "html.parser")
+    return _parse_html(_fetch_page(video_url, video_id, use_cache=use_cache))
 
 
-def extract_m3u8_from_html(room_html: BeautifulSoup) -> str:
+def extract_m3u8_from_html(room_html: "BeautifulSoup") -> str:
     """Given html data in BS form, search for the m3u8 url"""
-    m3u8_re = re.compile(r"['\"]?akamai_url['\"]?:\W*(.*\.m3u8)['\"]?")
     txt = str(room_html)
-    matches = [m.group(1) for m in m3u8_re.finditer(txt)]
+    matches = [m.group(1) for m in M3U8_REGEX.finditer(txt)]
     if len(matches) == 0:
         log(f"Failed to find m3u8 url in room html")
         raise SkippingSchooError("No m3u8 data found")
@@ -78,28 +196,81 @@ def extract_m3u8_from_html(room_html: BeautifulSoup) -> str:
     return m3u8
 
 
-def get_m3u8_link(video_id: str) -> str:
-    """Returns a URL to the .m3u8 file for downloading. Of the format 'https://video.schoo.jp/video/2001/$video_id'"""
-    soup = get_room_html_data(video_id)
-    return extract_m3u8_from_html(soup)
+def m3u8_from_page(room_page: str) -> str:
+    """Finds the m3u8 url in the full text of a room page"""
+    m3u8 = scan_first([room_page], M3U8_REGEX, line_bounded=True)
+    if m3u8 is None:
+        m3u8 = extract_m3u8_from_html(_parse_html(room_page))
+    return m3u8
+
+
+def get_m3u8_link(video_id: str, use_cache: bool = True) -> str:
+    """Returns a URL to the .m3u8 file for downloading. Of the format 'https://video.schoo.jp/video/2001/$video_id'
+    With [use_cache], a url found by a previous run for the same class id is returned without any request
+    """
+    if use_cache:
+        m3u8 = _get_catalog().get_m3u8(str(video_id))
+        if m3u8 is not None:
+            log(f"Using cached m3u8 url for class {video_id}")
+            return m3u8
+    room_url = f"{reconstruct_video_url(video_id)}/room"
+    seen: list[str] = []
+    m3u8 = scan_first(
+        _stream_page(room_url, video_id, use_cache=use_cache),
+        M3U8_REGEX,
+        line_bounded=True,
+        seen=seen,
+    )
+    if m3u8 is None:
+        log("Fast scan found no m3u8 url, falling back to parsing the room html")
+        m3u8 = extract_m3u8_from_html(_parse_html("".join(seen)))
+    _get_catalog().put(str(video_id), m3u8=m3u8)
+    return m3u8
+
+
+def _fetch_source(m3u8_url: str, output_path: str, downloader: str) -> str:
+    """Returns what ffmpeg should read the stream from: the playlist itself for the ffmpeg downloader,
+    or the joined local stream for the segment downloader, which can resume an interrupted download
+    """
+    if downloader == "ffmpeg":
+        return m3u8_url
+    elif downloader == "segments":
+        return hls.download(m3u8_url, os.path.join(output_path, SEGMENTS_DIR))
+    raise SkippingSchooError(
+        f"Unknown downloader '{downloader}', expected one of {', '.join(DOWNLOADERS)}"
+    )
+
+
+def _cleanup_source(output_path: str) -> None:
+    shutil.rmtree(os.path.join(output_path, SEGMENTS_DIR), ignore_errors=True)
+
 
+def get_output_path(filename: str) -> str:
+    """Returns the path [get_video] and [get_audio] write [filename] to"""
+    return os.path.join(utils.get_output_directory_path(filename), filename)
 
-def get_video(m3u8_url: str, filename: str, overwrite: bool = False) -> str:
+
+@metrics.stage("download")
+def get_video(
+    m3u8_url: str, filename: str, overwrite: bool = False, downloader: str = DOWNLOADER
+) -> str:
     """Uses FFMPEG to download the m3u8 file and stitch together the full video
+    With the 'segments' [downloader], the segments are fetched in parallel first, and ffmpeg only remuxes them
 
     returns the path to the downloaded video mp4 file"""
     output_path = utils.get_output_directory_path(filename)
-    os.makedirs(utils.get_output_directory_path(filename), exist_ok=True)
-    full_path = os.path.join(output_path, filename)
+    os.makedirs(output_path, exist_ok=True)
+    full_path = get_output_path(filename)
     if not overwrite and os.path.exists(full_path):
         log(
             f"Video file already existed at {full_path}, and overwrite is set to false. Skipping download step"
         )
     else:
+        source = _fetch_source(m3u8_url, output_path, downloader)
         args = [
             "ffmpeg",
             "-i",
-            m3u8_url,
+            source,
             "-bsf:a",
             "aac_adtstoasc",
             "-vcodec",
@@ -112,33 +283,101 @@ def get_video(m3u8_url: str, filename: str, overwrite: bool = False) -> str:
         ]
         x = subprocess.run(args, stdout=subprocess.PIPE)
         x.check_returncode()
+        _cleanup_source(output_path)
+        metrics.count("output_bytes", os.path.getsize(full_path), stage="download")
         log(f"File downloaded to {full_path}")
     return full_path
 
 
-def get_video_title(url: Union[str, int]) -> str:
-    """Fetches the course url to extract the course title"""
-    video_url = reconstruct_video_url(url)
-    r = requests.get(video_url)
-    if r.status_code != 200:
-        raise SkippingSchooError(f"No such course: {url}")
-    soup = BeautifulSoup(r.text, "html.parser")
-    title_tag = soup.find("title")
+@metrics.stage("download")
+def get_audio(
+    m3u8_url: str, filename: str, overwrite: bool = False, downloader: str = DOWNLOADER
+) -> str:
+    """Uses FFMPEG to stream only the audio of the m3u8 playlist straight into a 16khz mono wav file.
+    No video is written to disk, so there is no separate rip step. The 'segments' [downloader] does
+    download the whole stream first, in exchange for parallel and resumable downloads
+
+    returns the path to the wav file"""
+    output_path = utils.get_output_directory_path(filename)
+    os.makedirs(output_path, exist_ok=True)
+    full_path = get_output_path(filename)
+    if not overwrite and os.path.exists(full_path):
+        log(
+            f"Audio file already existed at {full_path}, and overwrite is set to false. Skipping download step"
+        )
+    else:
+        source = _fetch_source(m3u8_url, output_path, downloader)
+        args = ["ffmpeg", "-i", source, *rip_audio.ffmpeg_output_args(full_path), full_path]
+        x = subprocess.run(args, stdout=subprocess.PIPE)
+        x.check_returncode()
+        _cleanup_source(output_path)
+        metrics.count("output_bytes", os.path.getsize(full_path), stage="download")
+        log(f"Audio downloaded to {full_path}")
+    return full_path
+
+
+def stream_audio(m3u8_url: str):
+    """Streams only the audio of the m3u8 playlist into memory as 16khz mono float32 samples, ready for Whisper
+    returns a numpy array of the samples"""
+    return rip_audio.decode_samples(m3u8_url)
+
+
+def extract_title_from_html(page_html: "BeautifulSoup", url: Union[str, int]) -> str:
+    """Given html data in BS form, returns the course title from its <title> tag"""
+    title_tag = page_html.find("title")
     if title_tag == None:
         raise SkippingSchooError(
             f"No class title found in html response for course {url}"
         )
-    log(f"Found tile tag, contained the following text: {title_tag.text}")
+    return _clean_title(title_tag.text)
+
+
+def _clean_title(raw_title: str) -> str:
+    """Cuts the site name off the text of a <title> tag"""
+    log(f"Found tile tag, contained the following text: {raw_title}")
     split_on = None
-    if "｜" in title_tag.text:
+    if "｜" in raw_title:
         split_on = "｜"
-    elif "|" in title_tag.text:
+    elif "|" in raw_title:
         split_on = "|"
-    title_text = title_tag.text.split(split_on)[0]
+    title_text = raw_title.split(split_on)[0]
     log(f"Title text determined to be '{title_text}'")
     return title_text
 
 
+def title_from_page(course_page: str, url: Union[str, int]) -> str:
+    """Finds the course title in the full text of the course page of [url]"""
+    raw_title = scan_first([course_page], TITLE_REGEX)
+    if raw_title is not None:
+        return _clean_title(html.unescape(raw_title))
+    return extract_title_from_html(_parse_html(course_page), url)
+
+
+def get_video_title(url: Union[str, int], use_cache: bool = True) -> str:
+    """Fetches the course url to extract the course title
+    With [use_cache], a title found by a previous run for the same class id is returned without any request
+    """
+    class_id = _class_id(url)
+    if use_cache and class_id is not None:
+        title = _get_catalog().get_title(class_id)
+        if title is not None:
+            log(f"Using cached title for class {class_id}: '{title}'")
+            return title
+    video_url = reconstruct_video_url(url)
+    seen: list[str] = []
+    raw_title = scan_first(
+        _stream_page(video_url, url, use_cache=use_cache), TITLE_REGEX, seen=seen
+    )
+    if raw_title is not None:
+        title_text = _clean_title(html.unescape(raw_title))
+    else:
+        log("Fast scan found no title, falling back to parsing the course html")
+        title_text = extract_title_from_html(_parse_html("".join(seen)), url)
+    if class_id is not None:
+        _get_catalog().put(class_id, title=title_text)
+    return title_text
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
         prog=PROG,
@@ -151,19 +390,47 @@ def main() -> int:
         action="store_true",
         help="Fetches the course title of the given url",
     )
+    parser.add_argument(
+        "-a",
+        "--audio-only",
+        action="store_true",
+        help="Downloads only the audio, straight into a 16khz mono wav file, without writing the video to disk",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--downloader",
+        choices=DOWNLOADERS,
+        default=DOWNLOADER,
+        help="'ffmpeg' lets ffmpeg fetch the playlist. 'segments' fetches the segments in parallel, and resumes interrupted downloads",
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="if set, fetches the course pages again instead of using the title, m3u8 url and pages cached by previous runs",
+    )
 
     args = parser.parse_args()
 
+    use_cache = not args.no_cache
     video_id = parse_url(args.url)
     if video_id is None:
         return -1
     if args.title:
-        title = get_video_title(args.url)
+        title = get_video_title(args.url, use_cache=use_cache)
         print(title)
         return 0
     else:
-        m3u8_link = get_m3u8_link(video_id)
-        get_video(m3u8_link, f"{video_id}.mp4")
+        m3u8_link = get_m3u8_link(video_id, use_cache=use_cache)
+        if args.audio_only:
+            get_audio(
+                m3u8_link,
+                f"{video_id}.{storage.audio_extension()}",
+                downloader=args.downloader,
+            )
+        else:
+            get_video(m3u8_link, f"{video_id}.mp4", downloader=args.downloader)
         return 0
 
 
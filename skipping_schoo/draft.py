@@ -0,0 +1,90 @@
+""" This file is responsible for the draft transcripts and summaries a small Whisper model makes, while the full model's are still being made"""
+import datetime
+import json
+import os
+from typing import Optional
+
+from skipping_schoo import artifact_cache
+from skipping_schoo import summarize
+from skipping_schoo import transscribe
+from skipping_schoo import utils
+
+PROG = "Draft"
+
+# small enough to transcribe a lecture in a few minutes on a laptop
+DRAFT_MODELS = ["tiny", "base", "small"]
+DRAFT_MODEL_SIZE = "base"
+# greedy decoding, which costs the draft little accuracy for a fraction of the time
+DRAFT_BEAM_SIZE = 1
+
+TAG_SUFFIX = ".model.json"
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def get_draft_transcript_path(audio_path: str, model_size: str = DRAFT_MODEL_SIZE) -> str:
+    """Returns the path the draft transcript of [audio_path] made by [model_size] is written to, e.g. ./2799_base/2799_base.txt
+    It has its own directory, so its chunks and summaries never mix with those of the full transcript
+    """
+    # the base name of a file ends at its first dot, see utils.get_basename_no_ext
+    tag = model_size.replace(".", "-")
+    return transscribe.get_transcript_path(f"{utils.get_basename_no_ext(audio_path)}_{tag}.txt")
+
+
+def _tag_path(path: str) -> str:
+    return f"{path}{TAG_SUFFIX}"
+
+
+def write_tag(path: str, model_size: str, draft: bool) -> None:
+    """Records that the artifact at [path], a transcript or a summary, comes from a transcript made by [model_size]"""
+    tag = {
+        "model": model_size,
+        "draft": draft,
+        "tagged": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    utils.write_text_atomic(_tag_path(path), json.dumps(tag))
+
+
+def read_tag(path: str) -> Optional[dict]:
+    """returns the tag of the artifact at [path], or None if it has none"""
+    try:
+        with open(_tag_path(path), "r", encoding=utils.ENCODING) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def is_draft(path: str) -> bool:
+    tag = read_tag(path)
+    return tag is not None and tag["draft"]
+
+
+def remove_tag(path: str) -> None:
+    if os.path.exists(_tag_path(path)):
+        os.unlink(_tag_path(path))
+
+
+def publish(draft_summary_path: str, summary_path: str, model_size: str) -> None:
+    """Puts the draft summary at [draft_summary_path] in place of the full summary at [summary_path], tagged as a draft,
+    so readers have something to read until the full summary replaces it.
+    The tag is written first, so a summary is never taken for the full one while it is still a draft
+    """
+    write_tag(summary_path, model_size, draft=True)
+    # the cache must not take the draft for the full summary it recorded at this path
+    artifact_cache.forget(summary_path)
+    with open(draft_summary_path, "r", encoding=utils.ENCODING) as f:
+        utils.write_text_atomic(summary_path, f.read())
+    log(f"Published the draft summary from {model_size} at {summary_path}")
+
+
+def is_needed(audio_path: str, overwrite: bool = False) -> bool:
+    """A draft is only worth making while the full transcript of [audio_path] is still to be made, or its summary is"""
+    if overwrite:
+        return True
+    transcript_path = transscribe.get_transcript_path(audio_path)
+    summary_path = summarize.get_summary_path(transcript_path)
+    if os.path.exists(summary_path) and not is_draft(summary_path):
+        return False
+    return not transscribe.is_complete(transcript_path)
@@ -1,3 +1,15 @@
 class SkippingSchooError(Exception):
     pass
 
+
+
+class RetryableError(SkippingSchooError):
+    """A request failed in a way that may succeed if it is sent again, such as a dropped connection or a server error"""
+
+    def __init__(self, msg: str, headers=None) -> None:
+        super().__init__(msg)
+        self.headers = headers
+
+
+class RateLimitError(RetryableError):
+    """The server refused a request for going over the rate limit"""
@@ -0,0 +1,313 @@
+# /usr/bin/python3
+""" This file is responsible for downloading the segments of an HLS (.m3u8) playlist in parallel, resuming interrupted downloads"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urljoin, urlsplit
+
+from skipping_schoo import http_client
+from skipping_schoo import metrics
+from skipping_schoo import ratelimit
+from skipping_schoo import utils
+from skipping_schoo.errors import SkippingSchooError
+
+PROG = "HLS"
+
+WORKERS = 8
+RETRIES = 4
+CHUNK_BYTES = 1 << 16
+
+MANIFEST_NAME = "manifest.json"
+# the manifest is rewritten once per this many finished segments, and once the download stops.
+# Segments finished but not saved yet when a run is killed are only downloaded again
+MANIFEST_SAVE_EVERY = 50
+STREAM_NAME = "stream.ts"
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class Segment:
+    """One media segment of a playlist. [name] identifies the segment across runs, even if the signed query string changes"""
+
+    def __init__(self, index: int, url: str, duration: float = 0.0) -> None:
+        self.index = index
+        self.url = url
+        self.duration = duration
+        self.name = urlsplit(url).path
+
+    @property
+    def filename(self) -> str:
+        return f"{self.index:06d}.seg"
+
+
+def _parse_attributes(line: str) -> dict[str, str]:
+    """Parses the KEY=VALUE,KEY="VALUE" attribute list of an m3u8 tag"""
+    attributes: dict[str, str] = {}
+    _, _, rest = line.partition(":")
+    key, value, in_quotes = "", "", False
+    reading_key = True
+    for c in rest + ",":
+        if reading_key:
+            if c == "=":
+                reading_key = False
+            else:
+                key += c
+        elif c == '"':
+            in_quotes = not in_quotes
+        elif c == "," and not in_quotes:
+            attributes[key.strip().upper()] = value
+            key, value, reading_key = "", "", True
+        else:
+            value += c
+    return attributes
+
+
+def parse_playlist(text: str, base_url: str) -> tuple[list[tuple[int, str]], list[Segment]]:
+    """Parses an m3u8 playlist
+    returns the (bandwidth, url) of every variant if it is a master playlist, and the segments if it is a media playlist
+    """
+    lines = [l.strip() for l in text.splitlines()]
+    if len(lines) == 0 or lines[0] != "#EXTM3U":
+        raise SkippingSchooError("Not an m3u8 playlist")
+    variants: list[tuple[int, str]] = []
+    segments: list[Segment] = []
+    duration = 0.0
+    bandwidth: Optional[int] = None
+    for line in lines[1:]:
+        if len(line) == 0:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF"):
+            bandwidth = int(_parse_attributes(line).get("BANDWIDTH", "0"))
+        elif line.startswith("#EXTINF"):
+            duration = float(line.partition(":")[2].split(",")[0] or 0)
+        elif line.startswith("#EXT-X-KEY"):
+            method = _parse_attributes(line).get("METHOD", "NONE")
+            if method != "NONE":
+                raise SkippingSchooError(
+                    f"Playlist is encrypted with {method}, which only the ffmpeg downloader supports"
+                )
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            raise SkippingSchooError(
+                "Playlist addresses its segments by byte range, which only the ffmpeg downloader supports"
+            )
+        elif line.startswith("#EXT-X-MAP"):
+            attributes = _parse_attributes(line)
+            if "BYTERANGE" in attributes:
+                raise SkippingSchooError(
+                    "Playlist addresses its init segment by byte range, which only the ffmpeg downloader supports"
+                )
+            uri = attributes.get("URI")
+            if uri is not None:
+                segments.append(Segment(len(segments), urljoin(base_url, uri)))
+        elif line.startswith("#"):
+            continue
+        elif bandwidth is not None:
+            variants.append((bandwidth, urljoin(base_url, line)))
+            bandwidth = None
+        else:
+            segments.append(Segment(len(segments), urljoin(base_url, line), duration))
+            duration = 0.0
+    return variants, segments
+
+
+def resolve_segments(session, m3u8_url: str) -> list[Segment]:
+    """Fetches the playlist, following a master playlist to its highest bandwidth variant
+    returns the media segments in playback order
+    """
+    url = m3u8_url
+    for _ in range(4):
+        r = session.get(url, timeout=http_client.TIMEOUT)
+        if r.status_code != 200:
+            raise SkippingSchooError(f"Failed to fetch playlist {url}: HTTP {r.status_code}")
+        variants, segments = parse_playlist(r.text, url)
+        if len(variants) == 0:
+            log(f"Playlist has {len(segments)} segments")
+            return segments
+        url = max(variants)[1]
+        log(f"Master playlist, following the highest bandwidth variant {url}")
+    raise SkippingSchooError(f"Too many nested playlists at {m3u8_url}")
+
+
+class _Manifest:
+    """Records which segments are completely on disk, so that an interrupted download can resume"""
+
+    def __init__(self, work_dir: str) -> None:
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.completed: dict[str, dict] = {}
+        # set once the segments are joined into the stream, and deleted
+        self.joined = False
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding=utils.ENCODING) as f:
+                manifest = json.load(f)
+            self.completed = manifest.get("segments", {})
+            self.joined = manifest.get("joined", False)
+
+    def is_done(self, segment: Segment, work_dir: str) -> bool:
+        entry = self.completed.get(str(segment.index))
+        if entry is None or entry["name"] != segment.name:
+            return False
+        path = os.path.join(work_dir, segment.filename)
+        return os.path.exists(path) and os.path.getsize(path) == entry["bytes"]
+
+    def mark_done(self, segment: Segment, size: int) -> None:
+        with self._lock:
+            self.completed[str(segment.index)] = {"name": segment.name, "bytes": size}
+            self._unsaved += 1
+            if self._unsaved >= MANIFEST_SAVE_EVERY:
+                self._save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def mark_joined(self) -> None:
+        with self._lock:
+            self.joined = True
+            self._save()
+
+    def _save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding=utils.ENCODING) as f:
+            json.dump({"segments": self.completed, "joined": self.joined}, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+
+def _fetch_segment(session, segment: Segment, work_dir: str, retries: int) -> int:
+    """Downloads one segment, retrying with backoff. The file only appears under its final name once complete
+    returns the number of bytes written
+    """
+    path = os.path.join(work_dir, segment.filename)
+    tmp_path = f"{path}.part"
+    for attempt in range(retries + 1):
+        try:
+            size = 0
+            with session.get(segment.url, timeout=http_client.TIMEOUT, stream=True) as r:
+                r.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for block in r.iter_content(CHUNK_BYTES):
+                        f.write(block)
+                        size += len(block)
+            os.replace(tmp_path, path)
+            metrics.count("download_bytes", size)
+            metrics.count("segments_downloaded")
+            return size
+        except Exception as e:
+            metrics.count("retries", stage="download")
+            if attempt == retries:
+                raise SkippingSchooError(
+                    f"Failed to download segment {segment.index} after {attempt + 1} attempts: {e}"
+                ) from e
+            delay = ratelimit.backoff_delay(attempt)
+            log(f"Segment {segment.index} failed ({e}), retrying in {round(delay, 2)} seconds")
+            time.sleep(delay)
+    raise SkippingSchooError("Unreachable: retries exhausted without a result")
+
+
+def download_segments(
+    m3u8_url: str,
+    work_dir: str,
+    workers: int = WORKERS,
+    retries: int = RETRIES,
+    session=None,
+) -> list[str]:
+    """Downloads every segment of the playlist into [work_dir], [workers] at a time over the shared pooled session.
+    Segments recorded as complete by a previous run are not downloaded again
+
+    returns the segment file paths in playback order
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    if session is None:
+        session = http_client.get_session()
+    segments = resolve_segments(session, m3u8_url)
+    manifest = _Manifest(work_dir)
+    pending = [s for s in segments if not manifest.is_done(s, work_dir)]
+    if len(pending) < len(segments):
+        log(f"Resuming download, {len(segments) - len(pending)} of {len(segments)} segments already on disk")
+
+    done = [len(segments) - len(pending)]
+    lock = threading.Lock()
+
+    def fetch(segment: Segment) -> None:
+        size = _fetch_segment(session, segment, work_dir, retries)
+        manifest.mark_done(segment, size)
+        with lock:
+            done[0] += 1
+            log(f"\rDownloaded {done[0]} of {len(segments)} segments", end="\r")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(fetch, pending))
+    finally:
+        # also when a segment failed, so the next run resumes after every segment that did finish
+        manifest.save()
+    utils.eprint("", end="\r")
+    log(f"All {len(segments)} segments downloaded")
+    return [os.path.join(work_dir, s.filename) for s in segments]
+
+
+def concatenate(paths: list[str], output_path: str) -> str:
+    """Joins the downloaded segments, in order, into a single stream file.
+    Each segment is deleted once appended, so the download never takes up twice its size on disk.
+    If joining is interrupted, the segments already deleted are downloaded again on the next run
+    """
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out, CHUNK_BYTES)
+            os.unlink(path)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def download(
+    m3u8_url: str,
+    work_dir: str,
+    workers: int = WORKERS,
+    retries: int = RETRIES,
+    session=None,
+) -> str:
+    """Downloads the playlist into [work_dir] and joins its segments
+    returns the path of the joined stream, which ffmpeg can remux or decode locally
+    """
+    stream_path = os.path.join(work_dir, STREAM_NAME)
+    if _Manifest(work_dir).joined and os.path.exists(stream_path):
+        log(f"Segments were already joined at {stream_path}")
+        return stream_path
+    paths = download_segments(
+        m3u8_url, work_dir, workers=workers, retries=retries, session=session
+    )
+    concatenate(paths, stream_path)
+    _Manifest(work_dir).mark_joined()
+    return stream_path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Downloads the segments of an m3u8 playlist in parallel and joins them into one stream file",
+    )
+    parser.add_argument("m3u8_url")
+    parser.add_argument("work_dir", help="directory for the segments, the resume manifest and the joined stream")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS)
+    parser.add_argument("-r", "--retries", type=int, default=RETRIES)
+
+    args = parser.parse_args()
+
+    print(download(args.m3u8_url, args.work_dir, workers=args.workers, retries=args.retries))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+""" This file is responsible for the pooled HTTP session shared by everything that talks to schoo"""
+import threading
+
+POOL_SIZE = 16
+TIMEOUT = 30
+
+_session = None
+_lock = threading.Lock()
+
+
+def make_session(pool_size: int = POOL_SIZE):
+    """Returns a new requests session keeping up to [pool_size] connections open per host"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """Returns the session shared by the whole process, creating it on first use"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = make_session()
+        return _session
@@ -0,0 +1,655 @@
+# /usr/bin/python3
+""" This file is responsible for a persistent queue of courses, whose stages are claimed and run by workers on any number of machines"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+from skipping_schoo import download_schoo
+from skipping_schoo import metrics
+from skipping_schoo import storage
+from skipping_schoo import utils
+from skipping_schoo.errors import RetryableError, SkippingSchooError
+
+PROG = "JobQueue"
+
+# Read from SKIPPING_SCHOO_QUEUE. Point it at a shared filesystem for workers on several machines
+QUEUE_ENV = "SKIPPING_SCHOO_QUEUE"
+QUEUE_NAME = "jobs.sqlite3"
+
+STAGES = ["download", "rip", "transcribe", "summarize"]
+# with audio only, the download writes the wav file and there is nothing to rip
+AUDIO_ONLY_STAGES = ["download", "transcribe", "summarize"]
+
+# a claimed job is handed back to the queue unless its worker renews the lease within this long
+LEASE_SECS = 120
+HEARTBEAT_SECS = 30
+# a job that failed, or whose worker died, this many times is marked failed instead of being tried again
+MAX_ATTEMPTS = 3
+RETRY_SECS = 60
+POLL_SECS = 10
+# the window per-stage throughput is measured over
+THROUGHPUT_SECS = 60 * 60
+
+# the Course attributes carried from one stage to the next, see batch.Course
+COURSE_FIELDS = ["video_id", "title", "video_path", "wav_path", "transcript_path", "summary_path"]
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS classes (
+        class_id TEXT PRIMARY KEY,
+        source TEXT NOT NULL,
+        audio_only INTEGER NOT NULL,
+        priority INTEGER NOT NULL,
+        added REAL NOT NULL,
+        course TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS jobs (
+        class_id TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        lease_expires REAL,
+        available_at REAL NOT NULL DEFAULT 0,
+        started REAL,
+        finished REAL,
+        error TEXT,
+        PRIMARY KEY (class_id, stage)
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, stage)",
+]
+
+# waiting: an earlier stage of the class is not done yet. cancelled: an earlier stage failed
+STATES = ["waiting", "pending", "leased", "done", "failed", "cancelled"]
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def get_queue_path() -> str:
+    path = os.getenv(QUEUE_ENV)
+    if path:
+        return path
+    return os.path.join(utils.get_cache_dir("queue"), QUEUE_NAME)
+
+
+def make_worker_id(index: int = 0) -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+class Job:
+    """One stage of one class, claimed by [worker] until its lease runs out"""
+
+    def __init__(
+        self,
+        class_id: str,
+        stage: str,
+        attempts: int,
+        worker: str,
+        source: str,
+        audio_only: bool,
+        course: dict[str, Any],
+    ) -> None:
+        self.class_id = class_id
+        self.stage = stage
+        self.attempts = attempts
+        self.worker = worker
+        self.source = source
+        self.audio_only = audio_only
+        self.course = course
+        # set once the lease is lost, so the job is abandoned rather than run alongside its new owner
+        self.lost = threading.Event()
+
+
+class JobQueue:
+    """Tracks the state of every stage of every queued class in one SQLite database.
+
+    A stage becomes pending once the stage before it is done. Workers claim pending stages of the kinds they run,
+    and hold a lease on each that they renew with [heartbeat] while working. Only one stage of a class is pending
+    or leased at a time, so as long as leases are renewed, two workers never write the outputs of the same class at once.
+    A lease that runs out, e.g. because its worker died, is claimed again by the next worker asking for that stage.
+    A worker that finds its lease lost, e.g. after stalling for longer than [lease_secs], abandons the job and records nothing,
+    but a stage already running is not interrupted, so [lease_secs] must stay well above the longest stall expected
+
+    SQLite locks the whole database for every write, which is plenty for jobs taking minutes.
+    On a network filesystem, its file locking must work, and the default rollback journal is kept since WAL needs shared memory
+    """
+
+    def __init__(self, path: Optional[str] = None, lease_secs: float = LEASE_SECS) -> None:
+        self.path = path or get_queue_path()
+        self.lease_secs = lease_secs
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """A write transaction, holding the database's write lock from the start so that claims cannot race"""
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def add(self, sources: list[str], audio_only: bool = False, priority: int = 0) -> list[str]:
+        """Queues every Schoo url or class id in [sources]. Classes already in the queue are left as they are
+        returns the ids of the classes added
+        """
+        now = time.time()
+        added = []
+        with self._transaction() as conn:
+            for source in sources:
+                class_id = download_schoo.parse_url(source)
+                exists = conn.execute(
+                    "SELECT 1 FROM classes WHERE class_id = ?", (class_id,)
+                ).fetchone()
+                if exists is not None:
+                    log(f"{class_id} is already queued")
+                    continue
+                conn.execute(
+                    "INSERT INTO classes (class_id, source, audio_only, priority, added, course) VALUES (?, ?, ?, ?, ?, ?)",
+                    (class_id, source, int(audio_only), priority, now, json.dumps({"video_id": class_id})),
+                )
+                stages = AUDIO_ONLY_STAGES if audio_only else STAGES
+                for seq, stage in enumerate(stages):
+                    conn.execute(
+                        "INSERT INTO jobs (class_id, stage, seq, state) VALUES (?, ?, ?, ?)",
+                        (class_id, stage, seq, "pending" if seq == 0 else "waiting"),
+                    )
+                added.append(class_id)
+        return added
+
+    def _fail_expired(self, conn: sqlite3.Connection, now: float) -> None:
+        """Marks failed the jobs whose lease ran out on their last attempt, e.g. a lecture that crashes every worker taking it"""
+        for class_id, stage in conn.execute(
+            "SELECT class_id, stage FROM jobs WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, MAX_ATTEMPTS),
+        ).fetchall():
+            log(f"[{class_id}] {stage} lost its lease {MAX_ATTEMPTS} times, marking it failed")
+            self._mark_failed(conn, class_id, stage, "lease expired", now)
+
+    def _mark_failed(self, conn: sqlite3.Connection, class_id: str, stage: str, error: str, now: float) -> None:
+        conn.execute(
+            "UPDATE jobs SET state = 'failed', worker = NULL, lease_expires = NULL, finished = ?, error = ? WHERE class_id = ? AND stage = ?",
+            (now, error, class_id, stage),
+        )
+        conn.execute(
+            "UPDATE jobs SET state = 'cancelled' WHERE class_id = ? AND state = 'waiting'",
+            (class_id,),
+        )
+        metrics.count("jobs_failed", stage=stage)
+
+    def claim(self, worker: str, stages: list[str]) -> Optional[Job]:
+        """Leases the next pending job of one of [stages] to [worker], or one whose lease has run out
+        Later stages are preferred, so classes already under way are finished before new ones are started
+        returns None if there is nothing to do
+        """
+        now = time.time()
+        marks = ",".join("?" for _ in stages)
+        with self._transaction() as conn:
+            self._fail_expired(conn, now)
+            row = conn.execute(
+                f"""SELECT j.class_id, j.stage, j.state, j.worker, j.attempts, c.source, c.audio_only, c.course
+                FROM jobs j JOIN classes c ON c.class_id = j.class_id
+                WHERE j.stage IN ({marks})
+                  AND ((j.state = 'pending' AND j.available_at <= ?) OR (j.state = 'leased' AND j.lease_expires < ?))
+                ORDER BY c.priority DESC, j.seq DESC, c.added ASC
+                LIMIT 1""",
+                (*stages, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            class_id, stage, state, previous, attempts, source, audio_only, course = row
+            if state == "leased":
+                log(f"[{class_id}] reclaiming {stage}, whose lease held by {previous} expired")
+                metrics.count("leases_reclaimed", stage=stage)
+            conn.execute(
+                """UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, started = ?, error = NULL
+                WHERE class_id = ? AND stage = ?""",
+                (worker, now + self.lease_secs, now, class_id, stage),
+            )
+        metrics.count("jobs_claimed", stage=stage)
+        return Job(class_id, stage, attempts + 1, worker, source, bool(audio_only), json.loads(course))
+
+    def heartbeat(self, job: Job) -> bool:
+        """Renews the lease on [job]. returns False if it was lost, i.e. it ran out and another worker claimed the job"""
+        with self._transaction() as conn:
+            renewed = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE class_id = ? AND stage = ? AND state = 'leased' AND worker = ?",
+                (time.time() + self.lease_secs, job.class_id, job.stage, job.worker),
+            ).rowcount
+        return renewed > 0
+
+    def complete(self, job: Job, course: dict[str, Any]) -> bool:
+        """Marks [job] done, stores the [course] it produced for the next stage, and makes that stage pending
+        returns False if the lease was lost in the meantime, in which case nothing is recorded
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            done = conn.execute(
+                """UPDATE jobs SET state = 'done', worker = NULL, lease_expires = NULL, finished = ?
+                WHERE class_id = ? AND stage = ? AND state = 'leased' AND worker = ?""",
+                (now, job.class_id, job.stage, job.worker),
+            ).rowcount
+            if done == 0:
+                return False
+            conn.execute(
+                "UPDATE classes SET course = ? WHERE class_id = ?",
+                (json.dumps(course, ensure_ascii=False), job.class_id),
+            )
+            conn.execute(
+                """UPDATE jobs SET state = 'pending', available_at = 0 WHERE class_id = ? AND state = 'waiting'
+                AND seq = (SELECT MIN(seq) FROM jobs WHERE class_id = ? AND state = 'waiting')""",
+                (job.class_id, job.class_id),
+            )
+        metrics.count("jobs_done", stage=job.stage)
+        return True
+
+    def fail(self, job: Job, error: str, retryable: bool = True) -> None:
+        """Hands [job] back to be tried again after a backoff, or marks it failed once it has had MAX_ATTEMPTS,
+        or straight away if it is not [retryable]. A failed job cancels the later stages of its class
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            held = conn.execute(
+                "SELECT attempts FROM jobs WHERE class_id = ? AND stage = ? AND state = 'leased' AND worker = ?",
+                (job.class_id, job.stage, job.worker),
+            ).fetchone()
+            if held is None:
+                return
+            if retryable and held[0] < MAX_ATTEMPTS:
+                conn.execute(
+                    """UPDATE jobs SET state = 'pending', worker = NULL, lease_expires = NULL, available_at = ?, error = ?
+                    WHERE class_id = ? AND stage = ?""",
+                    (now + RETRY_SECS * 2 ** (held[0] - 1), error, job.class_id, job.stage),
+                )
+                metrics.count("jobs_retried", stage=job.stage)
+            else:
+                self._mark_failed(conn, job.class_id, job.stage, error, now)
+
+    def retry(self, class_ids: Optional[list[str]] = None) -> int:
+        """Queues the failed stage of [class_ids], or of every failed class, again with fresh attempts
+        returns the number of classes requeued
+        """
+        with self._transaction() as conn:
+            query = "SELECT DISTINCT class_id FROM jobs WHERE state = 'failed'"
+            failed = [r[0] for r in conn.execute(query).fetchall()]
+            if class_ids is not None:
+                wanted = {download_schoo.parse_url(c) for c in class_ids}
+                failed = [c for c in failed if c in wanted]
+            for class_id in failed:
+                conn.execute(
+                    """UPDATE jobs SET state = 'pending', attempts = 0, available_at = 0, error = NULL
+                    WHERE class_id = ? AND state = 'failed'""",
+                    (class_id,),
+                )
+                conn.execute(
+                    "UPDATE jobs SET state = 'waiting' WHERE class_id = ? AND state = 'cancelled'",
+                    (class_id,),
+                )
+        return len(failed)
+
+    def remaining(self, stages: list[str]) -> int:
+        """returns how many jobs of [stages] are not finished one way or another"""
+        marks = ",".join("?" for _ in stages)
+        with contextlib.closing(sqlite3.connect(self.path, timeout=60)) as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE stage IN ({marks}) AND state IN ('waiting', 'pending', 'leased')",
+                stages,
+            ).fetchone()[0]
+
+    def status(self, window_secs: float = THROUGHPUT_SECS) -> dict[str, Any]:
+        """returns the number of jobs in every state per stage, the jobs finished per stage in the last [window_secs]
+        with their mean run time, the active leases, and the most recent failures
+        """
+        now = time.time()
+        with contextlib.closing(sqlite3.connect(self.path, timeout=60)) as conn:
+            depth: dict[str, dict[str, int]] = {
+                stage: {state: 0 for state in STATES} for stage in STAGES
+            }
+            for stage, state, n in conn.execute(
+                "SELECT stage, state, COUNT(*) FROM jobs GROUP BY stage, state"
+            ).fetchall():
+                depth.setdefault(stage, {s: 0 for s in STATES})[state] = n
+            throughput = {}
+            for stage, n, secs in conn.execute(
+                "SELECT stage, COUNT(*), AVG(finished - started) FROM jobs WHERE state = 'done' AND finished >= ? GROUP BY stage",
+                (now - window_secs,),
+            ).fetchall():
+                throughput[stage] = {
+                    "done": n,
+                    "per_hour": round(n * 3600 / window_secs, 2),
+                    "mean_secs": round(secs or 0, 1),
+                }
+            leases = [
+                {
+                    "class_id": class_id,
+                    "stage": stage,
+                    "worker": worker,
+                    "attempt": attempts,
+                    "running_secs": round(now - started, 1),
+                    "expires_in": round(expires - now, 1),
+                }
+                for class_id, stage, worker, attempts, started, expires in conn.execute(
+                    "SELECT class_id, stage, worker, attempts, started, lease_expires FROM jobs WHERE state = 'leased' ORDER BY started"
+                ).fetchall()
+            ]
+            failures = [
+                {"class_id": class_id, "stage": stage, "error": error}
+                for class_id, stage, error in conn.execute(
+                    "SELECT class_id, stage, error FROM jobs WHERE state = 'failed' ORDER BY finished DESC LIMIT 10"
+                ).fetchall()
+            ]
+        return {
+            "depth": depth,
+            "throughput": throughput,
+            "window_secs": window_secs,
+            "leases": leases,
+            "failures": failures,
+        }
+
+
+def format_status(status: dict[str, Any]) -> str:
+    """Formats a [JobQueue.status] as tab separated tables"""
+    lines = ["stage\t" + "\t".join(STATES) + "\tdone/hour\tmean secs"]
+    for stage, counts in status["depth"].items():
+        t = status["throughput"].get(stage, {"per_hour": 0, "mean_secs": "-"})
+        cells = [str(counts.get(s, 0)) for s in STATES]
+        lines.append(f"{stage}\t" + "\t".join(cells) + f"\t{t['per_hour']}\t{t['mean_secs']}")
+    if len(status["leases"]) > 0:
+        lines.append("")
+        lines.append("class\tstage\tworker\tattempt\trunning secs\tlease left")
+        for l in status["leases"]:
+            expired = " (expired)" if l["expires_in"] < 0 else ""
+            lines.append(
+                f"{l['class_id']}\t{l['stage']}\t{l['worker']}\t{l['attempt']}\t{l['running_secs']}\t{l['expires_in']}{expired}"
+            )
+    if len(status["failures"]) > 0:
+        lines.append("")
+        lines.append("failed\tstage\terror")
+        for f in status["failures"]:
+            lines.append(f"{f['class_id']}\t{f['stage']}\t{f['error']}")
+    return "\n".join(lines)
+
+
+class Worker:
+    """Claims and runs jobs of [stages] from [job_queue] on [threads] threads, using the same stages as batch.make_stages.
+    Each thread keeps the state of the stages it ran, so e.g. a transcribing thread loads Whisper once.
+    A heartbeat thread renews the leases of every job held, until it is done
+
+    With [drain], the worker stops once nothing is left to do for its stages. Otherwise it polls for new jobs every [poll_secs]
+    [stage_options] are handed to batch.make_stages
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        stages: list[str],
+        threads: int = 1,
+        drain: bool = False,
+        poll_secs: float = POLL_SECS,
+        **stage_options,
+    ) -> None:
+        from skipping_schoo import batch
+
+        unknown = set(stages) - set(STAGES)
+        if len(unknown) > 0:
+            raise SkippingSchooError(f"Unknown stages {sorted(unknown)}, expected some of {STAGES}")
+        self.job_queue = job_queue
+        self.stages = stages
+        self.threads = max(1, threads)
+        self.drain = drain
+        self.poll_secs = poll_secs
+        self._stages = {
+            audio_only: {
+                s.name: s
+                for s in batch.make_stages(
+                    audio_only=audio_only, transcribe_workers=self.threads, **stage_options
+                )
+            }
+            for audio_only in (False, True)
+        }
+        self._held: dict[int, Job] = {}
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.completed = 0
+        self.failed = 0
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(HEARTBEAT_SECS):
+            with self._held_lock:
+                jobs = list(self._held.values())
+            for job in jobs:
+                try:
+                    if not job.lost.is_set() and not self.job_queue.heartbeat(job):
+                        log(f"[{job.class_id}] lost the lease on {job.stage}, another worker may be running it, abandoning it")
+                        job.lost.set()
+                except sqlite3.Error as e:
+                    log(f"Failed to renew the lease on {job.class_id} {job.stage}: {e}")
+
+    def _run_job(self, job: Job, states: dict[str, Any]) -> None:
+        from skipping_schoo import batch
+
+        stage = self._stages[job.audio_only][job.stage]
+        course = batch.Course(job.source)
+        for field in COURSE_FIELDS:
+            setattr(course, field, job.course.get(field))
+        if job.lost.is_set():
+            log(f"[{job.class_id}] lost the lease on {job.stage} before it started, leaving it to its new owner")
+            return
+        log(f"[{job.class_id}] running {job.stage}, attempt {job.attempts}")
+        try:
+            if job.stage not in states:
+                states[job.stage] = stage.init() if stage.init is not None else None
+            with metrics.span("job", stage=job.stage):
+                stage.run(course, states[job.stage])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            log(f"[{job.class_id}] failed at {job.stage}: {error}")
+            # e.g. a class id that is not on Schoo will not appear there on a retry, but a failed download may succeed
+            retryable = not isinstance(e, SkippingSchooError) or isinstance(e, RetryableError)
+            try:
+                self.job_queue.fail(job, error, retryable=retryable)
+            except sqlite3.Error as db_error:
+                # the lease runs out, and the job is retried by whichever worker claims it next
+                log(f"[{job.class_id}] failed to record the failure of {job.stage}: {db_error}")
+            self.failed += 1
+            return
+        if job.lost.is_set():
+            log(f"[{job.class_id}] finished {job.stage}, but its lease had been lost, so the result is not recorded")
+            return
+        try:
+            completed = self.job_queue.complete(job, {f: getattr(course, f) for f in COURSE_FIELDS})
+        except sqlite3.Error as e:
+            log(f"[{job.class_id}] finished {job.stage}, but failed to record it, so it will be run again: {e}")
+            return
+        if completed:
+            log(f"[{job.class_id}] finished {job.stage}")
+            self.completed += 1
+        else:
+            log(f"[{job.class_id}] finished {job.stage}, but its lease had been lost, so the result is not recorded")
+
+    def _work(self, index: int) -> None:
+        worker_id = make_worker_id(index)
+        states: dict[str, Any] = {}
+        while not self._stop.is_set():
+            job = self.job_queue.claim(worker_id, self.stages)
+            if job is None:
+                if self.drain and self.job_queue.remaining(self.stages) == 0:
+                    return
+                self._stop.wait(self.poll_secs)
+                continue
+            with self._held_lock:
+                self._held[index] = job
+            try:
+                self._run_job(job, states)
+            finally:
+                with self._held_lock:
+                    del self._held[index]
+
+    def run(self) -> None:
+        """Works until drained, or until interrupted"""
+        log(f"Working on {', '.join(self.stages)} with {self.threads} thread(s) from {self.job_queue.path}")
+        heartbeat = threading.Thread(target=self._heartbeat, name=f"{PROG}-heartbeat", daemon=True)
+        heartbeat.start()
+        threads = [
+            threading.Thread(target=self._work, args=(i,), name=f"{PROG}-{i}", daemon=True)
+            for i in range(self.threads)
+        ]
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+        except KeyboardInterrupt:
+            # the jobs under way keep their leases until they run out, and are then claimed by another worker
+            log("Interrupted, stopping")
+        finally:
+            self._stop.set()
+        log(f"Finished {self.completed} job(s), {self.failed} failed")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Queues courses, and runs their stages on workers claiming jobs from a shared queue",
+    )
+    parser.add_argument(
+        "--queue",
+        help=f"queue database. Defaults to ${QUEUE_ENV}, or 'queue' in the cache directory. Must be on a filesystem every worker shares",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add = subparsers.add_parser("add", help="queue Schoo urls or class ids")
+    add.add_argument("urls", nargs="*")
+    add.add_argument("-f", "--file", help="file containing one Schoo URL or course number per line")
+    add.add_argument(
+        "-a",
+        "--audio-only",
+        action="store_true",
+        help="if set, downloads only the audio straight into a 16khz mono wav file, skipping the video and the rip stage",
+    )
+    add.add_argument("--priority", type=int, default=0, help="higher priorities are worked on first")
+    add.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="if set, looks up the titles and m3u8 urls of the classes concurrently as they are queued, see crawl.py",
+    )
+
+    worker = subparsers.add_parser("worker", help="claim and run jobs")
+    worker.add_argument(
+        "-s",
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        help="the stages this machine takes, e.g. only transcribe on a machine with many cores",
+    )
+    worker.add_argument("-t", "--threads", type=int, default=1, help="jobs run at the same time")
+    worker.add_argument("--drain", action="store_true", help="if set, stops once no work is left for these stages")
+    worker.add_argument("--poll", type=float, default=POLL_SECS, help="seconds between looking for new jobs when idle")
+    worker.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="If set, overwrites the output of every stage if files from a previous run of the same class existed",
+    )
+    worker.add_argument(
+        "-c",
+        "--cleanup",
+        action="store_true",
+        help="if set, deletes the input of every stage once it is done, keeping only the final summary.txt",
+    )
+    worker.add_argument(
+        "-d",
+        "--downloader",
+        choices=download_schoo.DOWNLOADERS,
+        default=download_schoo.DOWNLOADER,
+    )
+    worker.add_argument("--no-cache", action="store_true", help="if set, ignores every cache, see batch.py")
+    worker.add_argument(
+        "--storage",
+        choices=storage.MODES,
+        default=storage.MODE,
+        help="compressed keeps audio and finished intermediate text compressed, see storage.py",
+    )
+    worker.add_argument(
+        "--metrics",
+        help="json lines file every timed span, request latency and the run's totals are appended to",
+    )
+    worker.add_argument("--prometheus", help="Prometheus textfile the worker's counters and stage times are written to")
+
+    status = subparsers.add_parser("status", help="print the queue depth and throughput of every stage")
+    status.add_argument("--json", action="store_true")
+    status.add_argument("--window", type=float, default=THROUGHPUT_SECS, help="seconds to measure throughput over")
+
+    retry = subparsers.add_parser("retry", help="queue failed classes again")
+    retry.add_argument("urls", nargs="*", help="classes to retry. Defaults to every failed class")
+
+    args = parser.parse_args()
+
+    job_queue = JobQueue(args.queue)
+    if args.command == "add":
+        from skipping_schoo import batch
+
+        sources = batch.read_sources(args.urls, args.file)
+        if len(sources) == 0:
+            parser.error("no urls or course numbers given")
+        added = job_queue.add(sources, audio_only=args.audio_only, priority=args.priority)
+        if args.prefetch:
+            from skipping_schoo import crawl
+
+            log(f"Prefetched class metadata: {json.dumps(crawl.prefetch(sources))}")
+        log(f"Queued {len(added)} class(es)")
+    elif args.command == "worker":
+        if "summarize" in args.stages:
+            from skipping_schoo import summarize
+
+            summarize.configure_backend()
+        metrics.configure(jsonl_path=args.metrics)
+        storage.MODE = args.storage
+        w = Worker(
+            job_queue,
+            args.stages,
+            threads=args.threads,
+            drain=args.drain,
+            poll_secs=args.poll,
+            overwrite=args.overwrite,
+            cleanup=args.cleanup,
+            downloader=args.downloader,
+            use_cache=not args.no_cache,
+        )
+        try:
+            w.run()
+        finally:
+            metrics.finish(args.prometheus)
+        return 0 if w.failed == 0 else 1
+    elif args.command == "status":
+        s = job_queue.status(args.window)
+        print(json.dumps(s, indent=2, ensure_ascii=False) if args.json else format_status(s))
+    else:
+        n = job_queue.retry(args.urls or None)
+        log(f"Requeued {n} class(es)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
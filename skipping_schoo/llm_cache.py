@@ -0,0 +1,207 @@
+# /usr/bin/python3
+""" This file is responsible for caching completion responses under a hash of the request that produced them"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Optional
+
+from skipping_schoo import utils
+
+PROG = "LLMCache"
+
+INDEX_NAME = "responses.sqlite3"
+# Responses older than this are requested again. Summaries do not go stale, so the default is long
+TTL_SECS = 90 * 24 * 60 * 60
+MAX_BYTES = 256 * 1024**2
+
+# Bump when the way requests are built changes in a way the key does not capture
+CACHE_VERSION = 1
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        response TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        tokens INTEGER NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)",
+    """CREATE TABLE IF NOT EXISTS stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )""",
+]
+
+_cache: Optional["ResponseCache"] = None
+_cache_lock = threading.Lock()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class ResponseCache:
+    """Stores completion responses keyed by the model, messages and sampling parameters of their request,
+    so a request already answered is never paid for again, whichever chunk, course or run it came from.
+
+    Entries expire after [ttl_secs], and once the stored responses take more than [max_bytes] the least recently used are evicted.
+    Hits, misses and the tokens that hits saved are counted across runs
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        ttl_secs: float = TTL_SECS,
+        max_bytes: int = MAX_BYTES,
+    ) -> None:
+        self.directory = directory or utils.get_cache_dir("responses")
+        self.ttl_secs = ttl_secs
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        with self._connect() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(os.path.join(self.directory, INDEX_NAME), timeout=30)
+
+    @staticmethod
+    def key(request: dict[str, Any]) -> str:
+        """returns the key of [request], the keyword arguments of a completion call: model, messages and sampling parameters"""
+        encoded = json.dumps(
+            {"version": CACHE_VERSION, "request": request},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(encoded.encode(utils.ENCODING)).hexdigest()
+
+    def _count(self, conn: sqlite3.Connection, name: str, n: int = 1) -> None:
+        conn.execute("INSERT OR IGNORE INTO stats (name) VALUES (?)", (name,))
+        conn.execute("UPDATE stats SET value = value + ? WHERE name = ?", (n, name))
+
+    def get(self, key: str) -> Optional[str]:
+        """returns the response stored under [key], or None if there is none or it has expired"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response, tokens, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[2] > self.ttl_secs:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._count(conn, "expired")
+                row = None
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._count(conn, "hits")
+            self._count(conn, "tokens_saved", row[1])
+        return row[0]
+
+    def put(self, key: str, model: str, response: str, tokens: int) -> None:
+        """Stores [response], which cost [tokens] in prompt and completion, then evicts down to the size cap"""
+        size = len(response.encode(utils.ENCODING))
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, tokens, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, tokens, now, now),
+            )
+        self.evict(keep=key)
+
+    def evict(self, max_bytes: Optional[int] = None, keep: Optional[str] = None) -> int:
+        """Deletes the expired responses, then the least recently used until the rest take at most [max_bytes]
+        returns the number of responses deleted
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        deleted = 0
+        with self._connect() as conn:
+            expired = conn.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_secs,)
+            ).rowcount
+            if expired > 0:
+                self._count(conn, "expired", expired)
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > limit:
+                freed = 0
+                for key, size in conn.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed ASC"
+                ).fetchall():
+                    if total - freed <= limit:
+                        break
+                    if key == keep:
+                        continue
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    freed += size
+                    deleted += 1
+                self._count(conn, "evictions", deleted)
+        if deleted > 0:
+            log(f"Evicted {deleted} least recently used responses")
+        return deleted + expired
+
+    def stats(self) -> dict[str, int]:
+        """returns the hits, misses, tokens saved, expirations and evictions so far, and the number and bytes of stored responses"""
+        with self._connect() as conn:
+            results = {
+                name: 0 for name in ("hits", "misses", "tokens_saved", "expired", "evictions")
+            }
+            results.update(conn.execute("SELECT name, value FROM stats").fetchall())
+            count, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        results["responses"] = count
+        results["bytes"] = size
+        return results
+
+    def clear(self) -> None:
+        """Deletes every response and resets the statistics"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+            conn.execute("DELETE FROM stats")
+
+
+def get_cache() -> ResponseCache:
+    """returns the response cache shared by the whole process"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Inspects and trims the cache of completion responses shared between runs",
+    )
+    parser.add_argument(
+        "--dir", help="cache directory. Defaults to 'responses' in the cache directory"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="print the hits, misses and tokens saved")
+    evict = subparsers.add_parser("evict", help="evict expired responses, then down to a size")
+    evict.add_argument("max_mb", type=float)
+    subparsers.add_parser("clear", help="delete every response")
+
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.dir)
+    if args.command == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+    elif args.command == "evict":
+        deleted = cache.evict(max_bytes=int(args.max_mb * 1024 * 1024))
+        print(f"deleted {deleted} responses")
+    else:
+        cache.clear()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+""" This file is responsible for recording where the time goes: timed spans around every stage, counters, and optional profiles"""
+import datetime
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from skipping_schoo import utils
+
+PROG = "Metrics"
+
+PROMETHEUS_PREFIX = "skipping_schoo"
+# functions listed in each per-stage profile report, by cumulative time
+PROFILE_TOP = 30
+MEMORY_TOP = 15
+
+_lock = threading.Lock()
+_local = threading.local()
+_counters: dict[tuple[str, tuple], float] = {}
+# count, sum and max of each observed value, such as a request latency
+_observations: dict[tuple[str, tuple], list[float]] = {}
+_spans: dict[str, list[float]] = {}
+_span_ids = iter(range(1, sys.maxsize))
+
+_jsonl_path: Optional[str] = None
+_profile_dir: Optional[str] = None
+_profile_counts: dict[str, int] = {}
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def configure(jsonl_path: Optional[str] = None, profile_dir: Optional[str] = None) -> None:
+    """With [jsonl_path], every finished span and observation is appended there as a json line.
+    With [profile_dir], every stage is run under cProfile and tracemalloc, and its report is written there
+    """
+    global _jsonl_path, _profile_dir
+    _jsonl_path = jsonl_path
+    _profile_dir = profile_dir
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def _key(name: str, labels: dict[str, Any]) -> tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _emit(record: dict[str, Any]) -> None:
+    if _jsonl_path is None:
+        return
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _lock:
+        with open(_jsonl_path, "a", encoding=utils.ENCODING) as f:
+            f.write(line)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    """Adds [value] to the counter [name], e.g. bytes downloaded or tokens sent.
+    [labels] should only take a few values, such as a stage name, since every combination is exported"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Records one measurement of [name], e.g. the latency of a request. The count, sum and max are exported,
+    and every measurement is written to the json lines"""
+    key = _key(name, labels)
+    with _lock:
+        entry = _observations.setdefault(key, [0, 0.0, value])
+        entry[0] += 1
+        entry[1] += value
+        entry[2] = max(entry[2], value)
+    _emit({"type": "observation", "name": name, "value": value, "labels": labels, "time": time.time()})
+
+
+class _Span:
+    def __init__(self, name: str, labels: dict[str, Any], profile: bool) -> None:
+        self.name = name
+        self.labels = labels
+        self.profile = profile and _profile_dir is not None
+        self.id = next(_span_ids)
+        self._profiler = None
+
+    def __enter__(self) -> "_Span":
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].id if len(stack) > 0 else None
+        # cProfile allows one profiler per thread, so a stage inside a profiled stage is only covered by the outer profile
+        if self.profile and not any(s._profiler is not None for s in stack):
+            import cProfile
+            import tracemalloc
+
+            tracemalloc.reset_peak()
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        stack.append(self)
+        self.started = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        secs = time.perf_counter() - self._start
+        _local.stack.pop()
+        record = {
+            "type": "span",
+            "name": self.name,
+            "id": self.id,
+            "parent": self.parent,
+            "thread": threading.current_thread().name,
+            "start": self.started,
+            "secs": round(secs, 6),
+            "labels": self.labels,
+            "error": None if exc_type is None else exc_type.__name__,
+        }
+        if self._profiler is not None:
+            self._profiler.disable()
+            record.update(_write_profile(self.name, self._profiler))
+        with _lock:
+            entry = _spans.setdefault(self.name, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += secs
+            entry[2] += exc_type is not None
+        _emit(record)
+
+
+def span(name: str, profile: bool = False, **labels) -> _Span:
+    """A context manager timing the code it wraps. Spans nest, each recording the id of the span it started in.
+    With [profile], the span is profiled when profiling was turned on with [configure]"""
+    return _Span(name, labels, profile)
+
+
+def stage(name: str) -> Callable:
+    """Decorates the function running a pipeline stage, timing every call in a profiled span named [name]"""
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, profile=True):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _write_profile(name: str, profiler) -> dict[str, Any]:
+    """Writes the cProfile stats of a stage, and a report of its slowest functions and largest allocations
+    returns the paths written and the peak memory of the stage"""
+    import io
+    import pstats
+    import tracemalloc
+
+    with _lock:
+        n = _profile_counts.get(name, 0)
+        _profile_counts[name] = n + 1
+    base = os.path.join(_profile_dir, f"{name}-{os.getpid()}-{n}")
+    profiler.dump_stats(f"{base}.prof")
+    _, traced_peak = tracemalloc.get_traced_memory()
+    held = tracemalloc.take_snapshot()
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    report.write(f"\nPeak traced Python memory: {round(traced_peak / 1024**2, 1)} MB\n")
+    report.write(f"Peak process memory: {_peak_rss_mb()} MB\n")
+    report.write(f"\nLargest allocations still held at the end of {name}:\n")
+    for stat in held.statistics("lineno")[:MEMORY_TOP]:
+        report.write(f"{stat}\n")
+    with open(f"{base}.txt", "w", encoding=utils.ENCODING) as f:
+        f.write(report.getvalue())
+    return {
+        "profile": f"{base}.prof",
+        # traced Python allocations only start counting from this stage, but the process peak covers the whole run
+        "peak_traced_mb": round(traced_peak / 1024**2, 1),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def snapshot() -> dict[str, Any]:
+    """returns the totals of every counter, observation and span so far"""
+    with _lock:
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in _counters.items()
+            ],
+            "observations": [
+                {"name": name, "labels": dict(labels), "count": c, "sum": round(s, 6), "max": round(m, 6)}
+                for (name, labels), (c, s, m) in _observations.items()
+            ],
+            "spans": [
+                {"name": name, "count": c, "secs": round(s, 6), "errors": e}
+                for name, (c, s, e) in _spans.items()
+            ],
+        }
+
+
+def _labels_text(labels: dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    pairs = []
+    for k, v in sorted(labels.items()):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{k}="{v}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_prometheus(data: Optional[dict[str, Any]] = None) -> str:
+    """Formats a [snapshot] in the Prometheus text format, e.g. for node_exporter's textfile collector.
+    Every metric family is written as one block under its TYPE line, and within a family, samples of the same name are kept together
+    """
+    data = data or snapshot()
+    # metric family -> its type, and the (sample name, line) of each of its samples
+    families: dict[str, tuple[str, list[tuple[str, str]]]] = {}
+
+    def add(family: str, kind: str, labels: dict, value: float, suffix: str = "") -> None:
+        sample = f"{family}{suffix}"
+        families.setdefault(family, (kind, []))[1].append(
+            (sample, f"{sample}{_labels_text(labels)} {value}")
+        )
+
+    for c in sorted(data["counters"], key=lambda c: c["name"]):
+        add(f"{PROMETHEUS_PREFIX}_{c['name']}_total", "counter", c["labels"], c["value"])
+    for o in sorted(data["observations"], key=lambda o: o["name"]):
+        metric = f"{PROMETHEUS_PREFIX}_{o['name']}"
+        add(metric, "summary", o["labels"], o["count"], suffix="_count")
+        add(metric, "summary", o["labels"], o["sum"], suffix="_sum")
+        add(f"{metric}_max", "gauge", o["labels"], o["max"])
+    for s in sorted(data["spans"], key=lambda s: s["name"]):
+        labels = {"span": s["name"]}
+        add(f"{PROMETHEUS_PREFIX}_span_seconds_total", "counter", labels, s["secs"])
+        add(f"{PROMETHEUS_PREFIX}_span_count_total", "counter", labels, s["count"])
+        add(f"{PROMETHEUS_PREFIX}_span_errors_total", "counter", labels, s["errors"])
+    add(
+        f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds",
+        "gauge",
+        {},
+        round(datetime.datetime.now().timestamp()),
+    )
+    lines: list[str] = []
+    for family, (kind, samples) in families.items():
+        lines.append(f"# TYPE {family} {kind}")
+        # the sort is stable, so e.g. all _count samples of a summary come first, each in the order it was added
+        lines.extend(line for _, line in sorted(samples, key=lambda sample: sample[0]))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str) -> str:
+    """Writes the totals so far to the Prometheus textfile at [path], replacing it atomically so a scrape never reads half of it"""
+    utils.write_text_atomic(path, format_prometheus())
+    return path
+
+
+def finish(prometheus_path: Optional[str] = None) -> None:
+    """Writes the totals of the run to the json lines, and to [prometheus_path] if given"""
+    data = snapshot()
+    _emit({"type": "totals", "time": time.time(), **data})
+    for s in sorted(data["spans"], key=lambda s: -s["secs"]):
+        log(f"{s['name']}: {s['count']} runs, {round(s['secs'], 2)} seconds in total")
+    if prometheus_path is not None:
+        write_prometheus(prometheus_path)
+        log(f"Metrics written to {prometheus_path}")
@@ -0,0 +1,76 @@
+""" This file is responsible for caching fetched web pages on disk, revalidating them with conditional GETs"""
+import hashlib
+import json
+import os
+from typing import Optional
+
+from skipping_schoo import http_client
+from skipping_schoo import utils
+
+PROG = "PageCache"
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class Page:
+    def __init__(self, url: str, status_code: int, text: str, from_cache: bool) -> None:
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.from_cache = from_cache
+
+
+class PageCache:
+    """Stores page bodies keyed by a hash of their url, along with their ETag and Last-Modified headers.
+    A cached page is revalidated with If-None-Match / If-Modified-Since, so an unchanged page is not transferred again
+    """
+
+    def __init__(self, directory: Optional[str] = None, session=None) -> None:
+        self.directory = directory or utils.get_cache_dir("pages")
+        os.makedirs(self.directory, exist_ok=True)
+        self.session = session
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode(utils.ENCODING)).hexdigest()
+        base = os.path.join(self.directory, key)
+        return f"{base}.html", f"{base}.json"
+
+    def _load(self, url: str) -> tuple[Optional[dict], Optional[str]]:
+        body_path, meta_path = self._paths(url)
+        if not os.path.exists(body_path) or not os.path.exists(meta_path):
+            return None, None
+        with open(meta_path, "r", encoding=utils.ENCODING) as f:
+            meta = json.load(f)
+        with open(body_path, "r", encoding=utils.ENCODING) as f:
+            return meta, f.read()
+
+    def _store(self, url: str, text: str, headers) -> None:
+        body_path, meta_path = self._paths(url)
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+        # the body is replaced before the metadata, so a torn write never pairs new validators with an old body
+        utils.write_text_atomic(body_path, text)
+        utils.write_text_atomic(meta_path, json.dumps(meta))
+
+    def get(self, url: str) -> Page:
+        """Fetches [url], answering from the cache when the server reports it unchanged"""
+        meta, cached = self._load(url)
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        session = self.session or http_client.get_session()
+        r = session.get(url, headers=headers, timeout=http_client.TIMEOUT)
+        if r.status_code == 304 and cached is not None:
+            log(f"{url} unchanged, using cached copy")
+            return Page(url, 200, cached, True)
+        if r.status_code == 200:
+            self._store(url, r.text, r.headers)
+        return Page(url, r.status_code, r.text, False)
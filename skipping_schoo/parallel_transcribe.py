@@ -0,0 +1,357 @@
+# /usr/bin/python3
+# -*- coding: UTF-8 -*-
+""" This file is responsible for transcribing one long recording on many cores, by splitting it at silences and transcribing the pieces in parallel"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from skipping_schoo import metrics
+from skipping_schoo import rip_audio
+from skipping_schoo import segments as structured
+from skipping_schoo import transscribe
+from skipping_schoo import utils
+
+PROG = "ParallelTranscribe"
+
+PROCESSES = max(1, (os.cpu_count() or 1) // 8)
+SILENCE_NOISE_DB = -35
+SILENCE_MIN_SECS = 0.5
+# a cut may move this far, as a fraction of the span length, to land in a silence
+SILENCE_SEARCH_FRACTION = 0.25
+
+_SILENCE_START_RE = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_SILENCE_END_RE = re.compile(r"silence_end: (-?\d+(?:\.\d+)?)")
+
+# each worker process holds its own model, loaded once by _init_worker
+_whisper = None
+_language = transscribe.LANGUAGE
+_settings: dict = {}
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def detect_silences(
+    input_filename: str,
+    noise_db: float = SILENCE_NOISE_DB,
+    min_silence_secs: float = SILENCE_MIN_SECS,
+) -> list[tuple[float, float]]:
+    """Uses FFMPEG's silencedetect filter to find the quiet stretches of the audio
+    returns (start, end) of every silence, in seconds
+    """
+    args = [
+        "ffmpeg",
+        "-nostdin",
+        "-i",
+        input_filename,
+        "-af",
+        f"silencedetect=noise={noise_db}dB:d={min_silence_secs}",
+        "-f",
+        "null",
+        "-",
+    ]
+    x = subprocess.run(args, stderr=subprocess.PIPE, encoding="utf8", errors="replace")
+    x.check_returncode()
+    silences = []
+    start: Optional[float] = None
+    for line in x.stderr.splitlines():
+        m = _SILENCE_START_RE.search(line)
+        if m is not None:
+            start = max(0.0, float(m.group(1)))
+            continue
+        m = _SILENCE_END_RE.search(line)
+        if m is not None and start is not None:
+            silences.append((start, float(m.group(1))))
+            start = None
+    log(f"Found {len(silences)} silences")
+    return silences
+
+
+def plan_spans(
+    duration: float,
+    silences: list[tuple[float, float]],
+    spans: int,
+    search_fraction: float = SILENCE_SEARCH_FRACTION,
+) -> list[tuple[float, float]]:
+    """Splits [duration] seconds into [spans] roughly equal (start, end) pieces.
+    Each cut is moved to the middle of the nearest silence, if one is close enough, so that no word is cut in half
+    """
+    if spans <= 1 or duration <= 0:
+        return [(0.0, duration)]
+    length = duration / spans
+    midpoints = [(s + e) / 2 for s, e in silences]
+    cuts = [0.0]
+    for k in range(1, spans):
+        target = k * length
+        nearest = min(midpoints, key=lambda m: abs(m - target), default=None)
+        if nearest is not None and abs(nearest - target) <= length * search_fraction:
+            target = nearest
+        if target > cuts[-1]:
+            cuts.append(target)
+    cuts.append(duration)
+    return [(cuts[i], cuts[i + 1]) for i in range(len(cuts) - 1)]
+
+
+def _init_worker(settings: dict, language: str) -> None:
+    """[settings] are resolved by the parent, see transscribe.get_settings, so that every worker uses the same ones"""
+    global _whisper, _language, _settings
+    _whisper = transscribe.load_model(
+        settings["model_size"],
+        device=settings["device"],
+        compute_type=settings["compute_type"],
+        cpu_threads=settings["cpu_threads"],
+        num_workers=settings["num_workers"],
+    )
+    _language = language
+    _settings = settings
+
+
+def _transcribe_span(
+    input_filename: str, start: float, end: Optional[float]
+) -> list[dict]:
+    """Transcribes the audio between [start] and [end] in a worker process. An [end] of None reads to the end of the file
+    returns the segment records, see segments.to_record, with timestamps shifted to absolute time
+    """
+    samples = rip_audio.load_samples(input_filename)
+    if samples is None:
+        duration = None if end is None else end - start
+        audio = rip_audio.decode_samples(input_filename, start=start, duration=duration)
+    else:
+        # every worker maps the same file, so the audio sits in the page cache once however many workers there are
+        stop = None if end is None else int(end * rip_audio.SAMPLE_RATE)
+        audio = samples[int(start * rip_audio.SAMPLE_RATE) : stop]
+    segments, _ = _whisper.transcribe(
+        audio,
+        language=_language,
+        word_timestamps=transscribe.WORD_TIMESTAMPS,
+        beam_size=_settings["beam_size"],
+        vad_filter=_settings["vad_filter"],
+    )
+    return [structured.to_record(seg, start) for seg in segments]
+
+
+def transcribe_spans(
+    input_filename: str,
+    spans: list[tuple[float, float]],
+    processes: int = PROCESSES,
+    model_size: Optional[str] = None,
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
+    language: str = transscribe.LANGUAGE,
+    beam_size: Optional[int] = None,
+    vad_filter: Optional[bool] = None,
+) -> list[dict]:
+    """Transcribes every span in a pool of [processes] workers, each holding its own model
+    Settings left as None are taken from transscribe.get_settings, except the threads, which are split between the workers
+    returns all segments in order
+    """
+    settings = transscribe.get_settings(
+        model_size=model_size,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=utils.cpu_threads_per_worker(processes),
+        beam_size=beam_size,
+        vad_filter=vad_filter,
+    )
+    log(
+        f"Transcribing {len(spans)} spans on {processes} processes with {settings['cpu_threads']} thread(s) each"
+    )
+    # the duration the spans were planned with may fall a little short of the audio, so the last span is left open-ended
+    bounds: list[tuple[float, Optional[float]]] = list(spans[:-1]) + [(spans[-1][0], None)]
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(settings, language),
+    ) as pool:
+        futures = [
+            pool.submit(_transcribe_span, input_filename, start, end)
+            for start, end in bounds
+        ]
+        merged = []
+        for i, future in enumerate(futures):
+            merged.extend(future.result())
+            log(f"\rSpan {i + 1} of {len(spans)} transcribed", end="\r")
+    utils.eprint("", end="\r")
+    return merged
+
+
+@metrics.stage("transcribe")
+def transcribe_parallel(
+    input_filename: str,
+    processes: int = PROCESSES,
+    model_size: Optional[str] = None,
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
+    language: str = transscribe.LANGUAGE,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    beam_size: Optional[int] = None,
+    vad_filter: Optional[bool] = None,
+) -> str:
+    """Uses Whisper on [processes] cores at once to create a transcript, in the same format as transscribe.transcribe"""
+    full_path_out = transscribe.get_transcript_path(input_filename)
+    params = transscribe.artifact_params(
+        model_size=model_size,
+        device=device,
+        compute_type=compute_type,
+        language=language,
+        beam_size=beam_size,
+        vad_filter=vad_filter,
+        split=True,
+    )
+    if not overwrite and transscribe.is_complete_with(full_path_out, params):
+        log(
+            f"Transcription file already existed at {full_path_out}, and overwrite is set to false. Skipping transcribe step"
+        )
+        return full_path_out
+
+    runtime_secs = transscribe.get_runtime_secs(input_filename)
+    log(f"file is {round(runtime_secs, 2)} seconds  / {round(runtime_secs / 60, 2) } minutes long")
+    starttime = datetime.datetime.now()
+    spans = plan_spans(runtime_secs, detect_silences(input_filename), processes)
+    segments = transcribe_spans(
+        input_filename,
+        spans,
+        processes=processes,
+        model_size=model_size,
+        device=device,
+        compute_type=compute_type,
+        language=language,
+        beam_size=beam_size,
+        vad_filter=vad_filter,
+    )
+    # the spans finish out of order, so the transcript is written in one go and only then marked complete
+    structured.write_all(full_path_out, segments)
+    metrics.count("segments", len(segments), stage="transcribe")
+    metrics.count("audio_seconds", runtime_secs, stage="transcribe")
+    transcript = "".join(
+        f"{transscribe.format_segment(s['start'], s['end'], s['text'])}\n" for s in segments
+    )
+    utils.write_text_atomic(full_path_out, transcript)
+    transscribe.write_checkpoint(
+        full_path_out,
+        runtime_secs,
+        os.path.getsize(full_path_out),
+        complete=True,
+        params=params,
+    )
+    mins = (datetime.datetime.now() - starttime).total_seconds() / 60
+    log(
+        f"Finished transcribing, took {mins} minutes, output written to {full_path_out}"
+    )
+    if cleanup:
+        log(f"Cleanup set to true, deleting input audio at {input_filename}")
+        os.unlink(input_filename)
+        rip_audio.remove_samples(input_filename)
+    return full_path_out
+
+
+def compare_with_serial(
+    input_filename: str,
+    processes: int = PROCESSES,
+    model_size: Optional[str] = None,
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
+    language: str = transscribe.LANGUAGE,
+) -> dict[str, float]:
+    """Times the serial path (one model over the whole file) against the parallel path on the same audio.
+    Model loading is excluded from the serial time, and included in the parallel time, so the speedup is conservative
+    """
+    whisper = transscribe.load_model(model_size, device=device, compute_type=compute_type)
+    start = datetime.datetime.now()
+    settings = transscribe.get_settings()
+    segments, _ = whisper.transcribe(
+        input_filename,
+        language=language,
+        beam_size=settings["beam_size"],
+        vad_filter=settings["vad_filter"],
+    )
+    serial_count = sum(1 for _ in segments)
+    serial_secs = (datetime.datetime.now() - start).total_seconds()
+    del whisper
+
+    runtime_secs = transscribe.get_runtime_secs(input_filename)
+    start = datetime.datetime.now()
+    spans = plan_spans(runtime_secs, detect_silences(input_filename), processes)
+    parallel_count = len(
+        transcribe_spans(
+            input_filename,
+            spans,
+            processes=processes,
+            model_size=model_size,
+            device=device,
+            compute_type=compute_type,
+            language=language,
+        )
+    )
+    parallel_secs = (datetime.datetime.now() - start).total_seconds()
+    result = {
+        "audio_secs": runtime_secs,
+        "processes": processes,
+        "serial_secs": round(serial_secs, 2),
+        "parallel_secs": round(parallel_secs, 2),
+        "speedup": round(serial_secs / max(parallel_secs, 0.001), 2),
+        "serial_segments": serial_count,
+        "parallel_segments": parallel_count,
+    }
+    log(
+        f"Serial took {result['serial_secs']}s, parallel took {result['parallel_secs']}s on {processes} processes: {result['speedup']}x speedup"
+    )
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Produces a transcript of a .wav file, transcribing pieces split at silences on several processes",
+    )
+    parser.add_argument("audio_file")
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=PROCESSES,
+        help="number of worker processes, each holding its own Whisper model",
+    )
+    parser.add_argument(
+        "-c",
+        "--cleanup",
+        action="store_true",
+        help="if set, will delete the source audio after transcribing",
+    )
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="if set, will overwrite any existing files on disk related to previous extraction attempts on the input video",
+    )
+    parser.add_argument(
+        "--compare-serial",
+        action="store_true",
+        help="if set, transcribes the file both serially and in parallel, and reports the speedup instead of writing a transcript",
+    )
+
+    args = parser.parse_args()
+
+    if args.compare_serial:
+        compare_with_serial(args.audio_file, processes=args.processes)
+        return 0
+    transcribe_parallel(
+        args.audio_file,
+        processes=args.processes,
+        overwrite=args.overwrite,
+        cleanup=args.cleanup,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+""" This file is responsible for keeping concurrent OpenAI requests within the request and token budgets of the account"""
+import random
+import re
+import threading
+import time
+from typing import Mapping, Optional, Union
+
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 90000
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 60 * 60}
+
+
+def parse_duration(remaining: Union[str, int, float, None]) -> Optional[float]:
+    """Given a duration as found in the x-ratelimit-reset-* headers, e.g. '1s', '6m0s', '20ms' or '0.5s',
+    returns the duration in seconds, or None if it could not be understood
+    """
+    if remaining is None:
+        return None
+    if isinstance(remaining, (int, float)):
+        return float(remaining)
+    text = remaining.strip().lower()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(text)
+    if len(parts) == 0:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def backoff_delay(
+    attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP
+) -> float:
+    """Exponential backoff with full jitter: a random delay between 0 and min(cap, base * 2^attempt)"""
+    return random.uniform(0, min(cap, base * (2**attempt)))
+
+
+class _Bucket:
+    """A token bucket holding at most [capacity], refilled evenly over one minute"""
+
+    def __init__(self, capacity: float) -> None:
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.capacity / 60
+        )
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until [amount] can be taken. Requests larger than the bucket only wait for a full bucket"""
+        missing = min(amount, self.capacity) - self.level
+        if missing <= 0:
+            return 0
+        return missing * 60 / self.capacity
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], now: float) -> None:
+        """Corrects the bucket with the budget the server reported"""
+        if limit is not None and limit > 0:
+            self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.capacity, remaining)
+            self.updated = now
+
+
+class RateLimiter:
+    """Shared between every thread sending requests. Tracks one bucket for requests and one for tokens,
+    and corrects both with the budgets reported in the x-ratelimit-* response headers
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = TOKENS_PER_MINUTE,
+    ) -> None:
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> float:
+        """Blocks until one request of [tokens] tokens fits within both budgets, then takes it
+        returns the number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+                wait_for = max(
+                    self._blocked_until - now,
+                    self._requests.wait_time(1),
+                    self._tokens.wait_time(tokens),
+                )
+                if wait_for <= 0:
+                    self._requests.level -= 1
+                    self._tokens.level -= min(tokens, self._tokens.capacity)
+                    return waited
+            time.sleep(wait_for)
+            waited += wait_for
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]]) -> None:
+        """Applies the x-ratelimit-limit-*, x-ratelimit-remaining-* and x-ratelimit-reset-* headers of a response"""
+        if not headers:
+            return
+        headers = {k.lower(): v for k, v in headers.items()}
+        with self._lock:
+            now = time.monotonic()
+            for kind, bucket in (("requests", self._requests), ("tokens", self._tokens)):
+                remaining = _to_float(headers.get(f"x-ratelimit-remaining-{kind}"))
+                bucket.refill(now)
+                bucket.sync(
+                    _to_float(headers.get(f"x-ratelimit-limit-{kind}")), remaining, now
+                )
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining is not None and remaining <= 0 and reset is not None:
+                    self._blocked_until = max(self._blocked_until, now + reset)
+
+    def block_for(self, seconds: float) -> None:
+        """Stops every thread from sending for [seconds], e.g. after the server refused a request"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
@@ -1,51 +1,222 @@
 # /usr/bin/python3
-""" This file is responsible for splitting the audio of an mp4 file into a single 16khz mono wav file """
+""" This file is responsible for splitting the audio of an mp4 file into a single 16khz mono wav file, and the same audio as raw float32 samples """
 import datetime
+import json
 import os, sys, subprocess
 import argparse
+from typing import Optional
+from skipping_schoo import metrics
+from skipping_schoo import storage
 from skipping_schoo import utils
 
 PROG = "RipAudio"
 
+SAMPLE_RATE = 16000
+CHANNELS = 1
+# next to the wav file, the same audio as raw float32 samples, which Whisper takes as they are. See [load_samples]
+SAMPLES_SUFFIX = ".f32"
+HEADER_SUFFIX = ".f32.json"
+SAMPLES_DTYPE = "float32"
+
 
 def log(msg: str, end="\n") -> None:
     utils.log(msg, end=end, prog=PROG)
 
 
+def ffmpeg_audio_args(codec: str = "pcm_s16le", bitrate: Optional[str] = None) -> list[str]:
+    """FFMPEG output arguments dropping any video, and resampling the audio to 16khz mono"""
+    args = [
+        "-vn",
+        "-acodec",
+        codec,
+        "-ac",
+        str(CHANNELS),
+        "-ar",
+        str(SAMPLE_RATE),
+    ]
+    if bitrate is not None:
+        args += ["-b:a", bitrate]
+    return args
+
+
+def ffmpeg_output_args(path: str) -> list[str]:
+    """FFMPEG output arguments writing 16khz mono audio to [path], in the format its extension names, see storage.AUDIO_CODECS"""
+    return ffmpeg_audio_args(*storage.audio_codec(path))
+
+
+def artifact_params() -> dict:
+    """Everything besides the input file that changes the ripped audio, for keying the artifact cache"""
+    return {"args": ffmpeg_output_args(f"audio.{storage.audio_extension()}")}
+
+
+def get_output_path(input_filename: str, output_filename: str) -> str:
+    """Returns the path [rip] writes [output_filename] to"""
+    return os.path.join(utils.get_output_directory_path(input_filename), output_filename)
+
+
+def decode_samples(
+    input_filename: str, start: float = 0.0, duration: Optional[float] = None
+):
+    """Uses FFMPEG to decode any audio source ffmpeg can read, including a remote m3u8 playlist,
+    straight into memory as 16khz mono float32 samples, without writing anything to disk
+    [start] and [duration] in seconds select only part of the audio
+
+    returns a numpy array of the samples
+    """
+    import numpy as np
+
+    log(f"Decoding audio of '{input_filename}' into memory")
+    args = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+    if start > 0:
+        args += ["-ss", str(start)]
+    args += ["-i", input_filename]
+    if duration is not None:
+        args += ["-t", str(duration)]
+    args += [
+        *ffmpeg_audio_args("pcm_f32le"),
+        "-f",
+        "f32le",
+        "-",
+    ]
+    x = subprocess.run(args, stdout=subprocess.PIPE)
+    x.check_returncode()
+    samples = np.frombuffer(x.stdout, dtype=np.float32)
+    log(f"Decoded {round(len(samples) / SAMPLE_RATE, 2)} seconds of audio")
+    return samples
+
+
+def get_samples_path(wav_path: str) -> str:
+    """Returns the path of the raw float32 samples kept next to [wav_path]"""
+    base, _ = os.path.splitext(wav_path)
+    return f"{base}{SAMPLES_SUFFIX}"
+
+
+def _header_path(wav_path: str) -> str:
+    base, _ = os.path.splitext(wav_path)
+    return f"{base}{HEADER_SUFFIX}"
+
+
+def _samples_args(samples_path: str) -> list[str]:
+    return [*ffmpeg_audio_args("pcm_f32le"), "-f", "f32le", samples_path]
+
+
+def _write_header(wav_path: str, samples_path: str) -> None:
+    """Records the format and length of the samples. The header is written last, so samples without one are unfinished"""
+    samples = os.path.getsize(samples_path) // 4 // CHANNELS
+    header = {
+        "dtype": SAMPLES_DTYPE,
+        "sample_rate": SAMPLE_RATE,
+        "channels": CHANNELS,
+        "samples": samples,
+        "duration": samples / SAMPLE_RATE,
+        # the samples are only used while the wav they were made with is unchanged
+        "wav_bytes": os.path.getsize(wav_path),
+    }
+    utils.write_text_atomic(_header_path(wav_path), json.dumps(header))
+
+
+def read_header(wav_path: str) -> Optional[dict]:
+    """returns the header of the samples kept next to [wav_path], or None if there are none, or they were made from another wav"""
+    try:
+        with open(_header_path(wav_path), "r", encoding=utils.ENCODING) as f:
+            header = json.load(f)
+        if header["wav_bytes"] != os.path.getsize(wav_path):
+            return None
+        if os.path.getsize(get_samples_path(wav_path)) < header["samples"] * 4 * CHANNELS:
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return header
+
+
+def get_duration(wav_path: str) -> Optional[float]:
+    """returns the length of [wav_path] in seconds from the header of its samples, without starting any process. None if it has no samples"""
+    header = read_header(wav_path)
+    return None if header is None else header["duration"]
+
+
+def load_samples(wav_path: str):
+    """Memory maps the float32 samples kept next to [wav_path], so they can be handed to Whisper without decoding or copying them.
+    Pages are read as they are used, and shared with every other process mapping the same file
+    returns a read only numpy array of the samples, or None if there are none
+    """
+    header = read_header(wav_path)
+    if header is None:
+        return None
+    import numpy as np
+
+    if header["samples"] == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(
+        get_samples_path(wav_path), dtype=np.float32, mode="r", shape=(header["samples"],)
+    )
+
+
+def write_samples(wav_path: str, overwrite: bool = False) -> str:
+    """Decodes [wav_path] into the float32 samples kept next to it, e.g. for a wav ripped before they existed
+    returns the path of the samples
+    """
+    samples_path = get_samples_path(wav_path)
+    if not overwrite and read_header(wav_path) is not None:
+        return samples_path
+    tmp_path = f"{samples_path}.part"
+    args = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", wav_path, *_samples_args(tmp_path)]
+    x = subprocess.run(args, stdout=subprocess.PIPE)
+    x.check_returncode()
+    os.replace(tmp_path, samples_path)
+    _write_header(wav_path, samples_path)
+    return samples_path
+
+
+def remove_samples(wav_path: str) -> None:
+    """Deletes the samples kept next to [wav_path], if any"""
+    for path in (_header_path(wav_path), get_samples_path(wav_path)):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+@metrics.stage("rip")
 def rip(
     input_filename: str,
     output_filename: str,
     overwrite: bool = False,
     cleanup: bool = False,
 ) -> str:
-    """Uses FFMPEG to rip audio
+    """Uses FFMPEG to rip audio. The same decode also writes the audio as raw float32 samples next to the wav file,
+    which transcription memory maps instead of decoding the wav again, see [load_samples]
     returns the path of the output wav file
     """
 
-    output_path = utils.get_output_directory_path(input_filename)
     os.makedirs(utils.get_output_directory_path(input_filename), exist_ok=True)
-    full_path_out = os.path.join(output_path, output_filename)
+    full_path_out = get_output_path(input_filename, output_filename)
 
     if not overwrite and os.path.exists(full_path_out):
         log(
             f"Audio file already existed at {full_path_out}, and overwrite is set to false. Skipping rip step"
         )
+        if read_header(full_path_out) is None:
+            log(f"Writing the float32 samples of {full_path_out}")
+            write_samples(full_path_out)
     else:
         log(f"Ripping audio for file '{input_filename}' into '{full_path_out}'")
+        samples_path = get_samples_path(full_path_out)
+        tmp_path = f"{samples_path}.part"
+        # one decode of the input, two outputs. The samples are renamed into place only once they are complete
         args = [
             "ffmpeg",
+            "-y",
             "-i",
             input_filename,
-            "-acodec",
-            "pcm_s16le",
-            "-ac",
-            "1",
-            "-ar",
-            "16000",
+            *ffmpeg_output_args(full_path_out),
             full_path_out,
+            *_samples_args(tmp_path),
         ]
         x = subprocess.run(args, stdout=subprocess.PIPE)
         x.check_returncode()
+        os.replace(tmp_path, samples_path)
+        _write_header(full_path_out, samples_path)
+        metrics.count("input_bytes", os.path.getsize(input_filename), stage="rip")
+        metrics.count("output_bytes", os.path.getsize(full_path_out), stage="rip")
     if cleanup:
         log(f"Cleanup set to true, deleting input video at {input_filename}")
         os.unlink(input_filename)
@@ -73,7 +244,7 @@ def main() -> int:
 
     args = parser.parse_args()
 
-    output_filename = utils.make_output_filename(args.video_file, "wav")
+    output_filename = utils.make_output_filename(args.video_file, storage.audio_extension())
     rip(
         args.video_file,
         output_filename,
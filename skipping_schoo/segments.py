@@ -0,0 +1,289 @@
+# /usr/bin/python3
+""" This file is responsible for the structured transcript: every segment with its timing and confidence, indexed for random access by time"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import Any, Iterator, Optional
+
+from skipping_schoo import storage
+from skipping_schoo import utils
+
+PROG = "Segments"
+
+SEGMENTS_SUFFIX = ".segments.jsonl"
+INDEX_SUFFIX = ".segments.idx"
+
+INDEX_MAGIC = b"SSIDX\x00\x01\x00"
+# one fixed size record per segment, pointing at its line in the jsonl file
+_INDEX_FIELDS = [
+    ("start", "<f8"),
+    ("end", "<f8"),
+    ("avg_logprob", "<f4"),
+    ("no_speech_prob", "<f4"),
+    ("offset", "<u8"),
+    ("length", "<u4"),
+]
+_RECORD = struct.Struct("<ddffQI")
+RECORD_BYTES = _RECORD.size
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def get_segments_path(transcript_path: str) -> str:
+    """Returns the path of the jsonl segments written alongside the transcript at [transcript_path]"""
+    base = utils.get_basename_no_ext(transcript_path)
+    return os.path.join(os.path.dirname(transcript_path), f"{base}{SEGMENTS_SUFFIX}")
+
+
+def get_index_path(transcript_path: str) -> str:
+    base = utils.get_basename_no_ext(transcript_path)
+    return os.path.join(os.path.dirname(transcript_path), f"{base}{INDEX_SUFFIX}")
+
+
+def _index_dtype():
+    import numpy as np
+
+    return np.dtype(_INDEX_FIELDS)
+
+
+def to_record(segment, offset_secs: float = 0.0) -> dict[str, Any]:
+    """Turns a faster-whisper segment into a json-able record, with its timestamps shifted by [offset_secs]"""
+    words = getattr(segment, "words", None)
+    return {
+        "start": round(segment.start + offset_secs, 3),
+        "end": round(segment.end + offset_secs, 3),
+        "text": segment.text,
+        "avg_logprob": getattr(segment, "avg_logprob", None),
+        "no_speech_prob": getattr(segment, "no_speech_prob", None),
+        "compression_ratio": getattr(segment, "compression_ratio", None),
+        "words": None
+        if words is None
+        else [
+            [round(w.start + offset_secs, 3), round(w.end + offset_secs, 3), w.word, w.probability]
+            for w in words
+        ],
+    }
+
+
+def _pack(record: dict[str, Any], offset: int, length: int) -> bytes:
+    return _RECORD.pack(
+        record["start"],
+        record["end"],
+        _or_nan(record.get("avg_logprob")),
+        _or_nan(record.get("no_speech_prob")),
+        offset,
+        length,
+    )
+
+
+def _or_nan(value: Optional[float]) -> float:
+    return float("nan") if value is None else value
+
+
+class SegmentWriter:
+    """Appends segments to the jsonl file and its index. Every segment is flushed to both before [write] returns,
+    so an interrupted transcription leaves a readable prefix behind
+    """
+
+    def __init__(self, transcript_path: str, resume_secs: Optional[float] = None) -> None:
+        """With [resume_secs], keeps the segments ending at or before it and drops the rest, otherwise starts empty"""
+        self.segments_path = get_segments_path(transcript_path)
+        self.index_path = get_index_path(transcript_path)
+        if resume_secs is None or not os.path.exists(self.index_path):
+            for path in (self.segments_path, self.index_path):
+                with open(path, "wb"):
+                    pass
+        else:
+            self._truncate(resume_secs)
+        self._segments = open(self.segments_path, "ab")
+        self._index = open(self.index_path, "ab")
+        if self._index.tell() == 0:
+            self._index.write(INDEX_MAGIC)
+            self._index.flush()
+
+    def _truncate(self, resume_secs: float) -> None:
+        keep_records = 0
+        segments_bytes = 0
+        with open(self.index_path, "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                keep_records = -1
+            else:
+                while True:
+                    raw = f.read(RECORD_BYTES)
+                    if len(raw) < RECORD_BYTES:
+                        break
+                    _, end, _, _, offset, length = _RECORD.unpack(raw)
+                    if end > resume_secs:
+                        break
+                    keep_records += 1
+                    segments_bytes = offset + length
+        if keep_records < 0:
+            for path in (self.segments_path, self.index_path):
+                with open(path, "wb"):
+                    pass
+            return
+        with open(self.index_path, "r+b") as f:
+            f.truncate(len(INDEX_MAGIC) + keep_records * RECORD_BYTES)
+        with open(self.segments_path, "r+b") as f:
+            f.truncate(segments_bytes)
+
+    def write(self, record: dict[str, Any]) -> None:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode(utils.ENCODING)
+        offset = self._segments.tell()
+        self._segments.write(line)
+        self._segments.flush()
+        self._index.write(_pack(record, offset, len(line)))
+        self._index.flush()
+
+    def close(self) -> None:
+        self._segments.close()
+        self._index.close()
+
+    def __enter__(self) -> "SegmentWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def write_all(transcript_path: str, records: list[dict[str, Any]]) -> None:
+    """Writes the segments of a whole transcript at once"""
+    with SegmentWriter(transcript_path) as writer:
+        for record in records:
+            writer.write(record)
+
+
+class SegmentIndex:
+    """Read only view of a structured transcript. The index is memory mapped as columns, so the timing and confidence
+    of every segment are available without parsing anything, and only the jsonl lines that are asked for are decoded
+    """
+
+    def __init__(self, transcript_path: str) -> None:
+        import numpy as np
+
+        self.segments_path = get_segments_path(transcript_path)
+        self.index_path = get_index_path(transcript_path)
+        with open(self.index_path, "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f"{self.index_path} is not a segment index")
+        count = (os.path.getsize(self.index_path) - len(INDEX_MAGIC)) // RECORD_BYTES
+        if count == 0:
+            self.columns = np.zeros(0, dtype=_index_dtype())
+        else:
+            self.columns = np.memmap(
+                self.index_path,
+                dtype=_index_dtype(),
+                mode="r",
+                offset=len(INDEX_MAGIC),
+                shape=(count,),
+            )
+        self._file = open(self.segments_path, "rb")
+        self._map = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.path.getsize(self.segments_path) > 0
+            else None
+        )
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    def __getitem__(self, i: int) -> dict[str, Any]:
+        offset = int(self.columns["offset"][i])
+        length = int(self.columns["length"][i])
+        return json.loads(self._map[offset : offset + length].decode(utils.ENCODING))
+
+    def find(self, start_secs: float, end_secs: float) -> range:
+        """returns the positions of the segments overlapping [start_secs, end_secs)"""
+        import numpy as np
+
+        first = int(np.searchsorted(self.columns["end"], start_secs, side="right"))
+        last = int(np.searchsorted(self.columns["start"], end_secs, side="left"))
+        return range(first, max(first, last))
+
+    def between(self, start_secs: float, end_secs: float) -> list[dict[str, Any]]:
+        """returns the segments overlapping [start_secs, end_secs)"""
+        return [self[i] for i in self.find(start_secs, end_secs)]
+
+    def texts(
+        self, start_secs: float = 0.0, end_secs: float = float("inf")
+    ) -> Iterator[tuple[float, str]]:
+        """yields the (start, text) of the segments overlapping the range"""
+        starts = self.columns["start"]
+        for i in self.find(start_secs, end_secs):
+            yield float(starts[i]), self[i]["text"]
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self) -> "SegmentIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def has_index(transcript_path: str) -> bool:
+    """Whether the structured segments of [transcript_path] exist and hold the same segments as the plain transcript,
+    which is not the case for e.g. a transcript restored from the artifact cache over older segments"""
+    if not (
+        os.path.exists(get_index_path(transcript_path))
+        and os.path.exists(get_segments_path(transcript_path))
+        and storage.exists(transcript_path)
+    ):
+        return False
+    count = (os.path.getsize(get_index_path(transcript_path)) - len(INDEX_MAGIC)) // RECORD_BYTES
+    with storage.open_bytes(transcript_path) as f:
+        lines = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+    return count == lines
+
+
+def write_text_view(transcript_path: str) -> str:
+    """Rewrites the plain transcript at [transcript_path] from its structured segments"""
+    from skipping_schoo import transscribe
+
+    with SegmentIndex(transcript_path) as index:
+        lines = [
+            f"{transscribe.format_segment(s['start'], s['end'], s['text'])}\n"
+            for s in (index[i] for i in range(len(index)))
+        ]
+    utils.write_text_atomic(transcript_path, "".join(lines))
+    return transcript_path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Reads the structured segments of a transcript",
+    )
+    parser.add_argument("transcript", help="path of the .txt transcript the segments were written next to")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    between = subparsers.add_parser("between", help="print the segments overlapping a time range, as jsonl")
+    between.add_argument("start", type=float, help="seconds")
+    between.add_argument("end", type=float, help="seconds")
+    subparsers.add_parser("text", help="print only the text of every segment")
+    subparsers.add_parser("view", help="rewrite the .txt transcript from the segments")
+
+    args = parser.parse_args()
+
+    if args.command == "view":
+        print(write_text_view(args.transcript))
+        return 0
+    with SegmentIndex(args.transcript) as index:
+        if args.command == "between":
+            for segment in index.between(args.start, args.end):
+                print(json.dumps(segment, ensure_ascii=False))
+        else:
+            for _, text in index.texts():
+                print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# /usr/bin/python3
+""" This file is responsible for how intermediate files are kept on disk: audio as wav, FLAC or Opus, and text plain or compressed"""
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+from typing import BinaryIO, Optional, TextIO
+
+from skipping_schoo import utils
+
+PROG = "Storage"
+
+# Read from SKIPPING_SCHOO_STORAGE
+STORAGE_ENV = "SKIPPING_SCHOO_STORAGE"
+MODES = ["plain", "compressed"]
+MODE = os.getenv(STORAGE_ENV) or "plain"
+
+# ffmpeg codec of every audio format. FLAC is lossless at about half the size of wav, Opus is lossy and far smaller
+AUDIO_CODECS = {"wav": "pcm_s16le", "flac": "flac", "opus": "libopus"}
+# Read from SKIPPING_SCHOO_AUDIO_FORMAT, the format compressed storage keeps audio in
+AUDIO_FORMAT_ENV = "SKIPPING_SCHOO_AUDIO_FORMAT"
+AUDIO_FORMAT = os.getenv(AUDIO_FORMAT_ENV) or "flac"
+# plenty for 16khz mono speech
+OPUS_BITRATE = "32k"
+
+# zstd needs the zstandard package, gzip is always there
+TEXT_CODECS = {"zstd": ".zst", "gzip": ".gz"}
+TEXT_CODEC = "zstd"
+ZSTD_LEVEL = 10
+GZIP_LEVEL = 6
+
+_warned_zstd = False
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+def compressed() -> bool:
+    return MODE == "compressed"
+
+
+def audio_extension() -> str:
+    """The extension audio is ripped or downloaded to: wav, or AUDIO_FORMAT when storage is compressed"""
+    return AUDIO_FORMAT if compressed() else "wav"
+
+
+def audio_codec(path: str) -> tuple[str, Optional[str]]:
+    """returns the ffmpeg codec and bitrate to write the audio file at [path] with, by its extension"""
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    codec = AUDIO_CODECS.get(extension, AUDIO_CODECS["wav"])
+    return codec, OPUS_BITRATE if extension == "opus" else None
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def text_codec() -> str:
+    """returns TEXT_CODEC, or gzip if it is zstd and the zstandard package is not installed"""
+    global _warned_zstd
+    if TEXT_CODEC == "zstd" and _zstd() is None:
+        if not _warned_zstd:
+            log("zstandard is not installed, compressing text with gzip")
+            _warned_zstd = True
+        return "gzip"
+    return TEXT_CODEC
+
+
+def find(path: str) -> Optional[str]:
+    """returns the file holding the text of [path]: [path] itself, or a compressed copy next to it. None if there is neither"""
+    if os.path.exists(path):
+        return path
+    for suffix in TEXT_CODECS.values():
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+
+def exists(path: str) -> bool:
+    return find(path) is not None
+
+
+def open_bytes(path: str) -> BinaryIO:
+    """Opens the text of [path] for reading as bytes, decompressing it if only a compressed copy exists"""
+    found = find(path)
+    if found is None:
+        raise FileNotFoundError(path)
+    if found.endswith(TEXT_CODECS["gzip"]):
+        return gzip.open(found, "rb")
+    if found.endswith(TEXT_CODECS["zstd"]):
+        zstandard = _zstd()
+        if zstandard is None:
+            raise ImportError(f"zstandard is needed to read {found}")
+        return zstandard.open(found, "rb")
+    return open(found, "rb")
+
+
+def open_text(path: str) -> TextIO:
+    """Opens the text of [path] for reading, decompressing it if only a compressed copy exists"""
+    return io.TextIOWrapper(open_bytes(path), encoding=utils.ENCODING)
+
+
+def read_text(path: str) -> str:
+    with open_text(path) as f:
+        return f.read()
+
+
+def _compress_bytes(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _write_bytes_atomic(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def remove(path: str) -> None:
+    """Deletes [path] and any compressed copy of it"""
+    for p in [path] + [path + suffix for suffix in TEXT_CODECS.values()]:
+        if os.path.exists(p):
+            os.unlink(p)
+
+
+def compress_file(path: str, codec: Optional[str] = None) -> str:
+    """Replaces the plain text file at [path] with a compressed copy, and removes any copy in another codec
+    returns the path of the compressed file
+    """
+    codec = codec or text_codec()
+    with open(path, "rb") as f:
+        data = f.read()
+    compressed_path = path + TEXT_CODECS[codec]
+    _write_bytes_atomic(compressed_path, _compress_bytes(data, codec))
+    for other in TEXT_CODECS.values():
+        if path + other != compressed_path and os.path.exists(path + other):
+            os.unlink(path + other)
+    os.unlink(path)
+    return compressed_path
+
+
+def _text_artifacts(transcript_path: str) -> list[str]:
+    """The plain text files made from [transcript_path] that are only read again by a later run:
+    the transcript, its compacted copy, its chunks and the intermediate summaries. The final summary is the result, and stays plain.
+    The structured segments are read at random positions through their index, and stay plain too
+    """
+    from skipping_schoo import compact
+    from skipping_schoo import summarize
+
+    base_dir = utils.get_output_directory_path(transcript_path)
+    final = os.path.abspath(summarize.get_summary_path(transcript_path))
+    paths = [transcript_path, compact.get_compact_path(transcript_path)]
+    for sub in ("chunks", "summaries"):
+        directory = os.path.join(base_dir, sub)
+        if os.path.isdir(directory):
+            paths.extend(
+                os.path.join(directory, name)
+                for name in sorted(os.listdir(directory))
+                if name.endswith(".txt")
+            )
+    return [p for p in paths if os.path.isfile(p) and os.path.abspath(p) != final]
+
+
+def archive(transcript_path: str, audio_path: Optional[str] = None) -> int:
+    """When storage is compressed, compresses the text files made from the finished transcript at [transcript_path],
+    and deletes the float32 samples of [audio_path], which are only there to speed up transcription
+    returns the bytes saved
+    """
+    if not compressed():
+        return 0
+    saved = 0
+    if audio_path is not None:
+        from skipping_schoo import rip_audio
+
+        samples_path = rip_audio.get_samples_path(audio_path)
+        if os.path.exists(samples_path):
+            saved += os.path.getsize(samples_path)
+        rip_audio.remove_samples(audio_path)
+    for path in _text_artifacts(transcript_path):
+        before = os.path.getsize(path)
+        saved += before - os.path.getsize(compress_file(path))
+    if saved > 0:
+        log(f"Compressed the intermediate files of {transcript_path}, saving {saved} bytes")
+    return saved
+
+
+def disk_usage(directory: str) -> dict[str, int]:
+    """returns the bytes under [directory] by kind of file: audio, samples, text, compressed text and other"""
+    usage = {"video": 0, "audio": 0, "samples": 0, "text": 0, "compressed_text": 0, "other": 0}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            size = os.path.getsize(os.path.join(root, name))
+            extension = os.path.splitext(name)[1].lstrip(".").lower()
+            if extension == "mp4":
+                kind = "video"
+            elif extension in AUDIO_CODECS:
+                kind = "audio"
+            elif name.endswith(".f32") or name.endswith(".f32.json"):
+                kind = "samples"
+            elif any(name.endswith(s) for s in TEXT_CODECS.values()):
+                kind = "compressed_text"
+            elif extension in ("txt", "jsonl", "json", "idx"):
+                kind = "text"
+            else:
+                kind = "other"
+            usage[kind] += size
+    usage["total"] = sum(usage.values())
+    return usage
+
+
+def main() -> int:
+    global MODE, TEXT_CODEC
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Compresses the intermediate files of finished lectures, and reports the disk they use",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compress = subparsers.add_parser(
+        "compress", help="compress the transcripts, chunks and summaries made from finished transcripts"
+    )
+    compress.add_argument("transcripts", nargs="+")
+    compress.add_argument("--codec", choices=list(TEXT_CODECS), default=TEXT_CODEC)
+    du = subparsers.add_parser("du", help="print the bytes used by each kind of file")
+    du.add_argument("directories", nargs="+")
+
+    args = parser.parse_args()
+
+    if args.command == "compress":
+        MODE = "compressed"
+        TEXT_CODEC = args.codec
+        saved = sum(archive(t) for t in args.transcripts)
+        log(f"Saved {saved} bytes")
+    else:
+        for directory in args.directories:
+            print(json.dumps({"directory": directory, **disk_usage(directory)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,19 +2,26 @@
 """ This file is responsible for sending transcript data to ChatGPT to get a summary of the contents"""
 from ast import List
 import datetime
+import json
 import math
 import os
 import sys, subprocess
 import argparse
 import time
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
 import re
-import openai
-from transformers import AutoTokenizer
-import torch
-from openai.error import RateLimitError
+from skipping_schoo import backends
+from skipping_schoo import compact
+from skipping_schoo import llm_cache
+from skipping_schoo import metrics
+from skipping_schoo import ratelimit
+from skipping_schoo import storage
+from skipping_schoo import tokenizer
 from skipping_schoo import utils
+from skipping_schoo.errors import RetryableError, SkippingSchooError
 import shutil
+import threading
 
 PROG = "Summarize"
 
@@ -28,69 +35,106 @@ TOP_P = 1
 FREQUENCY_PENALTY = 0
 PRESENCE_PENALTY = 0
 
-TOKENIZER = AutoTokenizer.from_pretrained("gpt2")
+PARALLELISM = 4
+MAX_RETRIES = 8
 
+# which server completes the requests, see backends.make_backend
+BACKEND = backends.BACKEND
+BASE_URL = None
+
+# at most this many summaries are merged by one request while reducing
+FAN_IN = 8
+# the summaries handed to one reduce request, or to the final request, must fit in the budget of one chunk
+REDUCE_INPUT_TOKENS = CHUNK_SIZE
+
+SYSTEM_PROMPT = "This is text summarization."
+CHUNK_PROMPT = 'The following is snippet {0} of {1}, of a Japanese language transcript of an online course titled "{2}". Summarize it. Pay attention to any especially important parts, and include those in your summary. Do not include the course title in your summary.'
+REDUCE_PROMPT = 'The following are summaries of parts {0} to {1}, out of {2}, of a Japanese language transcript of an online course titled "{3}". Combine them into a single summary of those parts, keeping any especially important points. Do not include the course title in your summary.'
+FINAL_PROMPT = 'The following is a list of summaries of an online course titled "{0}".  Extract between 10 to 20 bullet points of important, interesting, useful, or notable information:'
+
+# Shared by every thread sending requests, so that concurrent chunks stay within the account limits together
+RATE_LIMITER = ratelimit.RateLimiter()
+# Answers requests that were already sent, by this run or an earlier one, without calling OpenAI
+USE_RESPONSE_CACHE = True
+
+_backend = None
+_backend_lock = threading.Lock()
 
 def log(msg: str, end="\n") -> None:
     utils.log(msg, end=end, prog=PROG)
 
 
+def get_tokenizer() -> tokenizer.Tokenizer:
+    """Loads the tokenizer of [MODEL] on first use, so that importing this module stays cheap"""
+    return tokenizer.get_tokenizer(MODEL)
+
+
+def get_backend() -> backends.OpenAICompatibleBackend:
+    """returns the completion backend named by BACKEND, shared by every thread so that its connections are reused"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = backends.make_backend(BACKEND, BASE_URL)
+            log(f"Sending completions to {_backend.name}")
+        return _backend
+
+
 def count_tokens_file(filename: str) -> int:
-    """Runs a local tokenizer that roughly matches OpenAI's gpt3 and returns the total tokens in a given text from a filename"""
-    with open(filename, "r", encoding=utils.ENCODING) as f:
-        text = f.read()
-        return count_tokens_text(text)
+    """Returns the total tokens of the text in [filename], as counted by the summarizing model. The file is read line by line"""
+    tok = get_tokenizer()
+    with storage.open_text(filename) as f:
+        return sum(tok.count(line) for line in f)
 
 
 def count_tokens_text(text: str) -> int:
-    """Runs a local tokenizer that roughly matches OpenAI's gpt3 and returns the total tokens for the given text"""
-    input_ids = torch.tensor(TOKENIZER.encode(text)).unsqueeze(0)
-    num_tokens = input_ids.shape[1]
-    return num_tokens
+    """Returns the total tokens of the given text, as counted by the summarizing model"""
+    return get_tokenizer().count(text)
 
 
 def break_up_to_chunks_text(
     text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP
-) -> list[list[int]]:
-    """Given some text, breaks up that file into individual lists containing a token count that GPT-3 can accept in a single request"""
-    tokens = TOKENIZER.encode(text)
-    num_tokens = len(tokens)
-
-    chunks = []
-    for i in range(0, num_tokens, chunk_size - overlap):
-        chunk = tokens[i : i + chunk_size]
-        chunks.append(chunk)
-    return chunks
+) -> list[str]:
+    """Given some text, breaks it up into chunks of at most [chunk_size] tokens, which GPT can accept in a single request"""
+    return list(
+        tokenizer.iter_chunks(
+            text.splitlines(keepends=True), get_tokenizer(), chunk_size, overlap
+        )
+    )
 
 
 def break_up_to_chunks_file(
     filename: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP
-) -> list[list[int]]:
-    """Given a file containing text, breaks up that file into individual lists containing a token count that GPT-3 can accept in a single request"""
-    with open(filename, "r", encoding=utils.ENCODING) as f:
-        text = f.read()
-        return break_up_to_chunks_text(text, chunk_size, overlap)
+) -> list[str]:
+    """Given a file containing text, breaks it up into chunks of at most [chunk_size] tokens, which GPT can accept in a single request.
+    The file is streamed, so the whole transcript is never tokenized at once
+    """
+    return list(
+        tokenizer.iter_chunks_file(filename, get_tokenizer(), chunk_size, overlap)
+    )
 
 
 def write_chunks_to_files(
     filename: str, overwrite: bool = True, output_path: str = "./"
-) -> list[list[int]]:
-    """Given a filename containing some tokens, split the file into individual lists of tokens that GPT-3 can access in a single request.
-    Writes these lists back out to disk in numbered order.
+) -> list[str]:
+    """Given a filename containing some text, split the file into chunks that GPT can accept in a single request.
+    Writes these chunks back out to disk in numbered order, as they are produced.
     Returns the list of chunks in memory
     """
     os.makedirs(output_path, exist_ok=True)
-    chunks = break_up_to_chunks_file(filename)
-    for i, chunk in enumerate(chunks):
+    chunks: list[str] = []
+    chunk_iter = tokenizer.iter_chunks_file(
+        filename, get_tokenizer(), CHUNK_SIZE, CHUNK_OVERLAP
+    )
+    for i, chunk in enumerate(chunk_iter):
+        chunks.append(chunk)
         fname = _get_chunked_filename(filename, i)
         full_path = os.path.join(output_path, fname)
-        if os.path.isfile(full_path) and not overwrite:
+        if storage.exists(full_path) and not overwrite:
             log(f"\rSkipping writing Chunk {i}, file already exists", end="\r")
             continue
-        log(f"\rWriting Chunk {i}: {len(chunk)} tokens", end="\r")
-        retokenized = TOKENIZER.decode(chunk)
+        log(f"\rWriting Chunk {i}: {len(chunk)} characters", end="\r")
         with open(full_path, "w", encoding=utils.ENCODING) as f:
-            f.write(retokenized)
+            f.write(chunk)
     log("Finished writing chunked token files")
     return chunks
 
@@ -99,12 +143,27 @@ def _stitch_summaries(summaries: list[str]) -> str:
     return "\n".join(summaries)
 
 
+@metrics.stage("summarize")
 def summarizer_file(
-    filename: str, course_title: str, overwrite: bool = False, cleanup: bool = False
+    filename: str,
+    course_title: str,
+    overwrite: bool = False,
+    cleanup: bool = False,
+    parallelism: int = PARALLELISM,
+    compaction: bool = True,
+    fan_in: int = FAN_IN,
 ) -> str:
+    """Summarizes the transcript at [filename], returning the path of the final summary
+    With [compaction], the timestamps, repeated segments and filler words are stripped from the transcript before it is chunked
+    [fan_in] is the most chunk summaries merged by one request, see [reduce_summaries]
+    """
     base_dir = utils.get_output_directory_path(filename)
     chunk_path = os.path.join(base_dir, "chunks")
     summary_path = os.path.join(base_dir, "summaries")
+    compact_path = None
+    if compaction:
+        compact_path = compact.compact_file(filename, overwrite=overwrite, model=MODEL)
+        filename = compact_path
     chunks = write_chunks_to_files(
         filename, overwrite=overwrite, output_path=chunk_path
     )
@@ -117,173 +176,261 @@ def summarizer_file(
             filename,
             overwrite=overwrite,
             output_path=summary_path,
+            parallelism=parallelism,
         )
     elif len(chunks) == 1:
         log(
             "chunks was length==1, meaning that there's no need to do a meta-summary. We can instead move on to summarizing the raw input"
         )
-        summaries = [TOKENIZER.decode(x) for x in chunks]
+        summaries = list(chunks)
     else:
         log(
             "chunks was length==0, which is an error. There is nothing to summarize. Returning blank."
         )
         return ""
-    summary = summary_of_summaries(filename, summaries, course_title)
+    summary = summary_of_summaries(
+        filename,
+        summaries,
+        course_title,
+        overwrite=overwrite,
+        output_path=summary_path,
+        parallelism=parallelism,
+        fan_in=fan_in,
+    )
     if cleanup:
         log(f"Cleanup set to true, deleting snippet and summary collections")
         shutil.rmtree(chunk_path, ignore_errors=True)
         shutil.rmtree(summary_path, ignore_errors=True)
+        if compact_path is not None:
+            storage.remove(compact_path)
     return summary
 
 
-def recurse_summary(
+def summarize_chunk(
     prompt: str,
     chunk_idx: int,
     course_title: str,
     filename: str,
     output_path: str = "./",
 ) -> str:
+    """Sends a single chunk prompt out for summary, and streams the response into [output_path]"""
     prompt = prompt.strip()
     if len(prompt) == 0:
         log(
             "Prompt was empty, which is an error. Returning nothing and not sending anything out to OpenAI"
         )
         return ""
-    try:
-        response_text = _send_openai_request(
-            prompt,
-            MODEL,
-            TEMPERATURE,
-            MAX_TOKENS,
-            TOP_P,
-            FREQUENCY_PENALTY,
-            PRESENCE_PENALTY,
-        )
-        fname = _get_summarized_filename(filename, chunk_idx)
-        full_path = os.path.join(output_path, fname)
-        with open(full_path, "w", encoding=utils.ENCODING) as f:
-            f.write(response_text)
-        return response_text
-    except RateLimitError as rle:
-        _extract_and_wait_on_rate_limit(rle)
-        # recurse back in, so we can catch new rate limit errors from the rate limited execution
-        return recurse_summary(prompt, chunk_idx, course_title, filename, output_path)
-
-
-def _extract_and_wait_on_rate_limit(rle: RateLimitError):
-    wait_for = 60
-    log(str(rle))
-    try:
-        time_remaining_str = rle.headers["x-ratelimit-reset-requests"]
-        wait_for = _parse_time_remaining(time_remaining_str)
-    except:
-        log(
-            "Tried to get time remaining from Rate Limit Error headers but failed. Waiting for 60 seconds as a fallback"
-        )
-    while wait_for > 0:
-        time.sleep(1)
-        log(
-            f"\rWaiting {wait_for} seconds before re-running latest command",
-            end="\r",
+    fname = _get_summarized_filename(filename, chunk_idx)
+    return _send_with_retries(prompt, output_path=os.path.join(output_path, fname))
+
+
+def _send_with_retries(
+    prompt_request: str,
+    max_tokens: int = MAX_TOKENS,
+    max_retries: int = MAX_RETRIES,
+    output_path: Optional[str] = None,
+) -> str:
+    """Answers the request from the response cache if it was sent before, otherwise sends it once the shared rate limiter allows it.
+    Rate limits and transient errors are retried with jittered exponential backoff, up to [max_retries] times
+
+    With [output_path], the response is also written there, streamed as it arrives. It is written to a .part file first,
+    so a summary on disk is always a whole one
+    """
+    prompt_tokens = count_tokens_text(prompt_request)
+    cache = llm_cache.get_cache() if USE_RESPONSE_CACHE else None
+    key = None
+    if cache is not None:
+        key = cache.key(
+            {**_build_request(prompt_request, max_tokens=max_tokens), "backend": get_backend().name}
         )
-        wait_for -= 1
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.count("response_cache_hits")
+            log("Response cache hit, not sending the request to OpenAI")
+            if output_path is not None:
+                utils.write_text_atomic(output_path, cached)
+            return cached
+    estimated_tokens = prompt_tokens + max_tokens
+    rate_limited = get_backend().rate_limited
+    for attempt in range(max_retries + 1):
+        if rate_limited:
+            metrics.observe("rate_limit_wait_seconds", RATE_LIMITER.acquire(estimated_tokens))
+        try:
+            response_text = _send_request(prompt_request, max_tokens=max_tokens, output_path=output_path)
+            response_tokens = count_tokens_text(response_text)
+            metrics.count("tokens_sent", prompt_tokens)
+            metrics.count("tokens_received", response_tokens)
+            if cache is not None:
+                cache.put(key, MODEL, response_text, prompt_tokens + response_tokens)
+            return response_text
+        except RetryableError as e:
+            metrics.count("retries", stage="summarize", error=type(e).__name__)
+            if attempt == max_retries:
+                raise SkippingSchooError(
+                    f"Giving up on {get_backend().name} request after {attempt + 1} attempts: {e}"
+                ) from e
+            RATE_LIMITER.update_from_headers(getattr(e, "headers", None))
+            delay = ratelimit.backoff_delay(attempt)
+            log(
+                f"{type(e).__name__} from {get_backend().name}, retrying in {round(delay, 2)} seconds ({attempt + 1} of {max_retries})"
+            )
+            time.sleep(delay)
+    raise SkippingSchooError("Unreachable: retries exhausted without a result")
 
 
 def send_summary_prompts(
-    chunks: list[list[int]],
+    chunks: list[str],
     course_title: str,
     filename: str,
     overwrite: bool = True,
     output_path: str = "./",
+    parallelism: int = PARALLELISM,
 ) -> list[str]:
-    """Given a list chunked tokens, submits each list to OpenAI individually and returns a summary of the contents
+    """Given a list of text chunks, submits each chunk to OpenAI individually and returns a summary of the contents
+    Up to [parallelism] chunks are in flight at once
 
     Writes these summaries out to a '/summaries' folder
 
-    Returns the in-memory list of summaries
+    Returns the in-memory list of summaries, in chunk order
     """
     os.makedirs(output_path, exist_ok=True)
-    prompt_response: list[str] = []
+    prompt_response: list[str] = [""] * len(chunks)
+    pending: list[int] = []
 
-    initial_prompt = 'The following is snippet {0} of {1}, of a Japanese language transcript of an online course titled "{2}". Summarize it. Pay attention to any especially important parts, and include those in your summary. Do not include the course title in your summary.'
-
-    for i, chunk in enumerate(chunks):
+    for i in range(len(chunks)):
         full_path = os.path.join(output_path, _get_summarized_filename(filename, i))
-        if os.path.exists(full_path) and not overwrite:
+        if storage.exists(full_path) and not overwrite:
             log(f"Skipping sending chunk {i} for summary, already on disk")
-            with open(full_path, "r", encoding=utils.ENCODING) as f:
-                summarized_on_disk = f.read()
-                prompt_response.append(summarized_on_disk)
+            prompt_response[i] = storage.read_text(full_path)
             continue
+        pending.append(i)
+
+    def summarize_one(i: int) -> str:
         log(
-            f"Sending out chunk {i} ({math.ceil(((i+1) / len(chunks))*100)}%) to OpenAI"
+            f"Sending out chunk {i} ({math.ceil(((i+1) / len(chunks))*100)}%) to {get_backend().name}"
         )
-        prompt_request = initial_prompt.format(i + 1, len(chunks), course_title)
+        instruction = CHUNK_PROMPT.format(i + 1, len(chunks), course_title)
+        prompt_request = f"{instruction}\n\n{chunks[i]}"
+        return summarize_chunk(prompt_request, i, course_title, filename, output_path)
 
-        res = recurse_summary(prompt_request, i, course_title, filename, output_path)
-        prompt_response.append(res)
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        for i, res in zip(pending, pool.map(summarize_one, pending)):
+            prompt_response[i] = res
 
     return prompt_response
 
 
-def summary_of_summaries(filename: str, summaries: list[str], course_title: str) -> str:
-    """Stitches each of the summaries together into one meta-summary and requests OpenAI summarize that instead
+def _batch_summaries(summaries: list[str], fan_in: int) -> list[list[int]]:
+    """Groups consecutive summaries into batches of at most [fan_in] summaries, closing a batch early once its
+    stitched text would go over REDUCE_INPUT_TOKENS. Every batch but a trailing one holds at least two summaries,
+    so each level of the reduce at least halves the number of summaries
+    returns the positions of the summaries in each batch
+    """
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_tokens = 0
+    for i, summary in enumerate(summaries):
+        tokens = count_tokens_text(summary)
+        full = len(batch) >= max(2, fan_in) or (
+            len(batch) >= 2 and batch_tokens + tokens > REDUCE_INPUT_TOKENS
+        )
+        if full:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def reduce_summaries(
+    filename: str,
+    summaries: list[str],
+    course_title: str,
+    overwrite: bool = True,
+    output_path: str = "./",
+    parallelism: int = PARALLELISM,
+    fan_in: int = FAN_IN,
+) -> list[str]:
+    """Merges the summaries in a tree, until their stitched text fits into a single request.
+    Each level groups the summaries into batches of at most [fan_in], and summarizes the batches [parallelism] at a time,
+    so the number of serial requests grows with log(chunks) rather than with the length of the course
+
+    Every intermediate summary is written to [output_path], and reused by a later run unless [overwrite] is set
+    returns the summaries of the last level, in order
+    """
+    os.makedirs(output_path, exist_ok=True)
+    level = 0
+    while (
+        len(summaries) > 1
+        and count_tokens_text(_stitch_summaries(summaries)) > REDUCE_INPUT_TOKENS
+    ):
+        level += 1
+        batches = _batch_summaries(summaries, fan_in)
+        log(
+            f"Reducing {len(summaries)} summaries into {len(batches)} at level {level}"
+        )
+
+        def reduce_one(idx: int, level: int = level, summaries: list[str] = summaries) -> str:
+            batch = batches[idx]
+            full_path = os.path.join(
+                output_path, _get_reduced_filename(filename, level, idx)
+            )
+            if storage.exists(full_path) and not overwrite:
+                log(f"Skipping reduce {idx} of level {level}, already on disk")
+                return storage.read_text(full_path)
+            instruction = REDUCE_PROMPT.format(
+                batch[0] + 1, batch[-1] + 1, len(summaries), course_title
+            )
+            stitched = _stitch_summaries([summaries[i] for i in batch])
+            return _send_with_retries(
+                f"{instruction}\n\n{stitched}", output_path=full_path
+            )
+
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+            summaries = list(pool.map(reduce_one, range(len(batches))))
+    return summaries
+
+
+def summary_of_summaries(
+    filename: str,
+    summaries: list[str],
+    course_title: str,
+    overwrite: bool = True,
+    output_path: str = "./",
+    parallelism: int = PARALLELISM,
+    fan_in: int = FAN_IN,
+) -> str:
+    """Reduces the summaries until they fit in one request, see [reduce_summaries], then requests OpenAI summarize them into the final summary
     returns the path to the written output summary
     """
+    summaries = reduce_summaries(
+        filename,
+        summaries,
+        course_title,
+        overwrite=overwrite,
+        output_path=output_path,
+        parallelism=parallelism,
+        fan_in=fan_in,
+    )
     stitched = _stitch_summaries(summaries).strip()
     if len(stitched) == 0:
         log(
             "Handed empty string to summarize, which is an error. Returning blank, and not sending anything to OpenAI"
         )
         return ""
-    try:
-        prompt = 'The following is a list of summaries of an online course titled "{0}".  Extract between 10 to 20 bullet points of important, interesting, useful, or notable information:'.format(
-            course_title
-        )
-        log("Sending request for summary of sumaries out to OpenAI")
-        res = _send_openai_request(prompt)
-        output_path = os.path.join(
-            utils.get_output_directory_path(filename),
-            _get_final_resposne_filename(filename),
-        )
-        log(
-            f"Received final summary response. Response will be written to {output_path}"
-        )
-        with open(output_path, "w", encoding=utils.ENCODING) as f:
-            f.write(res)
-        return output_path
-    except RateLimitError as rle:
-        _extract_and_wait_on_rate_limit(rle)
-        return summary_of_summaries(filename, summaries, course_title)
-
-
-def _parse_time_remaining(remaining: Union[str, int, float]) -> int:
-    """Given a string in the form of 'xx.yyys" returns the time remaining in integer seconds (rounded up)"""
-    default = 60
-    if isinstance(remaining, int):
-        return remaining
-    elif isinstance(remaining, float):
-        return math.ceil(remaining)
-    elif isinstance(remaining, str):
-        try:
-            s2 = [c for c in remaining if c.isdigit() or c == "."]
-            last = remaining[-1].lower()
-            s3 = "".join(s2)
-            i = math.ceil(float(s3))
-            if last == "s":
-                return i
-            elif last == "m":
-                return i * 60
-            elif last == "h":
-                return i * 60 * 60
-        except Exception as e:
-            log(
-                f"Encountered a conversion error while trying to determine rate limit time remaining on {remaining}. Got {e}. Returning '60 seconds' default"
-            )
-    return default
+    prompt = FINAL_PROMPT.format(course_title)
+    output_path = get_summary_path(filename)
+    log(
+        f"Sending request for summary of sumaries out to {get_backend().name}. Response will be streamed to {output_path}"
+    )
+    _send_with_retries(f"{prompt}\n\n{stitched}", output_path=output_path)
+    log("Received final summary response")
+    return output_path
 
 
-def _send_openai_request(
+def _build_request(
     prompt_request: str,
     model: str = MODEL,
     temperature: float = TEMPERATURE,
@@ -291,26 +438,61 @@ def _send_openai_request(
     top_p: float = TOP_P,
     frequency_penalty: float = FREQUENCY_PENALTY,
     presence_penalty: float = PRESENCE_PENALTY,
-) -> str:
-    messages = [{"role": "system", "content": "This is text summarization."}]
+) -> dict:
+    """returns the keyword arguments of the completion call for [prompt_request], which also key the response cache"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
     messages.append({"role": "user", "content": prompt_request})
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        top_p=top_p,
-        frequency_penalty=frequency_penalty,
-        presence_penalty=presence_penalty,
-    )
-    response_text = response["choices"][0]["message"]["content"].strip()
-    return response_text
+    return {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "top_p": top_p,
+        "frequency_penalty": frequency_penalty,
+        "presence_penalty": presence_penalty,
+    }
+
+
+def _send_request(
+    prompt_request: str,
+    max_tokens: int = MAX_TOKENS,
+    output_path: Optional[str] = None,
+) -> str:
+    """Sends one request to the backend. With [output_path], the response is streamed into a .part file next to it,
+    which replaces [output_path] once the response is complete
+    """
+    request = _build_request(prompt_request, max_tokens=max_tokens)
+    if output_path is None:
+        completion = get_backend().complete(request)
+    else:
+        part_path = f"{output_path}.part"
+        with open(part_path, "w", encoding=utils.ENCODING) as f:
+
+            def on_text(text: str) -> None:
+                f.write(text)
+                f.flush()
+
+            completion = get_backend().complete(request, on_text=on_text)
+        os.replace(part_path, output_path)
+    RATE_LIMITER.update_from_headers(completion.headers)
+    metrics.count("api_requests", backend=get_backend().name)
+    metrics.observe("api_latency_seconds", completion.total_secs)
+    if completion.first_token_secs is not None:
+        metrics.observe("api_first_token_seconds", completion.first_token_secs)
+    return completion.text.strip()
 
 
 def set_openai_key(key: str) -> None:
     os.environ["OPENAI_API_KEY"] = key
 
 
+def configure_backend() -> None:
+    """Sets up the completion backend, which for the hosted API needs the key at the OPENAI_API_KEY environment variable
+    Raises if no key is set, so that a run fails before any slow work is done
+    """
+    get_backend()
+
+
 def _get_chunked_filename(filename: str, chunk_number: int) -> str:
     base = utils.get_basename_no_ext(filename)
     return f"{base}_{chunk_number}.txt"
@@ -321,13 +503,48 @@ def _get_summarized_filename(filename: str, chunk_number: int) -> str:
     return f"{base}_{chunk_number}_summary.txt"
 
 
+def _get_reduced_filename(filename: str, level: int, number: int) -> str:
+    base = utils.get_basename_no_ext(filename)
+    return f"{base}_L{level}_{number}_summary.txt"
+
+
 def _get_final_resposne_filename(filename: str) -> str:
     base = utils.get_basename_no_ext(filename)
     return f"{base}_summary.txt"
 
 
+def get_summary_path(filename: str) -> str:
+    """Returns the path the final summary of the transcript [filename] is written to"""
+    return os.path.join(
+        utils.get_output_directory_path(filename),
+        _get_final_resposne_filename(filename),
+    )
+
+
+def artifact_params(course_title: str, compaction: bool = True) -> dict:
+    """Everything besides the transcript that changes the summary, for keying the artifact cache"""
+    return {
+        "compaction": compact.artifact_params() if compaction else None,
+        "backend": BACKEND,
+        "base_url": BASE_URL,
+        "model": MODEL,
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+        "top_p": TOP_P,
+        "frequency_penalty": FREQUENCY_PENALTY,
+        "presence_penalty": PRESENCE_PENALTY,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "tokenizer": get_tokenizer().name,
+        "prompts": [SYSTEM_PROMPT, CHUNK_PROMPT, REDUCE_PROMPT, FINAL_PROMPT],
+        "fan_in": FAN_IN,
+        "reduce_input_tokens": REDUCE_INPUT_TOKENS,
+        "title": course_title,
+    }
+
+
 def main() -> int:
-    openai.api_key = os.getenv("OPENAI_API_KEY")
+    global USE_RESPONSE_CACHE, BACKEND, BASE_URL
 
     parser = argparse.ArgumentParser(
         prog=PROG,
@@ -353,13 +570,62 @@ def main() -> int:
         action="store_true",
         help="if set, will delete the summary snippets after processing the final summary of summaries",
     )
+    parser.add_argument(
+        "-p",
+        "--parallelism",
+        type=int,
+        default=PARALLELISM,
+        help="number of chunks sent out for summary at the same time",
+    )
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        default=FAN_IN,
+        help="most summaries merged by one request, when the chunk summaries are too long for a single final request",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends.BACKENDS,
+        default=BACKEND,
+        help="openai: the hosted API. local: an OpenAI compatible server, such as llama.cpp or vLLM. stub: canned responses, for testing without an API key",
+    )
+    parser.add_argument(
+        "--base-url",
+        help=f"url of the backend's API, e.g. {backends.LOCAL_URL}. Defaults to ${backends.LOCAL_URL_ENV} for the local backend",
+    )
+    parser.add_argument(
+        "--no-response-cache",
+        action="store_true",
+        help="if set, sends every request to OpenAI, even ones answered by an earlier run",
+    )
+    parser.add_argument(
+        "--no-compact",
+        action="store_true",
+        help="if set, sends the transcript with its timestamps, repeated segments and filler words as it is",
+    )
 
     args = parser.parse_args()
 
-    if args.chunk:
-        write_chunks_to_files(args.transcript)
+    USE_RESPONSE_CACHE = not args.no_response_cache
+    BACKEND = args.backend
+    BASE_URL = args.base_url
+    if args.block:
+        transcript = args.transcript
+        if not args.no_compact:
+            transcript = compact.compact_file(transcript, overwrite=args.overwrite, model=MODEL)
+        write_chunks_to_files(transcript)
     else:
-        summarizer_file(args.transcript, args.title, overwrite=args.overwrite, cleanup=args.cleanup)
+        summarizer_file(
+            args.transcript,
+            args.title,
+            overwrite=args.overwrite,
+            cleanup=args.cleanup,
+            parallelism=args.parallelism,
+            compaction=not args.no_compact,
+            fan_in=args.fan_in,
+        )
+        if USE_RESPONSE_CACHE:
+            log(f"Response cache: {json.dumps(llm_cache.get_cache().stats())}")
 
     return 0
 
@@ -0,0 +1,149 @@
+""" This file is responsible for counting and chunking text in the tokens of the model that summarizes it"""
+import threading
+from typing import Iterable, Iterator
+
+from skipping_schoo import storage
+from skipping_schoo import utils
+from skipping_schoo.errors import SkippingSchooError
+
+PROG = "Tokenizer"
+
+# Used when tiktoken is not installed. It does not match the chat models exactly, but keeps chunks in the right range
+FALLBACK_TOKENIZER = "gpt2"
+
+_tokenizers: dict[str, "Tokenizer"] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class Tokenizer:
+    """A fast tokenizer for [model]: tiktoken's encoding of the model if it is installed,
+    otherwise the Rust backed GPT-2 tokenizer from huggingface tokenizers. Neither needs torch
+    """
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        try:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            self.name = f"tiktoken:{encoding.name}"
+            self._encode = lambda text: encoding.encode(text, disallowed_special=())
+            self._encode_batch = lambda texts: encoding.encode_batch(
+                texts, disallowed_special=()
+            )
+            self._decode = encoding.decode
+        except ImportError:
+            try:
+                from tokenizers import Tokenizer as HFTokenizer
+            except ImportError:
+                raise SkippingSchooError(
+                    "No tokenizer available, install tiktoken or tokenizers"
+                )
+            log(f"tiktoken is not installed, counting tokens with {FALLBACK_TOKENIZER}")
+            hf = HFTokenizer.from_pretrained(FALLBACK_TOKENIZER)
+            self.name = f"tokenizers:{FALLBACK_TOKENIZER}"
+            self._encode = lambda text: hf.encode(text, add_special_tokens=False).ids
+            self._encode_batch = lambda texts: [
+                e.ids for e in hf.encode_batch(texts, add_special_tokens=False)
+            ]
+            self._decode = hf.decode
+
+    def encode(self, text: str) -> list[int]:
+        return self._encode(text)
+
+    def encode_batch(self, texts: list[str]) -> list[list[int]]:
+        return self._encode_batch(texts)
+
+    def decode(self, tokens: list[int]) -> str:
+        return self._decode(tokens)
+
+    def count(self, text: str) -> int:
+        return len(self._encode(text))
+
+
+def get_tokenizer(model: str) -> Tokenizer:
+    """returns the tokenizer of [model], loading it on first use"""
+    with _tokenizers_lock:
+        if model not in _tokenizers:
+            _tokenizers[model] = Tokenizer(model)
+        return _tokenizers[model]
+
+
+def iter_chunks(
+    lines: Iterable[str],
+    tokenizer: Tokenizer,
+    chunk_size: int,
+    overlap: int = 0,
+    batch_lines: int = 256,
+) -> Iterator[str]:
+    """Groups [lines] into chunks of at most [chunk_size] tokens, each starting with roughly the last [overlap] tokens
+    of the previous chunk. Chunks are cut between lines, so that no character is split in half,
+    unless a single line is longer than a chunk.
+
+    Lines are read and encoded [batch_lines] at a time, so only the lines of the current chunk are ever held in memory
+    """
+    if overlap >= chunk_size:
+        raise SkippingSchooError("The chunk overlap must be smaller than the chunk size")
+    window: list[tuple[str, int]] = []
+    window_tokens = 0
+    # set once the window holds lines that no chunk has been emitted for yet
+    fresh = False
+
+    def emit() -> str:
+        nonlocal window, window_tokens, fresh
+        chunk = "".join(line for line, _ in window)
+        kept: list[tuple[str, int]] = []
+        kept_tokens = 0
+        for line, n in reversed(window):
+            if kept_tokens + n > overlap:
+                break
+            kept.insert(0, (line, n))
+            kept_tokens += n
+        window, window_tokens, fresh = kept, kept_tokens, False
+        return chunk
+
+    def pieces(line: str, tokens: list[int]) -> Iterator[tuple[str, int]]:
+        if len(tokens) <= chunk_size - overlap:
+            yield line, len(tokens)
+            return
+        step = chunk_size - overlap
+        for i in range(0, len(tokens), step):
+            piece = tokens[i : i + step]
+            yield tokenizer.decode(piece), len(piece)
+
+    for batch in _batched(lines, batch_lines):
+        for line, tokens in zip(batch, tokenizer.encode_batch(batch)):
+            for piece, n in pieces(line, tokens):
+                if window_tokens + n > chunk_size and fresh:
+                    yield emit()
+                window.append((piece, n))
+                window_tokens += n
+                fresh = True
+    if fresh:
+        yield emit()
+
+
+def iter_chunks_file(
+    filename: str, tokenizer: Tokenizer, chunk_size: int, overlap: int = 0
+) -> Iterator[str]:
+    """Streams the chunks of the text file at [filename], see [iter_chunks]"""
+    with storage.open_text(filename) as f:
+        yield from iter_chunks(f, tokenizer, chunk_size, overlap)
+
+
+def _batched(lines: Iterable[str], n: int) -> Iterator[list[str]]:
+    batch: list[str] = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
@@ -6,9 +6,14 @@ import datetime
 import os, sys
 import subprocess
 import argparse
+import json
+from typing import Optional
+from skipping_schoo import metrics
+from skipping_schoo import rip_audio
+from skipping_schoo import segments as structured
+from skipping_schoo import storage
 from skipping_schoo import utils
 from time import sleep
-from faster_whisper import WhisperModel
 
 PROG = "Transcribe"
 
@@ -16,15 +21,29 @@ MODEL_SIZE = "large-v2"
 DEVICE = "cpu"
 COMPUTE_TYPE = "int8"
 LANGUAGE = "ja"
+# 0 lets CTranslate2 pick its own default
+CPU_THREADS = 0
+NUM_WORKERS = 1
+BEAM_SIZE = 5
+VAD_FILTER = False
+# the settings autotune found fastest on this host replace the defaults above, see [get_settings]
+USE_CALIBRATION = True
 
 FMT = "[{0} -> {1}] {2}"
+# per word timings make Whisper slower, so the structured segments only hold them when asked for
+WORD_TIMESTAMPS = False
+CHECKPOINT_SUFFIX = ".ckpt.json"
 
 
 def log(msg: str, end="\n") -> None:
     return utils.log(msg, end=end, prog=PROG)
 
 
-def get_runtime_secs(input_file: str) -> int:
+def get_runtime_secs(input_file: str) -> float:
+    """returns the length of [input_file] in seconds, from the header of its ripped samples if it has one, or else from ffprobe"""
+    duration = rip_audio.get_duration(input_file)
+    if duration is not None:
+        return float(duration)
     args = [
         "ffprobe",
         "-v",
@@ -39,67 +58,359 @@ def get_runtime_secs(input_file: str) -> int:
     ]
     x = subprocess.run(args, stdout=subprocess.PIPE, encoding="utf8")
     x.check_returncode()
-    dur_str = x.stdout.strip()
-    dur_str = dur_str.split(".")[0]
-    dur = int(dur_str)
-    return dur
+    return float(x.stdout.strip())
 
 
+def format_segment(start: float, end: float, text: str) -> str:
+    """Formats one transcribed segment as a transcript line, without the line break"""
+    return FMT.format(round(start, 2), round(end, 2), text)
+
+
+def _checkpoint_path(transcript_path: str) -> str:
+    return f"{transcript_path}{CHECKPOINT_SUFFIX}"
+
+
+def write_checkpoint(
+    transcript_path: str,
+    end_secs: float,
+    size_bytes: int,
+    model_size: Optional[str] = None,
+    complete: bool = False,
+    params: Optional[dict] = None,
+) -> None:
+    """Records that the transcript holds every segment up to [end_secs], in its first [size_bytes] bytes,
+    and the [params] it is made with, see artifact_params. They default to those of [model_size]"""
+    params = params or artifact_params(model_size=model_size)
+    checkpoint = {
+        "end": end_secs,
+        "bytes": size_bytes,
+        "model": params["model_size"],
+        "params": params,
+        "complete": complete,
+    }
+    utils.write_text_atomic(_checkpoint_path(transcript_path), json.dumps(checkpoint))
+
+
+def read_checkpoint(transcript_path: str) -> Optional[dict]:
+    """returns the checkpoint of an unfinished transcript, or None if there is nothing to resume"""
+    path = _checkpoint_path(transcript_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding=utils.ENCODING) as f:
+        checkpoint = json.load(f)
+    return None if checkpoint["complete"] else checkpoint
+
+
+def get_model(transcript_path: str) -> Optional[str]:
+    """returns the Whisper model the transcript at [transcript_path] was made with, or None if it has no checkpoint"""
+    path = _checkpoint_path(transcript_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding=utils.ENCODING) as f:
+        return json.load(f).get("model")
+
+
+def made_with(transcript_path: str, params: dict) -> bool:
+    """Whether the transcript at [transcript_path] was made, or is being made, with [params], see artifact_params.
+    Checkpoints written before the settings were recorded are matched on their model alone,
+    and transcripts without a checkpoint are trusted, as in [is_complete]"""
+    path = _checkpoint_path(transcript_path)
+    if not os.path.exists(path):
+        return True
+    with open(path, "r", encoding=utils.ENCODING) as f:
+        checkpoint = json.load(f)
+    if "params" not in checkpoint:
+        return checkpoint.get("model") == params["model_size"]
+    return checkpoint["params"] == params
+
+
+def is_complete(transcript_path: str) -> bool:
+    """A transcript is only complete once its checkpoint says so. Transcripts written before
+    checkpoints existed have none, and are trusted to be complete"""
+    path = _checkpoint_path(transcript_path)
+    if os.path.exists(path):
+        with open(path, "r", encoding=utils.ENCODING) as f:
+            return json.load(f)["complete"]
+    return storage.exists(transcript_path)
+
+
+def is_complete_with(transcript_path: str, params: dict) -> bool:
+    """Whether the transcript at [transcript_path] is complete and was made with [params], so it can be kept as it is"""
+    return is_complete(transcript_path) and made_with(transcript_path, params)
+
+
+def mark_complete(
+    transcript_path: str, model_size: Optional[str] = None, params: Optional[dict] = None
+) -> None:
+    """Marks a transcript that was produced elsewhere, e.g. restored from the artifact cache, as finished"""
+    if is_complete(transcript_path):
+        return
+    write_checkpoint(
+        transcript_path,
+        read_checkpoint(transcript_path)["end"],
+        os.path.getsize(transcript_path),
+        model_size,
+        complete=True,
+        params=params,
+    )
+
+
+def get_settings(**overrides) -> dict:
+    """returns the Whisper settings to use: model_size, device, compute_type, cpu_threads, num_workers, beam_size and vad_filter.
+    The defaults above are replaced by the calibration autotune saved for this host, if there is one and USE_CALIBRATION is set,
+    which are in turn replaced by any of [overrides] that is not None
+    """
+    settings = {
+        "model_size": MODEL_SIZE,
+        "device": DEVICE,
+        "compute_type": COMPUTE_TYPE,
+        "cpu_threads": CPU_THREADS,
+        "num_workers": NUM_WORKERS,
+        "beam_size": BEAM_SIZE,
+        "vad_filter": VAD_FILTER,
+    }
+    if USE_CALIBRATION:
+        from skipping_schoo import autotune
+
+        calibrated = autotune.load_calibration() or {}
+        settings.update({k: v for k, v in calibrated.items() if k in settings})
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    return settings
+
+
+def artifact_params(
+    model_size: Optional[str] = None,
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
+    language: str = LANGUAGE,
+    beam_size: Optional[int] = None,
+    vad_filter: Optional[bool] = None,
+    split: bool = False,
+) -> dict:
+    """Everything besides the audio that changes the transcript, for keying the artifact cache and checking checkpoints.
+    [split] is set for transcripts made from pieces split at silences, which lack the context of the previous piece"""
+    settings = get_settings(
+        model_size=model_size,
+        device=device,
+        compute_type=compute_type,
+        beam_size=beam_size,
+        vad_filter=vad_filter,
+    )
+    return {
+        "model_size": settings["model_size"],
+        "device": settings["device"],
+        "compute_type": settings["compute_type"],
+        "language": language,
+        "format": FMT,
+        "word_timestamps": WORD_TIMESTAMPS,
+        "beam_size": settings["beam_size"],
+        "vad_filter": settings["vad_filter"],
+        "split": split,
+    }
+
+
+def get_transcript_path(input_filename: str) -> str:
+    """Returns the path the transcript of [input_filename] is written to, creating its directory"""
+    output_filename = utils.make_output_filename(input_filename, "txt")
+    output_path = utils.get_output_directory_path(input_filename)
+    os.makedirs(output_path, exist_ok=True)
+    return os.path.join(output_path, output_filename)
+
+
+@metrics.stage("model_load")
+def load_model(
+    model_size: Optional[str] = None,
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
+    cpu_threads: Optional[int] = None,
+    num_workers: Optional[int] = None,
+):
+    """Loads a Whisper model. This is the slowest part of a short transcription, so callers
+    transcribing several files should load once and hand the model to [transcribe]
+    Settings left as None are taken from [get_settings]. [cpu_threads] of 0 lets CTranslate2 pick its own default
+    """
+    settings = get_settings(
+        model_size=model_size,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+    log(
+        f"Loading Whisper model '{settings['model_size']}' ({settings['compute_type']}, {settings['cpu_threads'] or 'default'} threads)..."
+    )
+    from faster_whisper import WhisperModel
+
+    whisper = WhisperModel(
+        settings["model_size"],
+        device=settings["device"],
+        compute_type=settings["compute_type"],
+        cpu_threads=settings["cpu_threads"],
+        num_workers=settings["num_workers"],
+    )
+    log("Whisper model loaded")
+    return whisper
+
+
+@metrics.stage("transcribe")
 def transcribe(
     input_filename: str,
-    model_size: str = MODEL_SIZE,
-    device: str = DEVICE,
-    compute_type: str = COMPUTE_TYPE,
+    model_size: Optional[str] = None,
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
     language: str = LANGUAGE,
     overwrite: bool = False,
     cleanup: bool = False,
+    whisper=None,
+    audio=None,
+    beam_size: Optional[int] = None,
+    vad_filter: Optional[bool] = None,
+    cpu_threads: Optional[int] = None,
+    num_workers: Optional[int] = None,
+    transcript_path: Optional[str] = None,
 ) -> str:
-    """Uses Whisper to create a transcript"""
-    log(f"Loading Video File '{input_filename}'...")
-    runtime_secs = get_runtime_secs(input_filename)
+    """Uses Whisper to create a transcript
+    If an already loaded [whisper] model is handed in, it is used instead of loading a new one
+    Settings left as None are taken from [get_settings]
+    The transcript is written to [transcript_path], defaulting to [get_transcript_path] of [input_filename]
+
+    [audio] may hold the already decoded 16khz mono float32 samples of [input_filename], in which case
+    nothing is read from disk and [input_filename] is only used to name the output.
+    Otherwise the samples written next to [input_filename] by rip_audio.rip are memory mapped, and only
+    files without them are decoded by Whisper itself
+    """
+    streamed = audio is not None
+    if audio is None:
+        log(f"Loading Video File '{input_filename}'...")
+        audio = rip_audio.load_samples(input_filename)
+    if audio is None:
+        runtime_secs = get_runtime_secs(input_filename)
+    else:
+        runtime_secs = len(audio) / rip_audio.SAMPLE_RATE
     log(
-        f"file is {runtime_secs} seconds  / {round(runtime_secs / 60, 2) } minutes long"
+        f"file is {round(runtime_secs, 2)} seconds  / {round(runtime_secs / 60, 2) } minutes long"
     )
 
-    output_filename = utils.make_output_filename(input_filename, "txt")
-    output_path = utils.get_output_directory_path(input_filename)
-    os.makedirs(utils.get_output_directory_path(input_filename), exist_ok=True)
-    full_path_out = os.path.join(output_path, output_filename)
+    full_path_out = transcript_path or get_transcript_path(input_filename)
+    settings = get_settings(
+        model_size=model_size,
+        device=device,
+        compute_type=compute_type,
+        beam_size=beam_size,
+        vad_filter=vad_filter,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+    model_size = settings["model_size"]
+    params = artifact_params(
+        model_size=model_size,
+        device=settings["device"],
+        compute_type=settings["compute_type"],
+        language=language,
+        beam_size=settings["beam_size"],
+        vad_filter=settings["vad_filter"],
+    )
+    same_settings = made_with(full_path_out, params)
 
-    if not overwrite and os.path.exists(full_path_out):
+    if not overwrite and is_complete(full_path_out) and same_settings:
         log(
             f"Transcription file already existed at {full_path_out}, and overwrite is set to false. Skipping transcribe step"
         )
     else:
+        if not overwrite and is_complete(full_path_out):
+            log(f"{full_path_out} was made with other settings, transcribing it again")
+        resume_from = 0.0
+        checkpoint_resumed = False
+        # an unfinished checkpoint means the last run died part way, so only the remaining audio is transcribed,
+        # as long as the first part was made with the same settings. An explicit overwrite starts over
+        checkpoint = read_checkpoint(full_path_out)
+        if (
+            not overwrite
+            and checkpoint is not None
+            and same_settings
+            and os.path.exists(full_path_out)
+        ):
+            resume_from = checkpoint["end"]
+            checkpoint_resumed = True
+            # drop anything written after the last checkpointed segment, e.g. a half written line
+            with open(full_path_out, "r+b") as f:
+                f.truncate(checkpoint["bytes"])
+            log(
+                f"Resuming partial transcription at {resume_from} seconds, appending to {full_path_out}"
+            )
+        else:
+            with open(full_path_out, "w", encoding="utf8"):
+                pass
         log(f"Will write output to {full_path_out}")
-        log(f"Loading Whisper model '{model_size}'...")
-        whisper = WhisperModel(model_size, device=device, compute_type=compute_type)
-        log("Whisper model loaded. Beginning transcription")
+        if whisper is None:
+            whisper = load_model(
+                model_size,
+                device=settings["device"],
+                compute_type=settings["compute_type"],
+                cpu_threads=settings["cpu_threads"],
+                num_workers=settings["num_workers"],
+            )
+        log("Beginning transcription")
         starttime = datetime.datetime.now()
-        segments, info = whisper.transcribe(input_filename, language=language)
-        with open(full_path_out, "w", encoding="utf8") as f:
+        if resume_from > 0:
+            if audio is None:
+                source = rip_audio.decode_samples(input_filename, start=resume_from)
+            else:
+                source = audio[int(resume_from * rip_audio.SAMPLE_RATE) :]
+        else:
+            source = input_filename if audio is None else audio
+        segments, info = whisper.transcribe(
+            source,
+            language=language,
+            word_timestamps=WORD_TIMESTAMPS,
+            beam_size=settings["beam_size"],
+            vad_filter=settings["vad_filter"],
+        )
+        writer = structured.SegmentWriter(
+            full_path_out, resume_secs=resume_from if checkpoint_resumed else None
+        )
+        with writer, open(full_path_out, "a", encoding="utf8") as f:
+            write_checkpoint(
+                full_path_out, resume_from, os.fstat(f.fileno()).st_size, params=params
+            )
             for segment in segments:
-                segment_start_secs = round(segment.start, 2)
-                segment_end_secs = round(segment.end, 2)
-                percent_done = round(segment_end_secs / runtime_secs, 2) * 100
+                record = structured.to_record(segment, resume_from)
+                writer.write(record)
+                metrics.count("segments", stage="transcribe")
+                start_secs = segment.start + resume_from
+                end_secs = segment.end + resume_from
+                segment_end_secs = round(end_secs, 2)
+                percent_done = round(segment_end_secs / max(1, runtime_secs), 2) * 100
                 as_utf8 = segment.text
                 log(
                     f"\r[{percent_done}%] Transcribed {segment_end_secs} seconds: {as_utf8}",
                     end="\r",
                 )
-                txt = FMT.format(segment_start_secs, segment_end_secs, as_utf8)
+                txt = format_segment(start_secs, end_secs, as_utf8)
                 f.write(txt)
                 f.write("\n")
                 f.flush()
+                write_checkpoint(
+                    full_path_out, end_secs, os.fstat(f.fileno()).st_size, params=params
+                )
+        write_checkpoint(
+            full_path_out,
+            runtime_secs,
+            os.path.getsize(full_path_out),
+            complete=True,
+            params=params,
+        )
         utils.eprint("", end="\r")
         endtime = datetime.datetime.now()
+        metrics.count("audio_seconds", runtime_secs - resume_from, stage="transcribe")
         mins = (endtime - starttime).total_seconds() / 60
         log(
             f"Finished transcribing, took {mins} minutes, output written to {full_path_out}"
         )
-        if cleanup:
+        if cleanup and not streamed:
             log(f"Cleanup set to true, deleting input audio at {input_filename}")
             os.unlink(input_filename)
+            rip_audio.remove_samples(input_filename)
     return full_path_out
 
 
@@ -122,9 +433,59 @@ def main() -> int:
         help="if set, will overwrite any existing files on disk related to previous extraction attempts on the input video",
     )
 
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        help="if above 1, splits the audio at silences and transcribes the pieces on this many processes",
+    )
+    parser.add_argument("--model", help=f"Whisper model size. Defaults to the calibrated one, or {MODEL_SIZE}")
+    parser.add_argument("--compute-type", help=f"Defaults to the calibrated one, or {COMPUTE_TYPE}")
+    parser.add_argument("--threads", type=int, help="cpu threads of the model. Defaults to the calibrated count")
+    parser.add_argument("--workers", type=int, help="CTranslate2 workers of the model")
+    parser.add_argument("--beam-size", type=int, help=f"Defaults to the calibrated one, or {BEAM_SIZE}")
+    parser.add_argument(
+        "--vad",
+        action=argparse.BooleanOptionalAction,
+        help="whether to skip silences with the VAD filter. Defaults to the calibrated choice",
+    )
+    parser.add_argument(
+        "--no-calibration",
+        action="store_true",
+        help="if set, ignores the settings autotune saved for this host, and uses the defaults",
+    )
+
     args = parser.parse_args()
 
-    transcribe(args.audio_file, overwrite=args.overwrite, cleanup=args.cleanup)
+    global USE_CALIBRATION
+    if args.no_calibration:
+        USE_CALIBRATION = False
+    if args.processes > 1:
+        from skipping_schoo import parallel_transcribe
+
+        parallel_transcribe.transcribe_parallel(
+            args.audio_file,
+            processes=args.processes,
+            model_size=args.model,
+            compute_type=args.compute_type,
+            overwrite=args.overwrite,
+            cleanup=args.cleanup,
+            beam_size=args.beam_size,
+            vad_filter=args.vad,
+        )
+    else:
+        transcribe(
+            args.audio_file,
+            model_size=args.model,
+            compute_type=args.compute_type,
+            overwrite=args.overwrite,
+            cleanup=args.cleanup,
+            beam_size=args.beam_size,
+            vad_filter=args.vad,
+            cpu_threads=args.threads,
+            num_workers=args.workers,
+        )
 
     return 0
 
@@ -1,10 +1,14 @@
 import datetime
 import os
 import sys
+import threading
+from typing import Optional
 
 
 ENCODING = "utf8"
 
+CACHE_DIR_ENV = "SKIPPING_SCHOO_CACHE_DIR"
+
 def eprint(*msg: object, end: str = "\n") -> None:
     """Prints to stderr"""
     print(*msg, end=end, file=sys.stderr)
@@ -34,3 +38,31 @@ def get_output_directory_path(fpath: str) -> str:
     no_ext = get_basename_no_ext(fpath)
     output_path = os.path.join("./", no_ext)
     return output_path
+
+
+def cpu_threads_per_worker(workers: int, cores: Optional[int] = None) -> int:
+    """Splits the cores of the machine evenly between [workers]"""
+    if cores is None:
+        cores = os.cpu_count() or 1
+    return max(1, cores // max(1, workers))
+
+
+def get_cache_dir(*parts: str) -> str:
+    """returns (and creates) a directory under the cache root, which is shared between runs from any working directory.
+    The root is read from the SKIPPING_SCHOO_CACHE_DIR environment variable, defaulting to ~/.cache/skipping_schoo
+    """
+    root = os.getenv(CACHE_DIR_ENV) or os.path.join(
+        os.path.expanduser("~"), ".cache", "skipping_schoo"
+    )
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    """Writes [text] to a temporary file next to [path] and renames it into place,
+    so that readers never see a partially written file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding=ENCODING) as f:
+        f.write(text)
+    os.replace(tmp_path, path)
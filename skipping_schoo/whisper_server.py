@@ -0,0 +1,350 @@
+# /usr/bin/python3
+""" This file is responsible for keeping Whisper models resident in memory, so that back-to-back transcriptions only pay the model load once"""
+import argparse
+import glob
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+from concurrent.futures import Future
+from typing import Optional
+
+from skipping_schoo import storage
+from skipping_schoo import transscribe
+from skipping_schoo import utils
+from skipping_schoo.errors import SkippingSchooError
+
+PROG = "WhisperServer"
+
+HOST = "127.0.0.1"
+PORT = 8765
+REPLICAS = 1
+QUEUE_SIZE = 16
+
+_STOP = object()
+
+
+def log(msg: str, end="\n") -> None:
+    utils.log(msg, end=end, prog=PROG)
+
+
+class _Job:
+    def __init__(self, audio_path: str, overwrite: bool, cleanup: bool) -> None:
+        self.audio_path = audio_path
+        self.overwrite = overwrite
+        self.cleanup = cleanup
+        self.future: Future = Future()
+
+
+class TranscriptionServer:
+    """Holds [replicas] loaded Whisper models, each served by its own worker thread.
+    CTranslate2 releases the GIL while decoding, so replicas run in parallel.
+
+    Jobs are handed out through a bounded queue: [submit] blocks once [queue_size] jobs are waiting
+    """
+
+    def __init__(
+        self,
+        model_size: Optional[str] = None,
+        device: Optional[str] = None,
+        compute_type: Optional[str] = None,
+        language: str = transscribe.LANGUAGE,
+        replicas: int = REPLICAS,
+        queue_size: int = QUEUE_SIZE,
+        cpu_threads: int = 0,
+    ) -> None:
+        if replicas < 1:
+            raise SkippingSchooError("At least one model replica is required")
+        # resolved once, so every replica and job uses the same settings even if the calibration changes
+        self.settings = transscribe.get_settings(
+            model_size=model_size, device=device, compute_type=compute_type
+        )
+        self.model_size = self.settings["model_size"]
+        self.device = self.settings["device"]
+        self.compute_type = self.settings["compute_type"]
+        self.language = language
+        self.replicas = replicas
+        self.cpu_threads = cpu_threads or utils.cpu_threads_per_worker(replicas)
+        self._jobs: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers: list[threading.Thread] = []
+        self._loaded = threading.Barrier(replicas + 1)
+
+    def start(self) -> "TranscriptionServer":
+        """Loads every model replica. Returns once all of them are ready to take jobs"""
+        log(
+            f"Starting {self.replicas} replica(s) of '{self.model_size}' with {self.cpu_threads} thread(s) each"
+        )
+        for i in range(self.replicas):
+            t = threading.Thread(
+                target=self._work, name=f"{PROG}-{i}", daemon=True
+            )
+            t.start()
+            self._workers.append(t)
+        try:
+            self._loaded.wait()
+        except threading.BrokenBarrierError:
+            raise SkippingSchooError("Failed to load a Whisper model replica")
+        log("All model replicas loaded")
+        return self
+
+    def _work(self) -> None:
+        try:
+            whisper = transscribe.load_model(
+                self.model_size,
+                device=self.device,
+                compute_type=self.compute_type,
+                cpu_threads=self.cpu_threads,
+                num_workers=self.settings["num_workers"],
+            )
+        except Exception:
+            self._loaded.abort()
+            raise
+        self._loaded.wait()
+        while True:
+            job = self._jobs.get()
+            if job is _STOP:
+                self._jobs.task_done()
+                return
+            if not job.future.set_running_or_notify_cancel():
+                self._jobs.task_done()
+                continue
+            try:
+                transcript_path = transscribe.transcribe(
+                    job.audio_path,
+                    model_size=self.model_size,
+                    device=self.device,
+                    compute_type=self.compute_type,
+                    language=self.language,
+                    overwrite=job.overwrite,
+                    cleanup=job.cleanup,
+                    whisper=whisper,
+                    beam_size=self.settings["beam_size"],
+                    vad_filter=self.settings["vad_filter"],
+                )
+                job.future.set_result(transcript_path)
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                self._jobs.task_done()
+
+    def submit(
+        self, audio_path: str, overwrite: bool = False, cleanup: bool = False
+    ) -> Future:
+        """Queues [audio_path] for transcription
+        returns a future resolving to the path of the transcript
+        """
+        if len(self._workers) == 0:
+            raise SkippingSchooError("Transcription server was not started")
+        job = _Job(audio_path, overwrite, cleanup)
+        self._jobs.put(job)
+        return job.future
+
+    def transcribe(
+        self, audio_path: str, overwrite: bool = False, cleanup: bool = False
+    ) -> str:
+        """Transcribes [audio_path] on the next free replica and waits for the result"""
+        return self.submit(audio_path, overwrite=overwrite, cleanup=cleanup).result()
+
+    def shutdown(self) -> None:
+        """Lets the queued jobs finish, then stops every replica"""
+        for _ in self._workers:
+            self._jobs.put(_STOP)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+    def __enter__(self) -> "TranscriptionServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Reads one json job per line, and answers with one json line per job"""
+
+    def handle(self) -> None:
+        server: TranscriptionServer = self.server.transcription_server
+        for line in self.rfile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                request = json.loads(line)
+                transcript_path = server.transcribe(
+                    request["audio"],
+                    overwrite=bool(request.get("overwrite", False)),
+                    cleanup=bool(request.get("cleanup", False)),
+                )
+                response = {"ok": True, "transcript": os.path.abspath(transcript_path)}
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode(utils.ENCODING))
+            self.wfile.write(b"\n")
+            self.wfile.flush()
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(
+    transcription_server: TranscriptionServer, host: str = HOST, port: int = PORT
+) -> None:
+    """Accepts transcription jobs over a local socket until interrupted"""
+    with _ThreadingServer((host, port), _RequestHandler) as server:
+        server.transcription_server = transcription_server
+        log(f"Listening for transcription jobs on {host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            log("Interrupted, shutting down")
+
+
+def submit_remote(
+    audio_path: str,
+    host: str = HOST,
+    port: int = PORT,
+    overwrite: bool = False,
+    cleanup: bool = False,
+) -> str:
+    """Sends [audio_path] to a running server and waits for it to be transcribed
+    returns the path of the transcript
+    """
+    request = {
+        "audio": os.path.abspath(audio_path),
+        "overwrite": overwrite,
+        "cleanup": cleanup,
+    }
+    with socket.create_connection((host, port)) as conn:
+        conn.sendall(json.dumps(request, ensure_ascii=False).encode(utils.ENCODING) + b"\n")
+        with conn.makefile("r", encoding=utils.ENCODING) as f:
+            response = json.loads(f.readline())
+    if not response["ok"]:
+        raise SkippingSchooError(f"Transcription failed: {response['error']}")
+    return response["transcript"]
+
+
+def transcribe_many(
+    transcription_server: TranscriptionServer,
+    directory: str,
+    pattern: Optional[str] = None,
+    overwrite: bool = False,
+    cleanup: bool = False,
+) -> dict[str, str]:
+    """Transcribes every file in [directory] matching [pattern] with the loaded replicas.
+    Without a [pattern], every audio file rip_audio or download_schoo may write is transcribed, whichever storage mode wrote it
+    returns a mapping of audio path to transcript path, or to the error for failed files
+    """
+    patterns = [pattern] if pattern is not None else [f"*.{extension}" for extension in storage.AUDIO_CODECS]
+    audio_paths = sorted(
+        {p for glob_pattern in patterns for p in glob.glob(os.path.join(directory, glob_pattern))}
+    )
+    log(f"Found {len(audio_paths)} audio files in {directory}")
+    futures = {
+        p: transcription_server.submit(p, overwrite=overwrite, cleanup=cleanup)
+        for p in audio_paths
+    }
+    results: dict[str, str] = {}
+    for p, future in futures.items():
+        try:
+            results[p] = future.result()
+        except Exception as e:
+            log(f"Failed to transcribe {p}: {e}")
+            results[p] = f"error: {e}"
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Keeps Whisper loaded in memory and transcribes many files without reloading the model",
+    )
+    parser.add_argument("--model-size", help="Defaults to the calibrated one, see transscribe.get_settings")
+    parser.add_argument("--compute-type", help="Defaults to the calibrated one")
+    parser.add_argument("--device")
+    parser.add_argument(
+        "-r",
+        "--replicas",
+        type=int,
+        default=REPLICAS,
+        help="number of models to keep loaded. The CPU cores are split evenly between them",
+    )
+    parser.add_argument(
+        "-q",
+        "--queue-size",
+        type=int,
+        default=QUEUE_SIZE,
+        help="maximum number of jobs waiting for a free replica",
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="if set, will overwrite any existing transcripts",
+    )
+    parser.add_argument(
+        "-c",
+        "--cleanup",
+        action="store_true",
+        help="if set, will delete the source audio after transcribing",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("serve", help="accept jobs over a local socket")
+    submit = subparsers.add_parser("submit", help="send audio files to a running server")
+    submit.add_argument("audio_files", nargs="+")
+    many = subparsers.add_parser(
+        "transcribe-many", help="transcribe every audio file (wav, flac or opus) in a directory"
+    )
+    many.add_argument("directory")
+    many.add_argument(
+        "--pattern",
+        help=f"glob of the files to transcribe. Defaults to every file ending in {', '.join(storage.AUDIO_CODECS)}",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        for audio_file in args.audio_files:
+            print(
+                submit_remote(
+                    audio_file,
+                    host=args.host,
+                    port=args.port,
+                    overwrite=args.overwrite,
+                    cleanup=args.cleanup,
+                )
+            )
+        return 0
+
+    transcription_server = TranscriptionServer(
+        model_size=args.model_size,
+        device=args.device,
+        compute_type=args.compute_type,
+        replicas=args.replicas,
+        queue_size=args.queue_size,
+    )
+    with transcription_server:
+        if args.command == "serve":
+            serve(transcription_server, host=args.host, port=args.port)
+            return 0
+        results = transcribe_many(
+            transcription_server,
+            args.directory,
+            pattern=args.pattern,
+            overwrite=args.overwrite,
+            cleanup=args.cleanup,
+        )
+    for audio_path, transcript in results.items():
+        print(f"{audio_path}\t{transcript}")
+    return 0 if all(not r.startswith("error: ") for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from skipping_schoo import artifact_cache
+from skipping_schoo import transscribe
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transscribe, "USE_CALIBRATION", False)
+    return artifact_cache.ArtifactCache(str(tmp_path / "store"), max_bytes=1024)
+
+
+def _transcribe(calls, path, params):
+    def produce(overwrite_output):
+        calls.append(overwrite_output)
+        with open(path, "w", encoding="utf8") as f:
+            f.write(transscribe.FMT.format(0.0, 1.5, "こんにちは") + "\n")
+        transscribe.write_checkpoint(path, 1.5, os.path.getsize(path), complete=True, params=params)
+        return path
+
+    return produce
+
+
+def _stored(cache, stage):
+    return cache.stats().get(stage, {}).get("artifacts", 0)
+
+
+def _run_transcript(cache, calls, path, params):
+    return cache.run(
+        "transcript",
+        path,
+        _transcribe(calls, path, params),
+        params=params,
+        trust_existing=True,
+        valid=lambda p: transscribe.is_complete_with(p, params),
+    )
+
+
+def test_evicted_transcript_is_kept_not_remade(cache):
+    params = transscribe.artifact_params()
+    calls = []
+    _run_transcript(cache, calls, "a.txt", params)
+    cache.evict(max_bytes=0)
+    assert _stored(cache, "transcript") == 0
+
+    _run_transcript(cache, calls, "a.txt", params)
+    assert len(calls) == 1
+    assert _stored(cache, "transcript") == 1
+
+
+def test_transcript_without_sidecar_is_kept_if_checkpoint_matches(cache):
+    params = transscribe.artifact_params()
+    calls = []
+    _transcribe(calls, "a.txt", params)(False)
+    _run_transcript(cache, [], "a.txt", params)
+    os.unlink(artifact_cache._sidecar_path("a.txt"))
+    cache.evict(max_bytes=0)
+
+    _run_transcript(cache, calls, "a.txt", params)
+    assert len(calls) == 1
+
+
+def test_transcript_made_with_other_settings_is_remade(cache):
+    params = transscribe.artifact_params()
+    calls = []
+    _run_transcript(cache, calls, "a.txt", params)
+    cache.evict(max_bytes=0)
+
+    other = transscribe.artifact_params(beam_size=params["beam_size"] + 1)
+    _run_transcript(cache, calls, "a.txt", other)
+    assert len(calls) == 2
+
+
+def test_media_is_not_stored(cache):
+    calls = []
+
+    def produce(overwrite_output):
+        calls.append(overwrite_output)
+        with open("v.mp4", "wb") as f:
+            f.write(b"\0" * 4096)
+        return "v.mp4"
+
+    cache.run("video", "v.mp4", produce, params={"class_id": 1}, trust_existing=True)
+    assert _stored(cache, "video") == 0
+    cache.run("video", "v.mp4", produce, params={"class_id": 1}, trust_existing=True)
+    assert calls == [False]
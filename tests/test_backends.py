@@ -0,0 +1,72 @@
+import pytest
+
+from skipping_schoo import backends
+from skipping_schoo import llm_cache
+from skipping_schoo import ratelimit
+from skipping_schoo import summarize
+from skipping_schoo.errors import RateLimitError
+
+
+def _request(content):
+    return {"model": "stub", "messages": [{"role": "user", "content": content}], "max_tokens": 20}
+
+
+@pytest.fixture
+def stub():
+    server = backends.StubServer(port=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def limited_stub():
+    server = backends.StubServer(port=0, rate_limited=1).start()
+    yield server
+    server.stop()
+
+
+def test_stub_streams_a_deterministic_completion(stub):
+    backend = backends.make_backend("stub", stub.url)
+    pieces = []
+    completion = backend.complete(_request("one two three"), on_text=pieces.append)
+
+    assert completion.text.endswith("one two three")
+    assert completion.text.startswith("[stub ")
+    assert len(pieces) > 1
+    assert "".join(pieces) == completion.text
+    assert completion.first_token_secs is not None
+    assert backend.complete(_request("one two three")).text == completion.text
+    assert backend.complete(_request("four")).text != completion.text
+
+
+def test_rate_limit_carries_headers(limited_stub):
+    backend = backends.make_backend("stub", limited_stub.url)
+    with pytest.raises(RateLimitError) as raised:
+        backend.complete(_request("one two three"))
+    headers = {k.lower(): v for k, v in raised.value.headers.items()}
+    for name, value in backends.STUB_RATE_LIMIT_HEADERS.items():
+        assert headers[name] == value
+    assert backend.complete(_request("one two three")).text.endswith("one two three")
+
+
+def test_summarize_retries_then_answers_from_cache(limited_stub, tmp_path, monkeypatch):
+    try:
+        summarize.count_tokens_text("tokenizer check")
+    except Exception as e:
+        pytest.skip(f"no tokenizer available: {e}")
+    monkeypatch.setattr(summarize, "BACKEND", "stub")
+    monkeypatch.setattr(summarize, "BASE_URL", limited_stub.url)
+    monkeypatch.setattr(summarize, "_backend", None)
+    monkeypatch.setattr(summarize, "USE_RESPONSE_CACHE", True)
+    monkeypatch.setattr(llm_cache, "_cache", llm_cache.ResponseCache(str(tmp_path / "responses")))
+    monkeypatch.setattr(ratelimit, "backoff_delay", lambda attempt: 0.0)
+
+    output_path = str(tmp_path / "summary.txt")
+    text = summarize._send_with_retries("summarize this lecture", output_path=output_path)
+    assert text.endswith("summarize this lecture")
+    assert limited_stub.requests == 2
+    with open(output_path, encoding="utf8") as f:
+        assert f.read().strip() == text
+
+    assert summarize._send_with_retries("summarize this lecture") == text
+    assert limited_stub.requests == 2
@@ -0,0 +1,28 @@
+import pytest
+
+from skipping_schoo import compact
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("まあ、それはいいです", "それはいいです"),
+        ("あの、今日は", "今日は"),
+        ("えーと今日は", "今日は"),
+        ("えーと、あの、今日は", "今日は"),
+        ("あのーそれは", "それは"),
+        ("それは、えー、違います", "それは、違います"),
+        ("um, yes", "yes"),
+        ("うーん", ""),
+    ],
+)
+def test_fillers_are_removed(text, expected):
+    assert compact.clean_segment(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["あの人は来ます", "まあまあです", "あのね", "umbrella", "それは、あの人です"],
+)
+def test_words_starting_like_fillers_are_kept(text):
+    assert compact.clean_segment(text) == text
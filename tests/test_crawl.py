@@ -0,0 +1,48 @@
+import pytest
+
+from skipping_schoo import catalog
+from skipping_schoo import crawl
+
+
+@pytest.fixture
+def stub():
+    server = crawl.StubSchooServer(port=0, latency=0.02, missing=["1003", "1007"]).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def class_catalog(tmp_path):
+    return catalog.Catalog(str(tmp_path / "catalog.sqlite3"))
+
+
+def test_crawl_fills_the_catalog(stub, class_catalog):
+    class_ids = crawl.parse_class_ids(["1000-1019"])
+    crawler = crawl.Crawler(class_catalog, base_url=stub.url, delay_secs=0)
+    counts = crawler.crawl(class_ids)
+
+    assert counts["resolved"] == 18
+    assert counts["missing"] == 2
+    assert counts["failed"] == 0
+    title, m3u8 = class_catalog.get("1000")
+    assert "テスト授業 1000" in title
+    assert m3u8 == "https://video.schoo.jp/video/2001/1000/master.m3u8"
+    assert class_catalog.get("1003") == (None, None)
+    assert class_catalog.resolved(class_ids) == set(class_ids)
+    assert stub.peak_in_flight <= crawl.CONCURRENCY
+
+
+def test_crawl_skips_what_the_catalog_knows(stub, class_catalog):
+    class_ids = crawl.parse_class_ids(["1000-1009"])
+    crawl.Crawler(class_catalog, base_url=stub.url, delay_secs=0).crawl(class_ids)
+    requests = stub.requests
+
+    counts = crawl.Crawler(class_catalog, base_url=stub.url, delay_secs=0).crawl(class_ids)
+    assert counts["skipped"] == len(class_ids)
+    assert stub.requests == requests
+
+
+def test_concurrency_limit(stub, class_catalog):
+    crawler = crawl.Crawler(class_catalog, base_url=stub.url, concurrency=2, delay_secs=0)
+    crawler.crawl(crawl.parse_class_ids(["1000-1011"]))
+    assert 1 <= stub.peak_in_flight <= 2
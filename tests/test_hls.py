@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from skipping_schoo import hls
+from skipping_schoo import http_client
+from skipping_schoo.errors import SkippingSchooError
+
+SEGMENTS = [bytes([i]) * (100 + i) for i in range(5)]
+PLAYLIST = "#EXTM3U\n#EXT-X-TARGETDURATION:2\n" + "".join(
+    f"#EXTINF:2.0,\nseg{i}.ts\n" for i in range(len(SEGMENTS))
+) + "#EXT-X-ENDLIST\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        if self.path == "/playlist.m3u8":
+            body = PLAYLIST.encode("utf8")
+        elif self.path.startswith("/seg") and self.path not in server.failing:
+            body = SEGMENTS[int(self.path[4:].split(".")[0])]
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.failing = set()
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/playlist.m3u8"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize(
+    "tag",
+    ["#EXT-X-KEY:METHOD=AES-128,URI=\"key\"", "#EXT-X-BYTERANGE:100@0", "#EXT-X-MAP:URI=\"init.mp4\",BYTERANGE=\"100@0\""],
+)
+def test_unsupported_playlists_are_rejected(tag):
+    with pytest.raises(SkippingSchooError):
+        hls.parse_playlist(f"#EXTM3U\n{tag}\n#EXTINF:2.0,\nseg0.ts\n", "http://example.com/")
+
+
+def test_parse_playlist():
+    variants, segments = hls.parse_playlist(PLAYLIST, "http://example.com/a/playlist.m3u8")
+    assert variants == []
+    assert [s.url for s in segments] == [f"http://example.com/a/seg{i}.ts" for i in range(len(SEGMENTS))]
+    assert [s.duration for s in segments] == [2.0] * len(SEGMENTS)
+
+
+def test_interrupted_download_resumes(server, tmp_path):
+    work_dir = str(tmp_path / "segments")
+    server.failing = {"/seg3.ts"}
+    with pytest.raises(SkippingSchooError):
+        hls.download(server.url, work_dir, retries=0, session=http_client.make_session())
+    with open(os.path.join(work_dir, hls.MANIFEST_NAME), encoding="utf8") as f:
+        assert sorted(json.load(f)["segments"]) == ["0", "1", "2", "4"]
+
+    server.failing = set()
+    server.requests = []
+    path = hls.download(server.url, work_dir, retries=0, session=http_client.make_session())
+    assert server.requests == ["/playlist.m3u8", "/seg3.ts"]
+    with open(path, "rb") as f:
+        assert f.read() == b"".join(SEGMENTS)
+
+    server.requests = []
+    assert hls.download(server.url, work_dir, session=http_client.make_session()) == path
+    assert server.requests == []
+
+
+def test_concatenate_joins_in_order_and_deletes(tmp_path):
+    paths = []
+    for i, data in enumerate(SEGMENTS):
+        paths.append(str(tmp_path / f"{i:06d}.seg"))
+        with open(paths[-1], "wb") as f:
+            f.write(data)
+    output = hls.concatenate(paths, str(tmp_path / hls.STREAM_NAME))
+    with open(output, "rb") as f:
+        assert f.read() == b"".join(SEGMENTS)
+    assert not any(os.path.exists(p) for p in paths)
+    assert not os.path.exists(f"{output}.part")
@@ -0,0 +1,111 @@
+import sqlite3
+import time
+
+import pytest
+
+from skipping_schoo import jobqueue
+
+LEASE_SECS = 0.05
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return jobqueue.JobQueue(str(tmp_path / "jobs.sqlite3"), lease_secs=LEASE_SECS)
+
+
+def _states(job_queue, class_id):
+    with sqlite3.connect(job_queue.path) as conn:
+        return dict(conn.execute("SELECT stage, state FROM jobs WHERE class_id = ? ORDER BY seq", (class_id,)))
+
+
+def _expire():
+    time.sleep(LEASE_SECS * 2)
+
+
+def test_expired_lease_is_reclaimed(job_queue):
+    job_queue.add(["2799"])
+    first = job_queue.claim("a", ["download"])
+    assert first.attempts == 1
+    assert job_queue.claim("b", ["download"]) is None
+
+    _expire()
+    second = job_queue.claim("b", ["download"])
+    assert (second.class_id, second.stage, second.worker, second.attempts) == ("2799", "download", "b", 2)
+    assert not job_queue.heartbeat(first)
+    assert job_queue.heartbeat(second)
+
+
+def test_complete_after_the_lease_moved(job_queue):
+    job_queue.add(["2799"])
+    first = job_queue.claim("a", ["download"])
+    _expire()
+    second = job_queue.claim("b", ["download"])
+
+    assert not job_queue.complete(first, {"video_id": "2799", "title": "stale"})
+    assert _states(job_queue, "2799")["download"] == "leased"
+    assert job_queue.complete(second, {"video_id": "2799", "title": "fresh"})
+    assert _states(job_queue, "2799") == {
+        "download": "done",
+        "rip": "pending",
+        "transcribe": "waiting",
+        "summarize": "waiting",
+    }
+    assert job_queue.claim("c", ["rip"]).course["title"] == "fresh"
+
+
+def test_fail_of_a_lost_lease_is_ignored(job_queue):
+    job_queue.add(["2799"])
+    first = job_queue.claim("a", ["download"])
+    _expire()
+    job_queue.claim("b", ["download"])
+    job_queue.fail(first, "stale", retryable=False)
+    assert _states(job_queue, "2799")["download"] == "leased"
+
+
+def test_expired_leases_fail_after_max_attempts_and_retry_restores(job_queue):
+    job_queue.add(["2799"])
+    for attempt in range(jobqueue.MAX_ATTEMPTS):
+        job = job_queue.claim(f"w{attempt}", ["download"])
+        assert job.attempts == attempt + 1
+        _expire()
+
+    assert job_queue.claim("last", ["download"]) is None
+    assert _states(job_queue, "2799") == {
+        "download": "failed",
+        "rip": "cancelled",
+        "transcribe": "cancelled",
+        "summarize": "cancelled",
+    }
+    assert job_queue.remaining(jobqueue.STAGES) == 0
+
+    assert job_queue.retry(["2799"]) == 1
+    assert _states(job_queue, "2799") == {
+        "download": "pending",
+        "rip": "waiting",
+        "transcribe": "waiting",
+        "summarize": "waiting",
+    }
+    assert job_queue.claim("again", ["download"]).attempts == 1
+
+
+def test_fail_retries_then_gives_up(job_queue, monkeypatch):
+    monkeypatch.setattr(jobqueue, "RETRY_SECS", 0)
+    job_queue.add(["2799"], audio_only=True)
+    for attempt in range(jobqueue.MAX_ATTEMPTS):
+        job = job_queue.claim("a", ["download"])
+        job_queue.fail(job, f"error {attempt}")
+    assert _states(job_queue, "2799") == {
+        "download": "failed",
+        "transcribe": "cancelled",
+        "summarize": "cancelled",
+    }
+
+
+def test_lost_job_is_not_run(job_queue):
+    worker = jobqueue.Worker(job_queue, ["download"])
+    job_queue.add(["2799"])
+    job = job_queue.claim("a", ["download"])
+    job.lost.set()
+    worker._run_job(job, {})
+    assert worker.completed == 0 and worker.failed == 0
+    assert _states(job_queue, "2799")["download"] == "leased"
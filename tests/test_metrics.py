@@ -0,0 +1,68 @@
+from skipping_schoo import metrics
+
+DATA = {
+    "counters": [
+        {"name": "tokens", "labels": {"stage": "summarize"}, "value": 10},
+        {"name": "bytes", "labels": {"stage": "download"}, "value": 100},
+        {"name": "tokens", "labels": {"stage": "draft"}, "value": 5},
+    ],
+    "observations": [
+        {"name": "latency", "labels": {"backend": "a"}, "count": 2, "sum": 1.5, "max": 1.0},
+        {"name": "latency", "labels": {"backend": "b"}, "count": 1, "sum": 0.5, "max": 0.5},
+    ],
+    "spans": [
+        {"name": "transcribe", "count": 1, "secs": 30.0, "errors": 0},
+        {"name": "download", "count": 2, "secs": 4.0, "errors": 1},
+    ],
+}
+
+
+def _parse(text):
+    """returns the (family, type) of every TYPE line, and the (family, sample name) of every sample, in order"""
+    types, samples = [], []
+    family = None
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, family, kind = line.split(" ")
+            types.append((family, kind))
+            continue
+        name = line.split("{")[0].split(" ")[0]
+        float(line.rsplit(" ", 1)[1])
+        assert family is not None and name.startswith(family)
+        samples.append((family, name))
+    return types, samples
+
+
+def _blocks(names):
+    """returns [names] with runs of the same name collapsed"""
+    return [n for i, n in enumerate(names) if i == 0 or names[i - 1] != n]
+
+
+def test_families_are_contiguous():
+    types, samples = _parse(metrics.format_prometheus(DATA))
+    families = [f for f, _ in types]
+    assert len(families) == len(set(families))
+    assert _blocks([f for f, _ in samples]) == families
+    names = _blocks([n for _, n in samples])
+    assert len(names) == len(set(names))
+
+
+def test_sample_names_and_types():
+    types, samples = _parse(metrics.format_prometheus(DATA))
+    assert dict(types) == {
+        "skipping_schoo_bytes_total": "counter",
+        "skipping_schoo_tokens_total": "counter",
+        "skipping_schoo_latency": "summary",
+        "skipping_schoo_latency_max": "gauge",
+        "skipping_schoo_span_seconds_total": "counter",
+        "skipping_schoo_span_count_total": "counter",
+        "skipping_schoo_span_errors_total": "counter",
+        "skipping_schoo_last_run_timestamp_seconds": "gauge",
+    }
+    assert [n for f, n in samples if f == "skipping_schoo_latency"] == [
+        "skipping_schoo_latency_count",
+        "skipping_schoo_latency_count",
+        "skipping_schoo_latency_sum",
+        "skipping_schoo_latency_sum",
+    ]
+    assert len([n for _, n in samples if n == "skipping_schoo_span_seconds_total"]) == 2